@@ -0,0 +1,36 @@
+import contextlib
+import numpy as np
+import os
+
+# Caches and outputs that concurrent workers share, or that an interrupted run
+# may leave behind, are written to a temporary file next to them and renamed
+# into place, so that a reader only ever sees no file or a complete one
+#   with atomic_open('index.npz') as f:
+#       np.savez(f,**columns)
+# The temporary file keeps the extension, as np.save and np.savez append one
+# to paths without it, and is removed if writing fails.
+
+def temporary_path_for(path):
+    root, ext = os.path.splitext(path)
+    return '{0}.{1}.tmp{2}'.format(root,os.getpid(),ext)
+
+# Yields the temporary path to write, which replaces the path on success
+@contextlib.contextmanager
+def atomic_path(path):
+    tmp_path = temporary_path_for(path)
+    try:
+        yield tmp_path
+        os.replace(tmp_path,path)
+    finally:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+@contextlib.contextmanager
+def atomic_open(path,mode='wb'):
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path,mode) as f:
+            yield f
+
+def save_array_atomic(path,array):
+    with atomic_open(path) as f:
+        np.save(f,array)
@@ -0,0 +1,284 @@
+import argparse
+from calculate_optical_flow import flow_to_hsv_image, optical_flow
+from calculate_surface_normals import points_in_camera_coords, surface_normal
+from convert_instance2class import NYU_WNID_TO_CLASS, save_class_from_instance
+import geometry
+from geometry import depth_to_world_points, extrinsics_from_shutter_poses, normalised_pixel_to_ray_array
+from generate_scene_obj import merge_scenenet_obj
+import io
+import json
+from logs_to_protobuf import parse_log_to_frame_pose_pairs
+import numpy as np
+import obj_mesh
+import os
+from PIL import Image
+import platform
+import scenenet_pb2 as sn
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from trajectory_index import IndexedTrajectories
+
+# Times the geometry and labelling hot paths on synthetic data, so that it runs
+# without the dataset
+#   python benchmark.py --save baseline.json
+#   python benchmark.py --baseline baseline.json
+# --baseline without a path compares against the reference results committed
+# in benchmark_baseline.json, whose environment and settings record the machine
+# and parameters they were measured with.  Latencies are only comparable on
+# the same machine, so regenerate it there with --save benchmark_baseline.json
+# (on an otherwise idle machine) before looking for regressions.
+# Every benchmark is synthesised from the same 320x240 depth and instance frame
+# of a box shaped room, a trajectories protobuf of one trajectory, a
+# render_info.log and a ShapeNet style obj.  For each function the median
+# latency of --repeat calls, the frames per second and the peak memory
+# allocated during a call (as traced by tracemalloc) are reported.  With
+# --baseline the latencies are compared against a previous --save, and the
+# exit status is 1 if any is slower by more than --tolerance.
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),'benchmark_baseline.json')
+
+WIDTH = 320
+HEIGHT = 240
+NUM_VIEWS = 300
+FRAME_SKIP = 25
+OBJ_RESOLUTION = 64
+SHAPENET_HASH = '04379243/benchmark'
+
+# Axis aligned walls of the room around the camera, in camera coordinates, as
+# (axis, position, instance id)
+ROOM_PLANES = [(0,-2.0,1),(0,2.0,2),(1,-1.2,3),(1,1.5,4),(2,4.5,5)]
+# Spheres in front of the walls as (centre, radius, instance id)
+ROOM_OBJECTS = [((-0.8,0.6,2.5),0.5,6),((0.9,0.2,3.2),0.7,7),((0.1,-0.5,1.8),0.3,8)]
+# A window in the far wall with no depth, as it is rendered to infinity
+WINDOW = (slice(40,90),slice(200,270))
+
+# Returns the uint16 depth in millimetres and the uint16 instance image of the
+# room, seen from the origin looking along +z
+def synthetic_frame():
+    rays = np.array(normalised_pixel_to_ray_array(WIDTH,HEIGHT))
+    depth = np.full((HEIGHT,WIDTH),np.inf)
+    instance = np.zeros((HEIGHT,WIDTH),dtype=np.uint16)
+    with np.errstate(divide='ignore'):
+        for axis,position,instance_id in ROOM_PLANES:
+            distance = position / rays[...,axis]
+            hit = (distance > 0) & (distance < depth)
+            depth[hit] = distance[hit]
+            instance[hit] = instance_id
+    for centre,radius,instance_id in ROOM_OBJECTS:
+        b = rays.dot(centre)
+        discriminant = b * b - np.dot(centre,centre) + radius * radius
+        distance = b - np.sqrt(np.maximum(discriminant,0))
+        hit = (discriminant > 0) & (distance > 0) & (distance < depth)
+        depth[hit] = distance[hit]
+        instance[hit] = instance_id
+    depth = np.uint16(np.round(depth * 1000.0))
+    depth[WINDOW] = 0
+    return depth, instance
+
+# One trajectory with an instance per wall and object of the room and
+# NUM_VIEWS views moving slowly through it
+def synthetic_trajectories():
+    rng = np.random.RandomState(0)
+    wnids = sorted(NYU_WNID_TO_CLASS)
+    trajectories = sn.Trajectories()
+    traj = trajectories.trajectories.add()
+    traj.render_path = '0/0'
+    traj.layout.layout_type = sn.SceneLayout.KITCHEN
+    traj.layout.model = 'kitchen/benchmark.obj'
+    background = traj.instances.add()
+    background.instance_id = 0
+    background.instance_type = sn.Instance.BACKGROUND
+    for instance_id in range(1,len(ROOM_PLANES) + len(ROOM_OBJECTS) + 1):
+        instance = traj.instances.add()
+        instance.instance_id = instance_id
+        instance.semantic_wordnet_id = wnids[rng.randint(len(wnids))]
+        if instance_id <= len(ROOM_PLANES):
+            instance.instance_type = sn.Instance.LAYOUT_OBJECT
+            continue
+        instance.instance_type = sn.Instance.RANDOM_OBJECT
+        instance.object_info.shapenet_hash = SHAPENET_HASH
+        instance.object_info.height_meters = 0.8
+        pose = instance.object_info.object_pose
+        pose.translation_x, pose.translation_y, pose.translation_z = rng.uniform(-1,1,3)
+        pose.rotation_mat11 = pose.rotation_mat22 = pose.rotation_mat33 = 1.0
+    for view_idx in range(NUM_VIEWS):
+        view = traj.views.add()
+        view.frame_num = view_idx * FRAME_SKIP
+        for pose,offset in ((view.shutter_open,0.0),(view.shutter_close,0.5)):
+            t = view_idx + offset
+            pose.camera.x, pose.camera.y, pose.camera.z = 0.01 * t, 1.2 + 0.001 * t, -0.005 * t
+            pose.lookat.x, pose.lookat.y, pose.lookat.z = 0.01 * t + 0.3, 1.1, 1.0 - 0.005 * t
+            pose.timestamp = t / 25.0
+    return trajectories
+
+# A render_info.log with the pose lines of NUM_VIEWS frames
+def synthetic_render_log(traj):
+    lines = ['instance:{0};{1};benchmark;\n'.format(instance.instance_id,instance.semantic_wordnet_id)
+             for instance in traj.instances[1:]]
+    rng = np.random.RandomState(1)
+    poses = rng.uniform(-3,3,(NUM_VIEWS * 2 * FRAME_SKIP,6))
+    for idx,pose in enumerate(poses):
+        lines.append('time:{0} pose:{1},{2},{3} lookat:{4},{5},{6}\n'.format(idx * 0.01,*pose))
+    return lines
+
+# A uv sphere with quad faces in the v/vt/vn layout of the ShapeNet models
+def synthetic_obj(resolution=OBJ_RESOLUTION):
+    lines = ['mtllib model_normalized.mtl\n']
+    theta, phi = np.meshgrid(np.linspace(0,np.pi,resolution),np.linspace(0,2 * np.pi,resolution),indexing='ij')
+    normals = np.stack((np.sin(theta) * np.cos(phi),np.cos(theta),np.sin(theta) * np.sin(phi)),axis=-1).reshape(-1,3)
+    lines.extend('v {0:.6f} {1:.6f} {2:.6f}\n'.format(*v) for v in normals * 0.5)
+    lines.extend('vt {0:.6f} {1:.6f}\n'.format(u,v) for u,v in zip(theta.ravel() / np.pi,phi.ravel() / (2 * np.pi)))
+    lines.extend('vn {0:.6f} {1:.6f} {2:.6f}\n'.format(*n) for n in normals)
+    lines.append('usemtl benchmark\n')
+    grid = np.arange(resolution * resolution).reshape(resolution,resolution) + 1
+    quads = np.stack((grid[:-1,:-1],grid[1:,:-1],grid[1:,1:],grid[:-1,1:]),axis=-1).reshape(-1,4)
+    lines.extend('f {0}/{0}/{0} {1}/{1}/{1} {2}/{2}/{2} {3}/{3}/{3}\n'.format(*quad) for quad in quads)
+    return ''.join(lines)
+
+# Writes the synthetic inputs to data_dir and returns the benchmarks as a list
+# of (name, function, frames per call), where merge_scenenet_obj counts the
+# objects merged as frames
+def benchmarks(data_dir):
+    depth, instance = synthetic_frame()
+    instance_path = os.path.join(data_dir,'instance.png')
+    Image.fromarray(instance).save(instance_path)
+    protobuf_path = os.path.join(data_dir,'benchmark.pb')
+    with open(protobuf_path,'wb') as f:
+        f.write(synthetic_trajectories().SerializeToString())
+    traj = IndexedTrajectories(protobuf_path)[0]
+    log_lines = synthetic_render_log(traj)
+    shapenet_dir = os.path.join(data_dir,'shapenet')
+    obj_dir = os.path.join(shapenet_dir,SHAPENET_HASH,'models')
+    os.makedirs(obj_dir)
+    with open(os.path.join(obj_dir,'model_normalized.obj'),'w') as f:
+        f.write(synthetic_obj())
+
+    depth_m = depth * 0.001
+    depth_m[depth == 0] = 50.0
+    points_in_camera = points_in_camera_coords(depth_m,normalised_pixel_to_ray_array(WIDTH,HEIGHT))
+    view = traj.views[0]
+    camera = np.array([[[p.camera.x,p.camera.y,p.camera.z],[p.lookat.x,p.lookat.y,p.lookat.z]]
+                       for p in (view.shutter_open,view.shutter_close)])
+    _, camera_to_world = extrinsics_from_shutter_poses(camera[:,0],camera[:,1])
+    world_points = depth_to_world_points(depth_m,camera_to_world).reshape(-1,3)
+    world_points = np.hstack((world_points,np.ones((len(world_points),1))))
+    flow = optical_flow(world_points,view.shutter_open,view.shutter_close).reshape(HEIGHT,WIDTH,2)
+    instance_class_map = {instance.instance_id:NYU_WNID_TO_CLASS[instance.semantic_wordnet_id]
+                          for instance in traj.instances if instance.instance_type != sn.Instance.BACKGROUND}
+    class_path = os.path.join(data_dir,'class.png')
+    class_colour_path = os.path.join(data_dir,'class_colour.png')
+    random_objects = [instance for instance in traj.instances if instance.instance_type == sn.Instance.RANDOM_OBJECT]
+
+    def pixel_to_ray_array():
+        # Without the memoized grid, which is what every new process pays
+        geometry._cached_ray_array.cache_clear()
+        normalised_pixel_to_ray_array(WIDTH,HEIGHT)
+
+    def merge_objs(cached):
+        if not cached:
+            obj_mesh._load_obj_mesh.cache_clear()
+        offsets = [0,0,0]
+        output = io.StringIO()
+        for k,instance in enumerate(random_objects):
+            offsets = merge_scenenet_obj(output,shapenet_dir,instance,k,offsets)
+
+    return [
+        ('surface_normal',lambda: surface_normal(points_in_camera),1),
+        ('normalised_pixel_to_ray_array',pixel_to_ray_array,1),
+        ('optical_flow',lambda: optical_flow(world_points,view.shutter_open,view.shutter_close),1),
+        ('flow_to_hsv_image',lambda: flow_to_hsv_image(flow),1),
+        ('save_class_from_instance',lambda: save_class_from_instance(instance_path,class_path,class_colour_path,
+                                                                     instance_class_map),1),
+        ('merge_scenenet_obj',lambda: merge_objs(False),len(random_objects)),
+        ('merge_scenenet_obj_cached',lambda: merge_objs(True),len(random_objects)),
+        ('parse_log_to_frame_pose_pairs',lambda: parse_log_to_frame_pose_pairs(log_lines,FRAME_SKIP),NUM_VIEWS),
+    ]
+
+# Returns {latency_ms, min_latency_ms, frames_per_s, peak_mib, frames}
+def run_benchmark(function,frames,repeat):
+    function()
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - start)
+    # Traced separately, as tracing slows down every allocation
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    latency = float(np.median(latencies))
+    return {'latency_ms':latency * 1000.0,'min_latency_ms':min(latencies) * 1000.0,
+            'frames_per_s':frames / max(latency,1e-12),'peak_mib':peak / float(1 << 20),'frames':frames}
+
+def environment():
+    return {'python':platform.python_version(),'numpy':np.__version__,'machine':platform.machine(),
+            'processor':platform.processor(),'platform':platform.platform(),'cpu_count':os.cpu_count()}
+
+def settings(repeat):
+    return {'repeat':repeat,'width':WIDTH,'height':HEIGHT,'num_views':NUM_VIEWS,'frame_skip':FRAME_SKIP,
+            'obj_resolution':OBJ_RESOLUTION}
+
+# Returns {name:latency / baseline latency} for the benchmarks in both
+def compare_to_baseline(results,baseline):
+    return {name:result['latency_ms'] / baseline['results'][name]['latency_ms']
+            for name,result in results.items() if name in baseline['results']}
+
+def print_results(results,ratios=None,tolerance=0.2):
+    print('{0:<32}{1:>12}{2:>12}{3:>12}{4:>16}'.format('function','latency ms','frames/s','peak MiB',
+                                                       'vs baseline' if ratios is not None else ''))
+    for name,result in results.items():
+        comparison = ''
+        if ratios is not None and name in ratios:
+            comparison = '{0:.2f}x'.format(ratios[name])
+            if ratios[name] > 1.0 + tolerance:
+                comparison += ' slower'
+            elif ratios[name] < 1.0 / (1.0 + tolerance):
+                comparison += ' faster'
+        print('{0:<32}{1:>12.3f}{2:>12.1f}{3:>12.2f}{4:>16}'.format(name,result['latency_ms'],result['frames_per_s'],
+                                                                    result['peak_mib'],comparison))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the geometry and labelling hot paths on synthetic data')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timed calls of each function')
+    parser.add_argument('--only', nargs='+', help='The benchmarks to run, all of them if not given')
+    parser.add_argument('--save', help='Write the results to this json file, e.g. to use as a baseline')
+    parser.add_argument('--baseline', nargs='?', const=BASELINE_PATH,
+                        help='Compare the latencies with those of a json file written by --save, '
+                             'benchmark_baseline.json if no path is given')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Fraction by which a latency may exceed the baseline before it is a regression')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline,'r') as f:
+            baseline = json.load(f)
+    data_dir = tempfile.mkdtemp(prefix='scenenet_benchmark_')
+    try:
+        results = {}
+        for name,function,frames in benchmarks(data_dir):
+            if args.only and name not in args.only:
+                continue
+            results[name] = run_benchmark(function,frames,args.repeat)
+    finally:
+        shutil.rmtree(data_dir)
+    ratios = compare_to_baseline(results,baseline) if baseline is not None else None
+    print_results(results,ratios,args.tolerance)
+    if args.save is not None:
+        with open(args.save,'w') as f:
+            json.dump({'environment':environment(),'settings':settings(args.repeat),'results':results},
+                      f,indent=2,sort_keys=True)
+        print('Wrote results to:{0}'.format(args.save))
+    if ratios is not None:
+        if baseline.get('environment') != environment():
+            print('Baseline was measured in a different environment:{0}'.format(baseline.get('environment')))
+        if baseline.get('settings') != settings(args.repeat):
+            print('Baseline was measured with different settings:{0}'.format(baseline.get('settings')))
+        regressions = sorted(name for name,ratio in ratios.items() if ratio > 1.0 + args.tolerance)
+        if regressions:
+            print('Slower than the baseline:{0}'.format(' '.join(regressions)))
+            sys.exit(1)
@@ -1,35 +1,33 @@
+import argparse
+from frame_store import ViewRef, depth_from_view, instance_from_view
+from geometry import depth_to_world_points, interpolate_pose_arrays, normalised_pixel_to_ray_array, normalize_rows
 from PIL import Image
 import math
-import matplotlib
 import numpy as np
 import os
 import pathlib
+from pose_table import cached_pose_table
+import profiling
 import random
 import scenenet_pb2 as sn
 import sys
-import scipy.misc
+import time
+from trajectory_index import IndexedTrajectories
+from trajectory_pool import print_progress, run_trajectory_pool
+
+FLO_MAGIC = 202021.25
 
 def normalize(v):
     return v/np.linalg.norm(v)
 
+@profiling.profiled(frames=1)
 def load_depth_map_in_m(file_name):
+    profiling.count_file_read(file_name)
     image = Image.open(file_name)
     pixel = np.array(image)
     return (pixel * 0.001)
 
-def pixel_to_ray(pixel,vfov=45,hfov=60,pixel_width=320,pixel_height=240):
-    x, y = pixel
-    x_vect = math.tan(math.radians(hfov/2.0)) * ((2.0 * ((x+0.5)/pixel_width)) - 1.0)
-    y_vect = math.tan(math.radians(vfov/2.0)) * ((2.0 * ((y+0.5)/pixel_height)) - 1.0)
-    return (x_vect,y_vect,1.0)
-
-def normalised_pixel_to_ray_array(width=320,height=240):
-    pixel_to_ray_array = np.zeros((height,width,3))
-    for y in range(height):
-        for x in range(width):
-            pixel_to_ray_array[y,x] = normalize(np.array(pixel_to_ray((x,y),pixel_height=height,pixel_width=width)))
-    return pixel_to_ray_array
-
+@profiling.profiled(frames=1)
 def points_in_camera_coords(depth_map,pixel_to_ray_array):
     assert depth_map.shape[0] == pixel_to_ray_array.shape[0]
     assert depth_map.shape[1] == pixel_to_ray_array.shape[1]
@@ -47,6 +45,7 @@ def reshape_points(height,width,points):
     other_dim = points.shape[1]
     return points.reshape(height,width,other_dim)
 
+@profiling.profiled(frames=1)
 def transform_points(transform,points):
     assert points.shape[2] == 4
     height = points.shape[0]
@@ -110,6 +109,7 @@ def world_point_to_uv_pixel_location_with_interpolated_camera(point,shutter_open
 # Returns:
 # a nx2 array of the horizontal and vertical pixel location time derivatives (i.e. pixels per second in the horizontal and vertical)
 # NOTE: the pixel coordinates are defined as (0,0) in the top left corner, to (320,240) in the bottom left
+@profiling.profiled(frames=1)
 def optical_flow(points,shutter_open,shutter_close,alpha=0.5,shutter_time=(1.0/60),
                  hfov=60,pixel_width=320,vfov=45,pixel_height=240):
     # Alpha is the linear interpolation coefficient, 0.5 takes the derivative in the midpoint
@@ -184,27 +184,391 @@ def optical_flow(points,shutter_open,shutter_close,alpha=0.5,shutter_time=(1.0/6
     dv_dt = dv_dalpha / shutter_time
     return np.vstack((du_dt,dv_dt)).T
 
+# Expects an (...,H,W,2) array of optical flow vectors, i.e. a single flow
+# image or a stack of them, and returns the matching (...,H,W,3) hsv image with
+# the flow direction as the hue and the scaled magnitude as the value
 def flow_to_hsv_image(flow, magnitude_scale=1.0/100.0):
-    hsv = np.empty((240,320,3))
-    for row in range(240):
-        for col in range(320):
-            v = flow[row,col,:]
-            magnitude = np.linalg.norm(v)
-            if magnitude < 1e-8:
-                hsv[row,col,0] = 0.0
-                hsv[row,col,1] = 0.0
-                hsv[row,col,2] = 0.0
-            else:
-                direction = v / magnitude
-                theta = math.atan2(direction[1], direction[0])
-                if theta <= 0:
-                    theta += 2*math.pi
-                assert(theta >= 0.0 and theta <= 2*math.pi)
-                hsv[row,col,0] = theta / (2*math.pi)
-                hsv[row,col,1] = 1.0
-                hsv[row,col,2] = min(magnitude * magnitude_scale, 1.0)
+    magnitude = np.linalg.norm(flow,axis=-1)
+    moving = magnitude >= 1e-8
+    with np.errstate(invalid='ignore',divide='ignore'):
+        direction = flow / magnitude[...,np.newaxis]
+    theta = np.arctan2(direction[...,1],direction[...,0])
+    theta[theta <= 0] += 2*math.pi
+    hsv = np.zeros(flow.shape[:-1] + (3,))
+    hsv[...,0] = np.where(moving,theta / (2*math.pi),0.0)
+    hsv[...,1] = moving
+    hsv[...,2] = np.where(moving,np.minimum(magnitude * magnitude_scale,1.0),0.0)
     return hsv
 
+# The same colour wheel as matplotlib.colors.hsv_to_rgb, returning float rgb
+def hsv_to_rgb(hsv):
+    h, s, v = hsv[...,0], hsv[...,1], hsv[...,2]
+    sector = (h * 6.0).astype(np.int64)
+    f = (h * 6.0) - sector
+    sector = sector % 6
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    t = v * (1.0 - s * (1.0 - f))
+    # For each of the six hue sectors, the source of the r, g and b channels
+    choices = ((v,q,p,p,t,v),(t,v,v,q,p,p),(p,p,t,v,v,q))
+    return np.stack([np.choose(sector,choices[channel]) for channel in range(3)],axis=-1)
+
+# The flow colour image written directly as uint8 rgb, into out if it is given,
+# which must be a uint8 array of shape flow.shape[:-1] + (3,).  With
+# rescale=True each (H,W,3) image is stretched to the full 0-255 range, as
+# scipy.misc.imsave did when the script saved the float rgb image, so the
+# pngs match those of the original per-pixel script.
+def flow_to_rgb_image(flow, magnitude_scale=1.0/100.0, out=None, rescale=False):
+    rgb = hsv_to_rgb(flow_to_hsv_image(flow,magnitude_scale))
+    if out is None:
+        out = np.empty(flow.shape[:-1] + (3,),dtype=np.uint8)
+    assert out.shape == flow.shape[:-1] + (3,)
+    assert out.dtype == np.uint8
+    if rescale:
+        low = rgb.min(axis=(-3,-2,-1),keepdims=True)
+        value_range = rgb.max(axis=(-3,-2,-1),keepdims=True) - low
+        value_range[value_range == 0] = 1
+        out[...] = np.clip((rgb - low) * (255.0 / value_range),0,255) + 0.5
+    else:
+        out[...] = rgb * 255.0 + 0.5
+    return out
+
+# Batched version of the pose derivative in optical_flow.  Takes (N,2,3)
+# shutter open/close camera and lookat positions (the pose table layout) and
+# returns the (N,4,4) world to camera transforms and their alpha derivatives
+# for every view at once, so they can be computed once per trajectory.
+def camera_flow_derivatives(camera,lookat,alpha=0.5):
+    camera = np.asarray(camera,dtype=np.float64)
+    lookat = np.asarray(lookat,dtype=np.float64)
+    camera_start, camera_end = camera[...,0,:], camera[...,1,:]
+    lookat_start, lookat_end = lookat[...,0,:], lookat[...,1,:]
+    camera_pose = interpolate_pose_arrays(camera_start,camera_end,alpha)
+    lookat_pose = interpolate_pose_arrays(lookat_start,lookat_end,alpha)
+
+    def dot(a,b):
+        return np.sum(a * b,axis=-1,keepdims=True)
+
+    # Basis vectors, as in optical_flow
+    ub1 = lookat_pose - camera_pose
+    b1 = normalize_rows(ub1)
+    ub2 = np.cross(b1,np.array([0,1,0]))
+    b2 = normalize_rows(ub2)
+    ub3 = np.cross(b2,b1)
+    b3 = -normalize_rows(ub3)
+
+    # Basis vector derivatives, (I - b b^T) x / |ub| without forming the matrices
+    dc_dalpha = camera_end - camera_start
+    dub1_dalpha = lookat_end - lookat_start - camera_end + camera_start
+    db1_dalpha = (dub1_dalpha - b1 * dot(b1,dub1_dalpha)) / np.linalg.norm(ub1,axis=-1,keepdims=True)
+    dub2_dalpha = np.stack((-db1_dalpha[...,2],np.zeros(db1_dalpha.shape[:-1]),db1_dalpha[...,0]),axis=-1)
+    db2_dalpha = (dub2_dalpha - b2 * dot(b2,dub2_dalpha)) / np.linalg.norm(ub2,axis=-1,keepdims=True)
+    dub3_dalpha = np.stack((
+            -(db2_dalpha[...,2]*b1[...,1] + db1_dalpha[...,1]*b2[...,2]),
+            -(db2_dalpha[...,0]*b1[...,2] + db1_dalpha[...,2]*b2[...,0]) + (db2_dalpha[...,2]*b1[...,0] + db1_dalpha[...,0]*b2[...,2]),
+            (db1_dalpha[...,1]*b2[...,0] + db2_dalpha[...,0]*b1[...,1]),
+        ),axis=-1)
+    db3_dalpha = -(dub3_dalpha - b3 * dot(b3,dub3_dalpha)) / np.linalg.norm(ub3,axis=-1,keepdims=True)
+
+    wTc = np.zeros(camera_pose.shape[:-1] + (4,4))
+    wTc[...,0,:3] = b2
+    wTc[...,1,:3] = b3
+    wTc[...,2,:3] = b1
+    wTc[...,:3,3] = -np.einsum('...ij,...j->...i',wTc[...,:3,:3],camera_pose)
+    wTc[...,3,3] = 1.0
+
+    dT_dalpha = np.zeros(camera_pose.shape[:-1] + (4,4))
+    dT_dalpha[...,0,:3] = db2_dalpha
+    dT_dalpha[...,1,:3] = db3_dalpha
+    dT_dalpha[...,2,:3] = db1_dalpha
+    dT_dalpha[...,0,3] = -dot(db2_dalpha,camera_pose)[...,0] - dot(dc_dalpha,b2)[...,0]
+    dT_dalpha[...,1,3] = -dot(db3_dalpha,camera_pose)[...,0] - dot(dc_dalpha,b3)[...,0]
+    dT_dalpha[...,2,3] = -dot(db1_dalpha,camera_pose)[...,0] - dot(dc_dalpha,b1)[...,0]
+    return wTc, dT_dalpha
+
+# Batched version of optical_flow over an (N,H,W) stack of depth maps (in
+# metres) with the (N,2,3) shutter camera and lookat positions of each view.
+# Returns float32 (N,H,W,2) pixel velocities (pixels per second).  Pixels with
+# zero depth are placed far_depth away, as in the single frame script.
+#
+# The camera space points are depth * ray, so with p_world = R^T p_cam + c the
+# point derivative dT p_world is depth * (dR R^T ray) + (dR c + dt), i.e. one
+# (3,3) matrix and offset per view applied to the shared rays.  derivatives
+# can be the precomputed (wTc, dT_dalpha) of the views.
+def optical_flow_batch(depth,camera,lookat,alpha=0.5,shutter_time=(1.0/60),hfov=60,vfov=45,
+                       far_depth=1000.0,dtype=np.float32,out=None,derivatives=None):
+    depth = np.asarray(depth)
+    if depth.ndim == 2:
+        depth = depth[np.newaxis]
+    num_frames, height, width = depth.shape
+    if derivatives is None:
+        derivatives = camera_flow_derivatives(np.reshape(camera,(-1,2,3)),np.reshape(lookat,(-1,2,3)),alpha)
+    wTc, dT_dalpha = derivatives
+    rays = normalised_pixel_to_ray_array(width=width,height=height,hfov=hfov,vfov=vfov,dtype=dtype)
+
+    R = wTc[:,:3,:3]
+    camera_pose = -np.einsum('nji,nj->ni',R,wTc[:,:3,3])
+    dR = dT_dalpha[:,:3,:3]
+    M = np.einsum('nij,nkj->nik',dR,R).astype(dtype)
+    m = (np.einsum('nij,nj->ni',dR,camera_pose) + dT_dalpha[:,:3,3]).astype(dtype)
+
+    d = depth.astype(dtype)
+    if far_depth is not None:
+        d[d == 0] = far_depth
+    # dp = d * (M ray) + m and p = d * ray, per view
+    with profiling.stage('point_derivatives',frames=num_frames):
+        dray = np.matmul(rays.reshape(1,-1,3),np.swapaxes(M,-1,-2)).reshape(num_frames,height,width,3)
+        dp = dray * d[...,np.newaxis]
+        dp += m[:,np.newaxis,np.newaxis,:]
+        z = d * rays[...,2]
+
+    uk = (width/2.0) * (1.0/math.tan(math.radians(hfov/2.0)))
+    vk = (height/2.0) * (1.0/math.tan(math.radians(vfov/2.0)))
+    x_over_z = rays[...,0] / rays[...,2]
+    y_over_z = rays[...,1] / rays[...,2]
+    if out is None:
+        out = np.empty((num_frames,height,width,2),dtype=dtype)
+    scale = 1.0 / (z * shutter_time)
+    out[...,0] = uk * (dp[...,0] - dp[...,2] * x_over_z) * scale
+    out[...,1] = vk * (dp[...,1] - dp[...,2] * y_over_z) * scale
+    return out
+
+# Returns an (max_instance_id+1,4,4) table of the object to world transforms of
+# the random objects in a trajectory (from object_info.object_pose), identity
+# for every other instance id
+def object_transform_table(traj):
+    max_instance_id = max([instance.instance_id for instance in traj.instances] + [0])
+    transforms = np.tile(np.eye(4),(max_instance_id + 1,1,1))
+    for instance in traj.instances:
+        if instance.instance_type == sn.Instance.RANDOM_OBJECT:
+            i = instance.object_info.object_pose
+            transforms[instance.instance_id,:3,:] = [
+                [i.rotation_mat11,i.rotation_mat12,i.rotation_mat13,i.translation_x],
+                [i.rotation_mat21,i.rotation_mat22,i.rotation_mat23,i.translation_y],
+                [i.rotation_mat31,i.rotation_mat32,i.rotation_mat33,i.translation_z],
+            ]
+    return transforms
+
+def rigid_inverse(transforms):
+    inverse = np.zeros_like(transforms)
+    inverse[...,:3,:3] = np.swapaxes(transforms[...,:3,:3],-1,-2)
+    inverse[...,:3,3] = -np.einsum('...ji,...j->...i',transforms[...,:3,:3],transforms[...,:3,3])
+    inverse[...,3,3] = 1.0
+    return inverse
+
+# Projects (...,3) camera space points to continuous pixel coordinates, as in
+# camera_point_to_uv_pixel_location (pixel centres are at +0.5)
+def camera_points_to_uv(points,width,height,hfov=60,vfov=45):
+    z = points[...,2]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        u = (width/2.0) * (points[...,0] / z / math.tan(math.radians(hfov/2.0)) + 1)
+        v = (height/2.0) * (points[...,1] / z / math.tan(math.radians(vfov/2.0)) + 1)
+    return np.stack((u,v),axis=-1)
+
+# Reprojects each pixel of the source views into the target views, returning
+# the float32 (N,H,W,2) flow in pixels, the out of frame mask and the distance
+# of each moved point from the target camera.  motions, if given, is an
+# (N,K,4,4) table of the world space motion of each instance id from the source
+# to the target view, applied to the pixels of that instance.
+def reprojection_flow(depth,camera_to_world,world_to_camera,instance=None,motions=None,
+                      hfov=60,vfov=45,far_depth=1000.0):
+    num_frames, height, width = depth.shape
+    d = depth.astype(np.float64)
+    if far_depth is not None:
+        d[d == 0] = far_depth
+    points = depth_to_world_points(d,camera_to_world,
+                                   rays=normalised_pixel_to_ray_array(width,height,hfov,vfov))
+    if motions is not None and instance is not None:
+        # Only the pixels of instances that actually move are transformed,
+        # gathering the motion of each from its frame and instance id
+        moving = ~np.all(np.isclose(motions,np.eye(4)),axis=(2,3))
+        instance_ids = np.asarray(instance,dtype=np.int64)
+        known = instance_ids < motions.shape[1]
+        frame_idx = np.broadcast_to(np.arange(num_frames)[:,np.newaxis,np.newaxis],instance_ids.shape)
+        frames, rows, cols = np.nonzero(known & moving[frame_idx,np.where(known,instance_ids,0)])
+        pixel_motions = motions[frames,instance_ids[frames,rows,cols]]
+        points[frames,rows,cols] = (np.einsum('pij,pj->pi',pixel_motions[:,:3,:3],points[frames,rows,cols]) +
+                                    pixel_motions[:,:3,3])
+    target_points = np.matmul(points.reshape(num_frames,-1,3),np.swapaxes(world_to_camera[:,:3,:3],-1,-2))
+    target_points += world_to_camera[:,np.newaxis,:3,3]
+    target_points = target_points.reshape(num_frames,height,width,3)
+    uv = camera_points_to_uv(target_points,width,height,hfov,vfov)
+    pixel_uv = np.stack(np.meshgrid(np.arange(width) + 0.5,np.arange(height) + 0.5),axis=-1)
+    flow = (uv - pixel_uv).astype(np.float32)
+    out_of_frame = ((target_points[...,2] <= 0) | ~np.all(np.isfinite(uv),axis=-1) |
+                    (uv[...,0] < 0) | (uv[...,0] >= width) | (uv[...,1] < 0) | (uv[...,1] >= height))
+    return flow, out_of_frame, np.linalg.norm(target_points,axis=-1)
+
+# Samples (N,H,W,...) images at the nearest pixel of (N,H,W,2) pixel
+# coordinates, which must be in frame
+def sample_nearest(images,uv):
+    num_frames, height, width = uv.shape[:3]
+    u = np.clip(np.floor(uv[...,0]).astype(np.int64),0,width - 1)
+    v = np.clip(np.floor(uv[...,1]).astype(np.int64),0,height - 1)
+    frame = np.arange(num_frames)[:,np.newaxis,np.newaxis]
+    return images[frame,v,u]
+
+# Flow between consecutive views (frame N and the next rendered frame, N+25)
+# of an (N,H,W) depth stack in metres, with instance ids and the (N,4,4) camera
+# to world transforms.  object_transforms is either one (K,4,4) table for the
+# whole trajectory (see object_transform_table; SceneNet objects are static,
+# so the instance motion is then the identity) or an (N,K,4,4) table per view,
+# in which case pixels of instance k move with T_next[k] T[k]^-1.
+#
+# Returns a dict of, for each of the N-1 pairs,
+#   forward_flow   float32 (N-1,H,W,2) pixels from frame i to frame i+1
+#   backward_flow  float32 (N-1,H,W,2) pixels from frame i+1 to frame i
+#   out_of_frame   bool (N-1,H,W) the pixel of frame i leaves the image
+#   occluded       bool (N-1,H,W) the pixel of frame i is hidden in frame i+1,
+#                  either behind the depth of frame i+1, failing the
+#                  forward-backward consistency check or, given instance
+#                  ids, landing on a pixel of a different instance
+def forward_backward_flow(depth,camera_to_world,instance=None,object_transforms=None,hfov=60,vfov=45,
+                          far_depth=1000.0,depth_tolerance=0.05,consistency_tolerance=0.5):
+    depth = np.asarray(depth)
+    camera_to_world = np.asarray(camera_to_world)
+    world_to_camera = rigid_inverse(camera_to_world)
+    forward_motions = backward_motions = None
+    if object_transforms is not None and instance is not None:
+        if np.ndim(object_transforms) == 3:
+            object_transforms = np.broadcast_to(object_transforms,(len(depth),) + np.shape(object_transforms))
+        forward_motions = np.matmul(object_transforms[1:],rigid_inverse(object_transforms[:-1]))
+        backward_motions = rigid_inverse(forward_motions)
+    instance_a = instance[:-1] if instance is not None else None
+    instance_b = instance[1:] if instance is not None else None
+    forward, out_of_frame, forward_distance = reprojection_flow(
+        depth[:-1],camera_to_world[:-1],world_to_camera[1:],instance_a,forward_motions,hfov,vfov,far_depth)
+    backward, _, _ = reprojection_flow(
+        depth[1:],camera_to_world[1:],world_to_camera[:-1],instance_b,backward_motions,hfov,vfov,far_depth)
+
+    num_pairs, height, width = out_of_frame.shape
+    pixel_uv = np.stack(np.meshgrid(np.arange(width) + 0.5,np.arange(height) + 0.5),axis=-1)
+    target_uv = pixel_uv + forward
+    target_depth = depth[1:].astype(np.float64)
+    if far_depth is not None:
+        target_depth[target_depth == 0] = far_depth
+    # Hidden behind the surface seen in the next frame
+    behind = forward_distance > sample_nearest(target_depth,target_uv) + depth_tolerance
+    # The backward flow at the target should bring the pixel back
+    target_backward = sample_nearest(backward,target_uv)
+    round_trip = forward + target_backward
+    squared_error = np.sum(round_trip * round_trip,axis=-1)
+    bound = 0.01 * (np.sum(forward * forward,axis=-1) + np.sum(target_backward * target_backward,axis=-1))
+    bound += consistency_tolerance
+    inconsistent = squared_error > bound
+    occluded = behind | inconsistent
+    if instance is not None:
+        occluded |= sample_nearest(np.asarray(instance[1:]),target_uv) != instance[:-1]
+    occluded &= ~out_of_frame
+    return {'forward_flow':forward,'backward_flow':backward,'out_of_frame':out_of_frame,'occluded':occluded}
+
+# Writes a single (H,W,2) flow in the Middlebury .flo format
+def write_flo(path,flow):
+    height, width = flow.shape[:2]
+    with open(path,'wb') as f:
+        np.array([FLO_MAGIC],dtype='<f4').tofile(f)
+        np.array([width,height],dtype='<i4').tofile(f)
+        np.asarray(flow,dtype='<f4').tofile(f)
+
+def read_flo(path):
+    with open(path,'rb') as f:
+        magic = np.fromfile(f,dtype='<f4',count=1)
+        assert magic[0] == FLO_MAGIC
+        width, height = np.fromfile(f,dtype='<i4',count=2)
+        return np.fromfile(f,dtype='<f4').reshape(height,width,2)
+
+# Computes the flow of every view of a trajectory chunk_size frames at a time,
+# streaming it to output_dir as
+#   npy  optical_flow.npy, float32 (N,H,W,2) pixels per second
+#   flo  <frame_num>.flo per view, the displacement in pixels over the
+#        shutter_time (the flow in pixels per second times shutter_time), as
+#        .flo files hold displacements rather than rates
+#   png  optical_flow_<view index>.png colour images, rescaled as the
+#        original script saved them (see flow_to_rgb_image)
+# With forward_backward=True the forward_backward_flow outputs between
+# consecutive views are also written to forward_flow.npy, backward_flow.npy,
+# out_of_frame.npy and occluded.npy, using the instance images and
+# object_transforms (see forward_backward_flow) if load_instance is given.
+# load_depth and load_instance take a frame number and return the raw
+# (millimetre) depth and instance images.  Returns the number of frames.
+def write_trajectory_flow(output_dir,frame_nums,camera,lookat,load_depth,load_instance=None,
+                          object_transforms=None,flow_format='npy',chunk_size=32,forward_backward=False,
+                          shutter_time=(1.0/60)):
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    num_frames = len(frame_nums)
+    # The pose derivatives of every view in one pass
+    derivatives = camera_flow_derivatives(camera,lookat)
+    camera_to_world = rigid_inverse(derivatives[0])
+    outputs = {}
+    previous = None
+    for start in range(0,num_frames,chunk_size):
+        end = min(start + chunk_size,num_frames)
+        with profiling.stage('load_depth_map_in_m',frames=end - start):
+            depth = np.stack([load_depth(frame_num) for frame_num in frame_nums[start:end]]) * 0.001
+        if not outputs:
+            height, width = depth.shape[1:]
+            if flow_format == 'npy':
+                outputs['optical_flow'] = np.lib.format.open_memmap(
+                    os.path.join(output_dir,'optical_flow.npy'),mode='w+',dtype=np.float32,
+                    shape=(num_frames,height,width,2))
+            if forward_backward:
+                pair_shape = (max(num_frames - 1,0),height,width)
+                for name, dtype, shape in (('forward_flow',np.float32,pair_shape + (2,)),
+                                           ('backward_flow',np.float32,pair_shape + (2,)),
+                                           ('out_of_frame',np.bool_,pair_shape),
+                                           ('occluded',np.bool_,pair_shape)):
+                    outputs[name] = np.lib.format.open_memmap(os.path.join(output_dir,name + '.npy'),
+                                                              mode='w+',dtype=dtype,shape=shape)
+        with profiling.stage('optical_flow',frames=end - start):
+            # The pngs are coloured from float64 flow, as in the original script
+            flow = optical_flow_batch(depth,None,None,shutter_time=shutter_time,
+                                      dtype=np.float64 if flow_format == 'png' else np.float32,
+                                      derivatives=(derivatives[0][start:end],derivatives[1][start:end]),
+                                      out=outputs['optical_flow'][start:end] if flow_format == 'npy' else None)
+        if flow_format == 'flo':
+            for frame_num, frame_flow in zip(frame_nums[start:end],flow):
+                flo_path = os.path.join(output_dir,'{0}.flo'.format(frame_num))
+                with profiling.stage('encode',frames=1):
+                    write_flo(flo_path,frame_flow * shutter_time)
+                    profiling.count_file_written(flo_path)
+        elif flow_format == 'png':
+            for idx, frame_flow in enumerate(flow,start):
+                with profiling.stage('flow_to_rgb_image',frames=1):
+                    image = Image.fromarray(flow_to_rgb_image(frame_flow,rescale=True))
+                png_path = os.path.join(output_dir,'optical_flow_{0}.png'.format(idx))
+                with profiling.stage('encode',frames=1):
+                    image.save(png_path)
+                    profiling.count_file_written(png_path)
+
+        if forward_backward:
+            instance = transforms = None
+            # The first pair of a chunk starts at the last frame of the previous one
+            pair_start = start if previous is None else start - 1
+            if load_instance is not None:
+                with profiling.stage('load_instance',frames=end - start):
+                    instance = np.stack([load_instance(frame_num) for frame_num in frame_nums[start:end]])
+                transforms = object_transforms
+                if transforms is not None and np.ndim(transforms) == 4:
+                    transforms = transforms[pair_start:end]
+            chunk_camera_to_world = camera_to_world[pair_start:end]
+            if previous is not None:
+                depth = np.concatenate((previous[0],depth))
+                if instance is not None:
+                    instance = np.concatenate((previous[1],instance))
+            if len(depth) > 1:
+                with profiling.stage('forward_backward_flow',frames=len(depth) - 1):
+                    pairs = forward_backward_flow(depth,chunk_camera_to_world,instance,transforms)
+                for name, values in pairs.items():
+                    outputs[name][pair_start:pair_start + len(values)] = values
+            previous = (depth[-1:],instance[-1:] if instance is not None else None)
+    # The npy outputs are written by flushing their memory maps
+    if outputs:
+        with profiling.stage('encode') as stage:
+            for output in outputs.values():
+                output.flush()
+                stage.add(bytes_written=output.nbytes)
+    return num_frames
+
 data_root_path = 'data/val'
 protobuf_path = 'data/scenenet_rgbd_val.pb'
 
@@ -213,43 +577,103 @@ def depth_path_from_view(render_path,view):
     depth_path = os.path.join(photo_path,'{0}.png'.format(view.frame_num))
     return os.path.join(data_root_path,depth_path)
 
+# Each worker process memory maps the cached pose table, and with instances
+# decodes the trajectories it needs the object poses of
+worker_poses = None
+worker_trajectories = None
+
+def init_worker(pb_path,instances=False):
+    global worker_poses, worker_trajectories
+    worker_poses = cached_pose_table(pb_path)
+    if instances:
+        worker_trajectories = IndexedTrajectories(pb_path)
+
+def write_flow_for_trajectory(traj_idx,root_path,output_dir,options):
+    poses = worker_poses
+    render_path = str(poses['render_path'][traj_idx])
+    num_views = int(poses['num_views'][traj_idx])
+    backend = options['backend']
+    def load_depth(frame_num):
+        return depth_from_view(render_path,ViewRef(frame_num),root_path,backend=backend)
+    if output_dir is None:
+        trajectory_output_dir = '.'
+    else:
+        trajectory_output_dir = os.path.join(output_dir,render_path)
+    load_instance = object_transforms = None
+    if options['instances']:
+        def load_instance(frame_num):
+            return instance_from_view(render_path,ViewRef(frame_num),root_path,backend=backend)
+        # SceneNet objects have a single pose per trajectory, so the table is
+        # the same for every view
+        object_transforms = object_transform_table(worker_trajectories[traj_idx])
+    return write_trajectory_flow(
+        trajectory_output_dir,[int(f) for f in poses['frame_num'][traj_idx,:num_views]],
+        poses['camera'][traj_idx,:num_views],poses['lookat'][traj_idx,:num_views],
+        load_depth,load_instance,object_transforms,flow_format=options['flow_format'],
+        chunk_size=options['chunk_size'],forward_backward=options['forward_backward'] or options['instances'])
+
 if __name__ == '__main__':
-    trajectories = sn.Trajectories()
+    parser = argparse.ArgumentParser(description='Computes the optical flow of trajectories from their depth and camera poses')
+    parser.add_argument('--protobuf-path', default=protobuf_path)
+    parser.add_argument('--data-root-path', default=data_root_path)
+    parser.add_argument('--render-path', help='The trajectory to process, a random one if not given')
+    parser.add_argument('--all', action='store_true', help='Process every trajectory of the protobuf')
+    parser.add_argument('--output-dir', help='Flow is written to OUTPUT_DIR/render_path, or the current '
+                                             'directory for a single trajectory if not given')
+    parser.add_argument('--format', default='png', choices=['png','npy','flo'],
+                        help='png colour images (scaled as the original script), an npy stack per trajectory '
+                             'in pixels per second, or a .flo file per frame of the displacement in pixels '
+                             'over the 1/60s shutter time')
+    parser.add_argument('--forward-backward', action='store_true',
+                        help='Also write the forward/backward flow between views with out of frame and occlusion masks')
+    parser.add_argument('--instances', action='store_true',
+                        help='Implies --forward-backward, moving the pixels of each instance with its object pose '
+                             'and marking pixels that land on a different instance as occluded')
+    parser.add_argument('--backend', default='files', help='files or packed, see frame_store.py')
+    parser.add_argument('--chunk-size', type=int, default=32, help='Number of frames processed at once')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes, the work is split by trajectory')
+    parser.add_argument('--profile', nargs='?', const=profiling.DEFAULT_TRACE_PATH, metavar='TRACE_PATH',
+                        help='Print the time of each stage at exit and write them as a Chrome trace, see profiling.py')
+    args = parser.parse_args()
+    if args.profile:
+        profiling.enable(args.profile)
+
     try:
-        with open(protobuf_path,'rb') as f:
-            trajectories.ParseFromString(f.read())
+        init_worker(args.protobuf_path,args.instances)
     except IOError:
-        print('Scenenet protobuf data not found at location:{0}'.format(data_root_path))
+        print('Scenenet protobuf data not found at location:{0}'.format(args.protobuf_path))
         print('Please ensure you have copied the pb file to the data directory')
-
-    traj = random.choice(trajectories.trajectories)
-    # This stores for each image pixel, the cameras 3D ray vector 
-    cached_pixel_to_ray_array = normalised_pixel_to_ray_array()
-    for idx,view in enumerate(traj.views):
-        depth_path = depth_path_from_view(traj.render_path,view)
-        optical_flow_path = 'optical_flow_{0}.png'.format(idx)
-        print('Converting depth image:{0} and camera pose to optical flow image:{1}'.format(depth_path,optical_flow_path))
-        depth_map = load_depth_map_in_m(str(depth_path))
-
-         # When no depth information is available (because a ray went to
-         # infinity outside of a window) depth is set to zero.  For the purpose
-         # of optical flow, here we set it simply to be very far away (1km)
-        depth_map[depth_map == 0.0] = 1000.0
-
-        # This is a 320x240x3 array, with each 'pixel' containing the 3D point in camera coords
-        points_in_camera = points_in_camera_coords(depth_map,cached_pixel_to_ray_array)
-
-        # Transform point from camera coordinates into world coordinates
-        ground_truth_pose = interpolate_poses(view.shutter_open,view.shutter_close,0.5)
-        camera_to_world_matrix = camera_to_world_with_pose(ground_truth_pose)
-        points_in_world = transform_points(camera_to_world_matrix,points_in_camera)
-
-        # Calculate optical flow
-        points_in_world = flatten_points(points_in_world)
-        optical_flow_derivatives = optical_flow(points_in_world,view.shutter_open,view.shutter_close)
-        optical_flow_derivatives = reshape_points(240,320,optical_flow_derivatives)
-
-        # Write out hsv optical flow image.  We use the matplotlib hsv colour wheel
-        hsv = flow_to_hsv_image(optical_flow_derivatives)
-        rgb = matplotlib.colors.hsv_to_rgb(hsv)
-        scipy.misc.imsave(optical_flow_path,rgb)
+        sys.exit(1)
+
+    render_paths = [str(render_path) for render_path in worker_poses['render_path']]
+    if args.all:
+        indices = range(len(render_paths))
+        if args.output_dir is None:
+            args.output_dir = 'optical_flow'
+    elif args.render_path is not None:
+        if args.render_path not in render_paths:
+            print('Render path:{0} is not in:{1}'.format(args.render_path,args.protobuf_path))
+            sys.exit(1)
+        indices = [render_paths.index(args.render_path)]
+    else:
+        indices = [random.randrange(len(render_paths))]
+
+    options = {'backend':args.backend,'forward_backward':args.forward_backward,'instances':args.instances,
+               'flow_format':args.format,'chunk_size':args.chunk_size}
+    tasks = [(traj_idx,args.data_root_path,args.output_dir,options) for traj_idx in indices]
+    results = run_trajectory_pool(write_flow_for_trajectory,tasks,args.workers,
+                                  initializer=init_worker,initargs=(args.protobuf_path,args.instances))
+    start_time = time.time()
+    total_frames = 0
+    failures = []
+    for done, ((traj_idx,_,_,_), num_frames, error) in enumerate(results,1):
+        if error is not None:
+            print('Failed render path:{0} {1}'.format(render_paths[traj_idx],error))
+            failures.append(render_paths[traj_idx])
+            continue
+        total_frames += num_frames
+        print_progress(done,len(tasks),total_frames,start_time,
+                       ('render path',render_paths[traj_idx]),('frames',total_frames))
+    if failures:
+        print('Failed to compute the flow of {0} trajectories'.format(len(failures)))
+        sys.exit(1)
@@ -1,13 +1,10 @@
+from geometry import normalised_pixel_to_ray_array
 from PIL import Image
-import math
-import matplotlib
 import numpy as np
 import os
-import pathlib
 import random
-import scenenet_pb2 as sn
 import sys
-import scipy.misc
+from trajectory_index import IndexedTrajectories
 
 def normalize(v):
     return v/np.linalg.norm(v)
@@ -17,19 +14,6 @@ def load_depth_map_in_m(file_name):
     pixel = np.array(image)
     return (pixel * 0.001)
 
-def pixel_to_ray(pixel,vfov=45,hfov=60,pixel_width=320,pixel_height=240):
-    x, y = pixel
-    x_vect = math.tan(math.radians(hfov/2.0)) * ((2.0 * ((x+0.5)/pixel_width)) - 1.0)
-    y_vect = math.tan(math.radians(vfov/2.0)) * ((2.0 * ((y+0.5)/pixel_height)) - 1.0)
-    return (x_vect,y_vect,1.0)
-
-def normalised_pixel_to_ray_array(width=320,height=240):
-    pixel_to_ray_array = np.zeros((height,width,3))
-    for y in range(height):
-        for x in range(width):
-            pixel_to_ray_array[y,x] = normalize(np.array(pixel_to_ray((x,y),pixel_height=height,pixel_width=width)))
-    return pixel_to_ray_array
-
 def points_in_camera_coords(depth_map,pixel_to_ray_array):
     assert depth_map.shape[0] == pixel_to_ray_array.shape[0]
     assert depth_map.shape[1] == pixel_to_ray_array.shape[1]
@@ -40,43 +24,76 @@ def points_in_camera_coords(depth_map,pixel_to_ray_array):
         camera_relative_xyz[:,:,i] = depth_map * pixel_to_ray_array[:,:,i]
     return camera_relative_xyz
 
-# A very simple and slow function to calculate the surface normals from 3D points from
-# a reprojected depth map. A better method would be to fit a local plane to a set of 
+# These lookups denote y,x offsets from the anchor point for 8 surrounding
+# directions from the anchor A depicted below.
+#  -----------
+# | 7 | 6 | 5 |
+#  -----------
+# | 0 | A | 4 |
+#  -----------
+# | 1 | 2 | 3 |
+#  -----------
+NEIGHBOUR_DISTANCE = 2
+NEIGHBOUR_LOOKUPS = [(-NEIGHBOUR_DISTANCE,0),(-NEIGHBOUR_DISTANCE,NEIGHBOUR_DISTANCE),
+                     (0,NEIGHBOUR_DISTANCE),(NEIGHBOUR_DISTANCE,NEIGHBOUR_DISTANCE),
+                     (NEIGHBOUR_DISTANCE,0),(NEIGHBOUR_DISTANCE,-NEIGHBOUR_DISTANCE),
+                     (0,-NEIGHBOUR_DISTANCE),(-NEIGHBOUR_DISTANCE,-NEIGHBOUR_DISTANCE)]
+
+def shifted_points(points,dy,dx):
+    # Returns the points array shifted so that element [...,i,j,:] holds
+    # points[...,i+dy,j+dx,:], together with a (H,W) mask of which pixels
+    # have a valid neighbour.  This mirrors plain python indexing, negative
+    # indices wrap around to the other side of the image whereas indices past
+    # the end are invalid (they raised an IndexError in the per-pixel version)
+    height = points.shape[-3]
+    width = points.shape[-2]
+    rows = np.arange(height) + dy
+    cols = np.arange(width) + dx
+    valid = (rows < height)[:,None] & (cols < width)[None,:]
+    return points[...,rows[:,None] % height,cols[None,:] % width,:], valid
+
+# A simple function to calculate the surface normals from 3D points from a
+# reprojected depth map. A better method would be to fit a local plane to a set of
 # surrounding points with outlier rejection such as RANSAC.  Such as done here:
 # http://cs.nyu.edu/~silberman/projects/indoor_scene_seg_sup.html
-def surface_normal(points):
-    # These lookups denote y,x offsets from the anchor point for 8 surrounding
-    # directions from the anchor A depicted below.
-    #  -----------
-    # | 7 | 6 | 5 |
-    #  -----------
-    # | 0 | A | 4 |
-    #  -----------
-    # | 1 | 2 | 3 |
-    #  -----------
-    d = 2
-    lookups = {0:(-d,0),1:(-d,d),2:(0,d),3:(d,d),4:(d,0),5:(d,-d),6:(0,-d),7:(-d,-d)}
-    surface_normals = np.zeros((240,320,3))
-    for i in range(240):
-        for j in range(320):
-            min_diff = None
-            point1 = points[i,j,:3]
-             # We choose the normal calculated from the two points that are
-             # closest to the anchor points.  This helps to prevent using large
-             # depth disparities at surface borders in the normal calculation.
-            for k in range(8):
-                try:
-                    point2 = points[i+lookups[k][0],j+lookups[k][1],:3]
-                    point3 = points[i+lookups[(k+2)%8][0],j+lookups[(k+2)%8][1],:3]
-                    diff = np.linalg.norm(point2 - point1) + np.linalg.norm(point3 - point1)
-                    if min_diff is None or diff < min_diff:
-                        normal = normalize(np.cross(point2-point1,point3-point1))
-                        min_diff = diff
-                except IndexError:
-                    continue
-            surface_normals[i,j,:3] = normal
+#
+# Expects an (N,H,W,3+) array of points (e.g. a stack of the (H,W,4) outputs
+# of points_in_camera_coords) and returns an (N,H,W,3) array of unit normals.
+# The frames are processed chunk_size at a time, which bounds the memory of
+# the shifted neighbour copies.
+def surface_normals_batch(points,chunk_size=16):
+    surface_normals = np.zeros(points.shape[:-1] + (3,))
+    for start in range(0,len(points),chunk_size):
+        surface_normals[start:start + chunk_size] = surface_normals_chunk(points[start:start + chunk_size])
     return surface_normals
 
+def surface_normals_chunk(points):
+    points = points[...,:3]
+    min_diff = np.full(points.shape[:-1],np.inf)
+    surface_normals = np.zeros(points.shape)
+    # We choose the normal calculated from the two points that are
+    # closest to the anchor points.  This helps to prevent using large
+    # depth disparities at surface borders in the normal calculation.
+    # Keeping the running minimum with a strict comparison is the argmin over
+    # the 8 pairs (ties go to the first pair) without holding all 8 candidate
+    # normals in memory at once, and each pair of neighbours is only shifted
+    # when it is needed.
+    for k in range(8):
+        point2, valid2 = shifted_points(points,*NEIGHBOUR_LOOKUPS[k])
+        point3, valid3 = shifted_points(points,*NEIGHBOUR_LOOKUPS[(k+2)%8])
+        offset2 = point2 - points
+        offset3 = point3 - points
+        diff = np.linalg.norm(offset2,axis=-1) + np.linalg.norm(offset3,axis=-1)
+        closer = (diff < min_diff) & valid2 & valid3
+        min_diff[closer] = diff[closer]
+        surface_normals[closer] = np.cross(offset2[closer],offset3[closer])
+    with np.errstate(invalid='ignore',divide='ignore'):
+        surface_normals /= np.linalg.norm(surface_normals,axis=-1,keepdims=True)
+    return surface_normals
+
+def surface_normal(points):
+    return surface_normals_batch(points[np.newaxis])[0]
+
 data_root_path = 'data/val'
 protobuf_path = 'data/scenenet_rgbd_val.pb'
 
@@ -86,15 +103,14 @@ def depth_path_from_view(render_path,view):
     return os.path.join(data_root_path,depth_path)
 
 if __name__ == '__main__':
-    trajectories = sn.Trajectories()
     try:
-        with open(protobuf_path,'rb') as f:
-            trajectories.ParseFromString(f.read())
+        trajectories = IndexedTrajectories(protobuf_path)
     except IOError:
         print('Scenenet protobuf data not found at location:{0}'.format(data_root_path))
         print('Please ensure you have copied the pb file to the data directory')
+        sys.exit(1)
 
-    traj = random.choice(trajectories.trajectories)
+    traj = random.choice(trajectories)
     # This stores for each image pixel, the cameras 3D ray vector 
     cached_pixel_to_ray_array = normalised_pixel_to_ray_array()
     for idx,view in enumerate(traj.views):
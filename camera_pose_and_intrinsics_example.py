@@ -6,6 +6,7 @@ import pathlib
 import random
 import scenenet_pb2 as sn
 import sys
+from trajectory_index import IndexedTrajectories
 
 def normalize(v):
     return v/np.linalg.norm(v)
@@ -66,16 +67,15 @@ def photo_path_from_view(render_path,view):
     return os.path.join(data_root_path,image_path)
 
 if __name__ == '__main__':
-    trajectories = sn.Trajectories()
     try:
-        with open(protobuf_path,'rb') as f:
-            trajectories.ParseFromString(f.read())
+        trajectories = IndexedTrajectories(protobuf_path)
     except IOError:
         print('Scenenet protobuf data not found at location:{0}'.format(data_root_path))
         print('Please ensure you have copied the pb file to the data directory')
+        sys.exit(1)
 
 
-    traj = random.choice(trajectories.trajectories)
+    traj = random.choice(trajectories)
     # Get positions of all the lights in the scene
     light_positions = []
     for instance in traj.instances:
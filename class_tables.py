@@ -0,0 +1,178 @@
+import argparse
+from atomic_files import save_array_atomic
+import numpy as np
+import os
+import scenenet_pb2 as sn
+import sys
+from trajectory_index import IndexedTrajectories
+
+# Per trajectory instance id -> class id lookup tables, one per class scheme
+# (column) of semantic_classes/wnid_to_class.txt, so that labelling a frame is
+# a single gather without walking the trajectory instances
+#   class_table = cached_class_table('data/scenenet_rgbd_val.pb','13_classes')
+#   class_img = instance_to_class(instance_img,class_table[traj_idx])
+#
+# The tables are stored as a directory with one memory mappable .npy per column
+#   <scheme>.npy        uint8/uint16 (n_traj,max_instance_id+1) class ids, see
+#                       semantic_labels.instance_to_class for larger ids
+#   <scheme>_names.npy  str          (n_classes,) class name of each class id
+#   render_path.npy     str          (n_traj,)
+# The background, and any wordnet id missing from wnid_to_class.txt, is class
+# 0 'Unknown', the missing wordnet ids are printed when the tables are built.
+# render_path.npy is written last, so a directory with it is complete.
+
+WNID_TO_CLASS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),'semantic_classes','wnid_to_class.txt')
+
+UNKNOWN_CLASS = 'Unknown'
+
+# The class list order is important, the index in the list is the class id.
+# Schemes without a list here are numbered 'Unknown' then the sorted names.
+CLASS_LISTS = {
+    '13_classes':['Unknown', 'Bed', 'Books', 'Ceiling', 'Chair',
+                  'Floor', 'Furniture', 'Objects', 'Picture',
+                  'Sofa', 'Table', 'TV', 'Wall', 'Window'],
+}
+
+# Columns of wnid_to_class.txt that describe the wordnet id rather than give
+# its class in a scheme
+DESCRIPTION_COLUMNS = ['wnid','name']
+
+# Returns {scheme:{wnid:class_name}} for every class column (e.g. 13_classes),
+# with the wnids zero padded to 8 digits as they are in the protobuf
+def read_wnid_to_class(path=WNID_TO_CLASS_PATH):
+    with open(path,'r') as f:
+        lines = f.read().splitlines()
+    column_headings = lines[0].split()
+    schemes = {column:{} for column in column_headings[1:] if column not in DESCRIPTION_COLUMNS}
+    for line in lines[1:]:
+        fields = line.split()
+        if not fields:
+            continue
+        if len(fields) != len(column_headings):
+            raise ValueError('Expected {0} columns in line:{1}'.format(len(column_headings),line))
+        wnid = fields[0].zfill(8)
+        for column,class_name in zip(column_headings[1:],fields[1:]):
+            if column in schemes:
+                schemes[column][wnid] = class_name
+    return schemes
+
+def class_names_for_scheme(scheme,class_of_wnid):
+    if scheme in CLASS_LISTS:
+        return list(CLASS_LISTS[scheme])
+    return [UNKNOWN_CLASS] + sorted(set(class_of_wnid.values()) - set([UNKNOWN_CLASS]))
+
+# Returns ({scheme:class_names}, {scheme:{wnid:class_id}})
+def wnid_class_ids(path=WNID_TO_CLASS_PATH):
+    class_names = {}
+    class_ids = {}
+    for scheme,class_of_wnid in read_wnid_to_class(path).items():
+        names = class_names_for_scheme(scheme,class_of_wnid)
+        index = {name:class_id for class_id,name in enumerate(names)}
+        try:
+            class_ids[scheme] = {wnid:index[name] for wnid,name in class_of_wnid.items()}
+        except KeyError as e:
+            raise ValueError('Class:{0} of scheme:{1} is not in its class list'.format(e.args[0],scheme))
+        class_names[scheme] = names
+    return class_names, class_ids
+
+def class_id_dtype(num_classes):
+    return np.uint8 if num_classes <= 256 else np.uint16
+
+# Trajectories can be any iterable of sn.Trajectory, each one is only visited
+# once.  Returns ({scheme:table}, {scheme:class_names}, render_paths,
+# missing_wnids) where missing_wnids are those not in wnid_to_class.txt.
+def class_tables_from_trajectories(trajectories,path=WNID_TO_CLASS_PATH):
+    class_names, class_ids = wnid_class_ids(path)
+    render_paths = []
+    all_instances = []
+    max_instance_id = 0
+    for traj in trajectories:
+        render_paths.append(traj.render_path)
+        instances = [(instance.instance_id,instance.semantic_wordnet_id) for instance in traj.instances
+                     if instance.instance_type != sn.Instance.BACKGROUND]
+        all_instances.append(instances)
+        if instances:
+            max_instance_id = max(max_instance_id,max(instance_id for instance_id,_ in instances))
+    tables = {}
+    missing_wnids = set()
+    for scheme,ids in class_ids.items():
+        table = np.zeros((len(all_instances),max_instance_id + 1),dtype=class_id_dtype(len(class_names[scheme])))
+        for traj_idx,instances in enumerate(all_instances):
+            for instance_id,wnid in instances:
+                if wnid in ids:
+                    table[traj_idx,instance_id] = ids[wnid]
+                else:
+                    missing_wnids.add(wnid)
+        tables[scheme] = table
+    return tables, class_names, np.array(render_paths,dtype=np.str_), missing_wnids
+
+def class_tables_from_protobuf(protobuf_path,path=WNID_TO_CLASS_PATH):
+    with IndexedTrajectories(protobuf_path) as trajectories:
+        return class_tables_from_trajectories(trajectories,path)
+
+# Every labelling path reports the wordnet ids it labelled 'Unknown' because
+# they are missing from wnid_to_class.txt
+def print_missing_wnids(missing_wnids,path=WNID_TO_CLASS_PATH):
+    if missing_wnids:
+        print('Wordnet ids not in {0}, labelled {1}:{2}'.format(path,UNKNOWN_CLASS,' '.join(sorted(missing_wnids))))
+
+def save_class_tables(table_dir,tables,class_names,render_paths):
+    if not os.path.isdir(table_dir):
+        os.makedirs(table_dir)
+    marker = os.path.join(table_dir,'render_path.npy')
+    if os.path.isfile(marker):
+        os.remove(marker)
+    for scheme,table in tables.items():
+        save_array_atomic(os.path.join(table_dir,scheme + '.npy'),table)
+        save_array_atomic(os.path.join(table_dir,scheme + '_names.npy'),np.array(class_names[scheme],dtype=np.str_))
+    save_array_atomic(marker,render_paths)
+
+def load_class_table(table_dir,scheme,mmap_mode='r'):
+    table_path = os.path.join(table_dir,scheme + '.npy')
+    if not os.path.isfile(table_path):
+        raise IOError('No class table for scheme:{0} in:{1}'.format(scheme,table_dir))
+    return np.load(table_path,mmap_mode=mmap_mode)
+
+def load_class_names(table_dir,scheme):
+    return [str(name) for name in np.load(os.path.join(table_dir,scheme + '_names.npy'))]
+
+def class_table_dir_for(protobuf_path):
+    return os.path.splitext(protobuf_path)[0] + '_classes'
+
+# Returns the cached (n_traj,max_instance_id+1) class table of the scheme,
+# building the tables if they are missing or older than the protobuf or
+# wnid_to_class.txt
+def cached_class_table(protobuf_path,scheme='13_classes',table_dir=None,mmap_mode='r',path=WNID_TO_CLASS_PATH):
+    table_dir = table_dir or class_table_dir_for(protobuf_path)
+    marker = os.path.join(table_dir,'render_path.npy')
+    if (not os.path.isfile(marker) or
+            os.path.getmtime(marker) < max(os.path.getmtime(protobuf_path),os.path.getmtime(path))):
+        tables, class_names, render_paths, missing_wnids = class_tables_from_protobuf(protobuf_path,path)
+        print_missing_wnids(missing_wnids,path)
+        if scheme not in tables:
+            raise IOError('No class table for scheme:{0} in:{1}'.format(scheme,path))
+        try:
+            save_class_tables(table_dir,tables,class_names,render_paths)
+        except (IOError,OSError):
+            # The tables are only a cache, e.g. the data directory may be read
+            # only, in which case they are rebuilt on the next run
+            print('Unable to write class tables to:{0}'.format(table_dir))
+            return tables[scheme]
+    return load_class_table(table_dir,scheme,mmap_mode=mmap_mode)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds the instance id to class id lookup tables of every trajectory for each class scheme of wnid_to_class.txt')
+    parser.add_argument('protobuf_path', help='e.g. data/scenenet_rgbd_val.pb')
+    parser.add_argument('output_dir', nargs='?', help='defaults to the protobuf path without its extension + _classes')
+    parser.add_argument('--wnid-to-class', default=WNID_TO_CLASS_PATH, help='the wordnet id to class columns')
+    args = parser.parse_args()
+    if not os.path.isfile(args.protobuf_path):
+        print('Scenenet protobuf data not found at location:{0}'.format(args.protobuf_path))
+        sys.exit(1)
+    table_dir = args.output_dir or class_table_dir_for(args.protobuf_path)
+    tables, class_names, render_paths, missing_wnids = class_tables_from_protobuf(args.protobuf_path,args.wnid_to_class)
+    save_class_tables(table_dir,tables,class_names,render_paths)
+    for scheme,table in sorted(tables.items()):
+        print('Scheme:{0} classes:{1} table:{2} {3}'.format(scheme,len(class_names[scheme]),table.shape,table.dtype))
+    print_missing_wnids(missing_wnids,args.wnid_to_class)
+    print('Wrote class tables of {0} trajectories to:{1}'.format(len(render_paths),table_dir))
@@ -0,0 +1,257 @@
+import argparse
+from atomic_files import save_array_atomic
+from frame_stats import load_frame_stats
+import numpy as np
+import os
+from pose_table import cached_pose_table
+import scenenet_pb2 as sn
+import sys
+from trajectory_index import IndexedTrajectories
+
+# Selects frames of a split by the trajectory metadata and, optionally, the
+# frame statistics of frame_stats.py, without decoding the protobuf, e.g.
+#   query = FrameQuery('data/scenenet_rgbd_train.pb',stats_path='data/scenenet_rgbd_train_stats.npz')
+#   query.select(layout_type='KITCHEN')
+#   query.select(min_class_fraction={'TV':0.05})
+#   query.select(min_class_fraction=[('Wall',0.2),('Window',0.01)])
+#   query.select(light_type='PARALLELOGRAM',wnid='04256520')
+# which return a list of (render_path, frame_num).  Each filter takes a value
+# or a list of values, any of which match, and the filters are combined with
+# and.
+#
+# The metadata is a directory of inverted indices, one per key, from each
+# value of the key to the (sorted) trajectories that have it
+#   <key>_values.npy        (n_values,) sorted
+#   <key>_offsets.npy       int64 (n_values+1,)
+#   <key>_trajectories.npy  int32 the trajectories of value i are
+#                           [offsets[i]:offsets[i+1]]
+# for the keys
+#   layout_type    the sn.SceneLayout.LayoutType of the trajectory
+#   instance_type  the sn.Instance.InstanceType of any of its instances
+#   wnid           the semantic_wordnet_id of any of its instances
+#   light_type     the sn.LightInfo.LightType of any of its light instances
+# render_path.npy is written last, so a directory with it is complete.
+
+QUERY_KEYS = ['layout_type','instance_type','wnid','light_type']
+
+# The enums the names of each key are values of, the wnids are strings
+QUERY_KEY_ENUMS = {
+    'layout_type':sn.SceneLayout.LayoutType,
+    'instance_type':sn.Instance.InstanceType,
+    'light_type':sn.LightInfo.LightType,
+}
+
+# Returns {key:(values, trajectory index)} with a row for every (value,
+# trajectory) pair, and the render paths.  Trajectories can be any iterable of
+# sn.Trajectory, each one is only visited once.
+def metadata_from_trajectories(trajectories):
+    rows = {key:([],[]) for key in QUERY_KEYS}
+    render_paths = []
+    for traj_idx,traj in enumerate(trajectories):
+        render_paths.append(traj.render_path)
+        keys = {'layout_type':set([traj.layout.layout_type]),'instance_type':set(),'wnid':set(),'light_type':set()}
+        for instance in traj.instances:
+            keys['instance_type'].add(instance.instance_type)
+            if instance.instance_type != sn.Instance.BACKGROUND:
+                keys['wnid'].add(instance.semantic_wordnet_id)
+            if instance.instance_type == sn.Instance.LIGHT_OBJECT:
+                keys['light_type'].add(instance.light_info.light_type)
+        for key,values in keys.items():
+            rows[key][0].extend(values)
+            rows[key][1].extend([traj_idx] * len(values))
+    columns = {}
+    for key,(values,traj_indices) in rows.items():
+        dtype = np.str_ if key == 'wnid' else np.int32
+        columns[key] = (np.array(values,dtype=dtype),np.array(traj_indices,dtype=np.int32))
+    return columns, np.array(render_paths,dtype=np.str_)
+
+# Returns (values, offsets, trajectories) of the inverted index of the rows
+def inverted_index(values,traj_indices):
+    order = np.lexsort((traj_indices,values))
+    values = values[order]
+    unique_values, starts = np.unique(values,return_index=True)
+    offsets = np.append(starts,len(values)).astype(np.int64)
+    return unique_values, offsets, traj_indices[order].astype(np.int32)
+
+def save_query_metadata(metadata_dir,columns,render_paths):
+    if not os.path.isdir(metadata_dir):
+        os.makedirs(metadata_dir)
+    marker = os.path.join(metadata_dir,'render_path.npy')
+    if os.path.isfile(marker):
+        os.remove(marker)
+    for key in QUERY_KEYS:
+        for name,array in zip(('values','offsets','trajectories'),inverted_index(*columns[key])):
+            save_array_atomic(os.path.join(metadata_dir,'{0}_{1}.npy'.format(key,name)),array)
+    save_array_atomic(marker,render_paths)
+
+def load_query_metadata(metadata_dir,mmap_mode='r'):
+    index = {}
+    for key in QUERY_KEYS:
+        index[key] = tuple(np.load(os.path.join(metadata_dir,'{0}_{1}.npy'.format(key,name)),mmap_mode=mmap_mode)
+                           for name in ('values','offsets','trajectories'))
+    return index, np.load(os.path.join(metadata_dir,'render_path.npy'),mmap_mode=mmap_mode)
+
+def query_metadata_dir_for(protobuf_path):
+    return os.path.splitext(protobuf_path)[0] + '_metadata'
+
+# Returns the cached inverted indices and render paths of the protobuf,
+# building them if they are missing or older than the protobuf itself
+def cached_query_metadata(protobuf_path,metadata_dir=None,mmap_mode='r'):
+    metadata_dir = metadata_dir or query_metadata_dir_for(protobuf_path)
+    marker = os.path.join(metadata_dir,'render_path.npy')
+    if not os.path.isfile(marker) or os.path.getmtime(marker) < os.path.getmtime(protobuf_path):
+        with IndexedTrajectories(protobuf_path) as trajectories:
+            columns, render_paths = metadata_from_trajectories(trajectories)
+        try:
+            save_query_metadata(metadata_dir,columns,render_paths)
+        except (IOError,OSError):
+            # The indices are only a cache, e.g. the data directory may be
+            # read only, in which case they are rebuilt on the next run
+            print('Unable to write query metadata to:{0}'.format(metadata_dir))
+            return {key:inverted_index(*columns[key]) for key in QUERY_KEYS}, render_paths
+    return load_query_metadata(metadata_dir,mmap_mode=mmap_mode)
+
+class FrameQuery(object):
+    def __init__(self,protobuf_path,stats_path=None,metadata_dir=None,pose_table_dir=None):
+        self.index, self.render_path = cached_query_metadata(protobuf_path,metadata_dir)
+        poses = cached_pose_table(protobuf_path,table_dir=pose_table_dir)
+        num_views = np.asarray(poses['num_views'])
+        # Every frame of the split, in the trajectory order of the pose table
+        # and the statistics index
+        self.frame_trajectory = np.repeat(np.arange(len(num_views),dtype=np.int32),num_views)
+        self.frame_num = np.asarray(poses['frame_num'])[np.arange(poses['frame_num'].shape[1]) < num_views[:,None]]
+        self.frame_offsets = np.concatenate(([0],np.cumsum(num_views))).astype(np.int64)
+        self.stats = None
+        if stats_path is not None:
+            self.stats = load_frame_stats(stats_path)
+            if not np.array_equal(self.stats['frame_num'],self.frame_num):
+                raise ValueError('Frame statistics:{0} are not of the frames of:{1}'.format(stats_path,protobuf_path))
+            self.class_names = [str(name) for name in self.stats['class_names']]
+            num_pixels = float(np.prod(self.stats['image_shape']))
+            # Class major, so filtering by a class reads one contiguous row
+            self.class_fraction = np.ascontiguousarray((self.stats['class_pixels'] / max(num_pixels,1.0)).T,
+                                                       dtype=np.float32)
+            self.zero_depth_fraction = self.stats['zero_depth_fraction']
+
+    def __len__(self):
+        return len(self.frame_num)
+
+    def key_value(self,key,value):
+        if key in QUERY_KEY_ENUMS and not isinstance(value,(int,np.integer)):
+            return QUERY_KEY_ENUMS[key].Value(value)
+        return value
+
+    # The sorted trajectories with any of the values of the key
+    def trajectories_with(self,key,values):
+        if key not in self.index:
+            raise ValueError('Unknown query key:{0}, choose from {1}'.format(key,QUERY_KEYS))
+        if isinstance(values,(str,int,np.integer)):
+            values = [values]
+        key_values, offsets, trajectories = self.index[key]
+        matches = []
+        for value in values:
+            value = self.key_value(key,value)
+            pos = np.searchsorted(key_values,value)
+            if pos < len(key_values) and key_values[pos] == value:
+                matches.append(trajectories[offsets[pos]:offsets[pos + 1]])
+        if not matches:
+            return np.zeros(0,dtype=np.int32)
+        return np.unique(np.concatenate(matches))
+
+    # The sorted trajectories matching every given metadata filter, all of
+    # them if there are none
+    def select_trajectories(self,**filters):
+        selected = None
+        for key,values in filters.items():
+            if values is None:
+                continue
+            matches = self.trajectories_with(key,values)
+            selected = matches if selected is None else np.intersect1d(selected,matches,assume_unique=True)
+        if selected is None:
+            return np.arange(len(self.render_path),dtype=np.int32)
+        return selected
+
+    def class_id(self,class_name):
+        if self.stats is None:
+            raise ValueError('Class filters need the frame statistics, see frame_stats.py')
+        if isinstance(class_name,(int,np.integer)):
+            return class_name
+        try:
+            return self.class_names.index(class_name)
+        except ValueError:
+            raise ValueError('Unknown class:{0}, choose from {1}'.format(class_name,self.class_names))
+
+    # Indices into the frames of the split of the frames matching every filter
+    #   min_class_fraction      {class:fraction} or [(class, fraction)] frames
+    #                           where each class covers more than its fraction
+    #                           of the pixels
+    #   max_zero_depth_fraction frames with at most this fraction of pixels
+    #                           without depth
+    # Both need the frame statistics, from the stats_path of the query.
+    def select_frame_indices(self,layout_type=None,instance_type=None,wnid=None,light_type=None,
+                             min_class_fraction=None,max_zero_depth_fraction=None):
+        metadata_filters = {'layout_type':layout_type,'instance_type':instance_type,'wnid':wnid,'light_type':light_type}
+        if (min_class_fraction or max_zero_depth_fraction is not None) and self.stats is None:
+            raise ValueError('Class and depth filters need the frame statistics, see frame_stats.py')
+        # Masks over every frame, which are then only gathered for the frames
+        # of the selected trajectories
+        masks = []
+        if min_class_fraction:
+            if isinstance(min_class_fraction,dict):
+                min_class_fraction = min_class_fraction.items()
+            for class_name,fraction in min_class_fraction:
+                masks.append((self.class_fraction[self.class_id(class_name)],float(fraction),np.greater))
+        if max_zero_depth_fraction is not None:
+            masks.append((self.zero_depth_fraction,max_zero_depth_fraction,np.less_equal))
+        if all(values is None for values in metadata_filters.values()):
+            if not masks:
+                return np.arange(len(self.frame_num))
+            column, threshold, compare = masks.pop(0)
+            frames = np.flatnonzero(compare(column,threshold))
+        else:
+            trajectories = self.select_trajectories(**metadata_filters)
+            starts = self.frame_offsets[trajectories]
+            counts = self.frame_offsets[trajectories + 1] - starts
+            frames = np.repeat(starts - np.cumsum(counts) + counts,counts) + np.arange(int(counts.sum()))
+        for column,threshold,compare in masks:
+            frames = frames[compare(column[frames],threshold)]
+        return frames
+
+    # Returns the [(render_path, frame_num)] of the frames matching every
+    # filter, see select_frame_indices
+    def select(self,**filters):
+        frames = self.select_frame_indices(**filters)
+        render_paths = self.render_path[self.frame_trajectory[frames]]
+        return list(zip(render_paths.tolist(),self.frame_num[frames].tolist()))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Lists the (render path, frame number) of the frames matching every filter')
+    parser.add_argument('protobuf_path', help='e.g. data/scenenet_rgbd_val.pb')
+    parser.add_argument('--stats', help='the frame statistics of frame_stats.py, needed by the class and depth filters')
+    parser.add_argument('--layout-type', nargs='+', help='e.g. KITCHEN BEDROOM')
+    parser.add_argument('--instance-type', nargs='+', help='e.g. LIGHT_OBJECT')
+    parser.add_argument('--wnid', nargs='+', help='wordnet ids of any instance, e.g. 04256520')
+    parser.add_argument('--light-type', nargs='+', help='e.g. PARALLELOGRAM')
+    parser.add_argument('--min-class-fraction', nargs=2, action='append', metavar=('CLASS','FRACTION'),
+                        help='frames where the class covers more than the fraction of the pixels, e.g. TV 0.05')
+    parser.add_argument('--max-zero-depth-fraction', type=float)
+    parser.add_argument('--count', action='store_true', help='only print the number of matching frames')
+    args = parser.parse_args()
+    if (args.min_class_fraction or args.max_zero_depth_fraction is not None) and args.stats is None:
+        parser.error('--min-class-fraction and --max-zero-depth-fraction need --stats')
+    for class_name,fraction in args.min_class_fraction or []:
+        try:
+            float(fraction)
+        except ValueError:
+            parser.error('--min-class-fraction {0} {1}: the fraction is not a number'.format(class_name,fraction))
+    if not os.path.isfile(args.protobuf_path):
+        print('Scenenet protobuf data not found at location:{0}'.format(args.protobuf_path))
+        sys.exit(1)
+    query = FrameQuery(args.protobuf_path,stats_path=args.stats)
+    frames = query.select(layout_type=args.layout_type,instance_type=args.instance_type,wnid=args.wnid,
+                          light_type=args.light_type,min_class_fraction=args.min_class_fraction,
+                          max_zero_depth_fraction=args.max_zero_depth_fraction)
+    if not args.count:
+        for render_path,frame_num in frames:
+            print('{0} {1}'.format(render_path,frame_num))
+    print('Frames:{0}/{1}'.format(len(frames),len(query)))
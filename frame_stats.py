@@ -0,0 +1,287 @@
+import argparse
+from atomic_files import atomic_open
+from class_tables import cached_class_table, wnid_class_ids
+from frame_store import ViewRef, check_backend, depth_from_view, instance_from_view
+import numpy as np
+import os
+from pose_table import cached_pose_table
+import sys
+import time
+from trajectory_pool import print_progress, run_trajectory_pool
+
+# Pixel statistics of every frame of a split, computed in one pass over the
+# instance and depth images so that frame sampling and class weighting need no
+# further image decodes.  The index is a single .npz file of columns
+#
+#   trajectory_index        int32   (n_frames,) the trajectory of the protobuf
+#   frame_num               int32   (n_frames,)
+#   class_pixels            uint32  (n_frames,n_classes) pixels of each class
+#   instance_offsets        int64   (n_frames+1,) the instance pixel counts of
+#                                   frame i are instance_ids/instance_pixels
+#                                   [instance_offsets[i]:instance_offsets[i+1]]
+#   instance_ids            uint16  instances with any pixels in the frame
+#   instance_pixels         uint32
+#   depth_min/depth_max     uint16  (n_frames,) millimetres, of the non zero
+#                                   depths, 0 if there are none
+#   depth_mean              float32 (n_frames,) millimetres, of the non zero depths
+#   zero_depth_fraction     float32 (n_frames,) fraction of pixels with no depth
+#                                   (e.g. seen through a window)
+#
+# and per trajectory
+#
+#   render_path                     str     (n_traj,) of the trajectories
+#                                   read, every one of the protobuf unless
+#                                   some failed
+#   frame_offsets                   int64   (n_traj+1,) the frames of each trajectory
+#   trajectory_class_pixels         uint64  (n_traj,n_classes)
+#   trajectory_instance_pixels      uint64  (n_traj,max_instance_id+1)
+#   trajectory_depth_min/max/mean   as the frame columns, over the whole trajectory
+#   trajectory_zero_depth_fraction
+#
+#   class_names                     str     (n_classes,) of the class scheme
+#   image_shape                     int64   (2,) height, width
+#
+# Classes come from the instance -> class tables of class_tables.py, so every
+# pixel count is a bincount of the instance image and the class counts are
+# gathered from the instance counts.  Instance ids past the end of the class
+# table of a trajectory are counted as class 0, 'Unknown'.
+
+FRAME_STATS_COLUMNS = ['trajectory_index','frame_num','class_pixels',
+                       'instance_offsets','instance_ids','instance_pixels',
+                       'depth_min','depth_max','depth_mean','zero_depth_fraction']
+
+TRAJECTORY_STATS_COLUMNS = ['render_path','frame_offsets',
+                            'trajectory_class_pixels','trajectory_instance_pixels',
+                            'trajectory_depth_min','trajectory_depth_max','trajectory_depth_mean',
+                            'trajectory_zero_depth_fraction','class_names','image_shape']
+
+# Returns the (N,num_instances) pixel count of each instance id in an (N,H,W)
+# stack of instance images, widened to the largest id if the images have ids
+# of num_instances or more
+def instance_histograms(instance,num_instances):
+    n = len(instance)
+    flat = instance.reshape(n,-1)
+    if flat.size:
+        num_instances = max(num_instances,int(flat.max()) + 1)
+    # Offset the ids of each frame so one bincount counts all of them
+    ids = flat + (np.arange(n,dtype=np.int64) * num_instances)[:,None]
+    return np.bincount(ids.ravel(),minlength=n * num_instances).reshape(n,num_instances)
+
+# Sums the instance counts of each frame into the class of each instance,
+# instances past the end of the lookup table are class 0
+def class_histograms(instance_counts,instance_class_lut,num_classes):
+    n, num_instances = instance_counts.shape
+    lut = np.zeros(num_instances,dtype=np.int64)
+    known = min(num_instances,len(instance_class_lut))
+    lut[:known] = instance_class_lut[:known]
+    classes = (np.arange(n,dtype=np.int64) * num_classes)[:,None] + lut
+    return np.bincount(classes.ravel(),weights=instance_counts.ravel(),
+                       minlength=n * num_classes).reshape(n,num_classes).astype(np.uint64)
+
+# Returns (depth_min, depth_max, depth_sum, zero_pixels) of each frame of an
+# (N,H,W) uint16 depth stack, over its non zero depths
+def depth_statistics(depth):
+    flat = depth.reshape(len(depth),-1)
+    zero = flat == 0
+    zero_pixels = zero.sum(axis=1)
+    depth_max = flat.max(axis=1)
+    depth_min = np.where(zero,np.iinfo(np.uint16).max,flat).min(axis=1)
+    depth_min[zero_pixels == flat.shape[1]] = 0
+    depth_sum = flat.sum(axis=1,dtype=np.uint64)
+    return depth_min.astype(np.uint16), depth_max.astype(np.uint16), depth_sum, zero_pixels
+
+# Concatenates 2D count arrays, padding each with zero columns to the widest
+def pad_columns(counts):
+    width = max(c.shape[1] for c in counts)
+    return np.concatenate([np.pad(c,((0,0),(0,width - c.shape[1]))) for c in counts])
+
+def safe_mean(total,count):
+    return np.where(count > 0,total / np.maximum(count,1),0).astype(np.float32)
+
+# Statistics of one trajectory, its frames loaded chunk_size at a time by
+# load_depth(frame_num) and load_instance(frame_num)
+def trajectory_statistics(frame_nums,load_depth,load_instance,instance_class_lut,num_classes,chunk_size=32):
+    num_instances = len(instance_class_lut)
+    instance_counts = []
+    depth_columns = []
+    for start in range(0,len(frame_nums),chunk_size):
+        chunk = frame_nums[start:start + chunk_size]
+        instance = np.stack([load_instance(frame_num) for frame_num in chunk])
+        depth = np.stack([load_depth(frame_num) for frame_num in chunk])
+        instance_counts.append(instance_histograms(instance,num_instances))
+        depth_columns.append(depth_statistics(depth))
+    image_shape = depth.shape[1:] if len(frame_nums) else (0,0)
+    num_pixels = int(np.prod(image_shape))
+    if instance_counts:
+        instance_counts = pad_columns(instance_counts)
+        depth_min, depth_max, depth_sum, zero_pixels = [np.concatenate(column) for column in zip(*depth_columns)]
+    else:
+        instance_counts = np.zeros((0,num_instances),dtype=np.int64)
+        depth_min, depth_max = np.zeros(0,dtype=np.uint16), np.zeros(0,dtype=np.uint16)
+        depth_sum, zero_pixels = np.zeros(0,dtype=np.uint64), np.zeros(0,dtype=np.int64)
+    class_pixels = class_histograms(instance_counts,instance_class_lut,num_classes)
+    frame_idx, instance_ids = np.nonzero(instance_counts)
+    valid_pixels = num_pixels - zero_pixels
+    has_depth = valid_pixels > 0
+    total_valid = int(valid_pixels.sum())
+    return {
+        'frame_num':np.asarray(frame_nums,dtype=np.int32),
+        'class_pixels':class_pixels.astype(np.uint32),
+        'instance_counts_per_frame':np.bincount(frame_idx,minlength=len(frame_nums)),
+        'instance_ids':instance_ids.astype(np.uint16),
+        'instance_pixels':instance_counts[frame_idx,instance_ids].astype(np.uint32),
+        'depth_min':depth_min,
+        'depth_max':depth_max,
+        'depth_mean':safe_mean(depth_sum,valid_pixels),
+        'zero_depth_fraction':(zero_pixels / max(num_pixels,1)).astype(np.float32),
+        'trajectory_class_pixels':class_pixels.sum(axis=0,dtype=np.uint64),
+        'trajectory_instance_pixels':instance_counts.sum(axis=0,dtype=np.uint64),
+        'trajectory_depth_min':depth_min[has_depth].min() if has_depth.any() else np.uint16(0),
+        'trajectory_depth_max':depth_max.max() if len(depth_max) else np.uint16(0),
+        'trajectory_depth_mean':safe_mean(depth_sum.sum(),total_valid),
+        'trajectory_zero_depth_fraction':np.float32(zero_pixels.sum() / max(num_pixels * len(frame_nums),1)),
+        'image_shape':np.array(image_shape,dtype=np.int64),
+    }
+
+# Joins the statistics of each trajectory, in trajectory order, into the index.
+# trajectory_indices are the protobuf indices of the trajectories, by default
+# their position in trajectory_stats.
+def frame_stats_index(trajectory_stats,render_paths,class_names,trajectory_indices=None):
+    if trajectory_indices is None:
+        trajectory_indices = np.arange(len(trajectory_stats))
+    num_frames = np.array([len(stats['frame_num']) for stats in trajectory_stats],dtype=np.int64)
+    instances_per_frame = np.concatenate([stats['instance_counts_per_frame'] for stats in trajectory_stats]
+                                         + [np.zeros(0,dtype=np.int64)])
+    def concatenate(column,dtype):
+        return np.concatenate([stats[column] for stats in trajectory_stats]
+                              + [np.zeros(0,dtype=dtype)]).astype(dtype)
+    num_classes = len(class_names)
+    image_shapes = [stats['image_shape'] for stats in trajectory_stats if len(stats['frame_num'])]
+    index = {
+        'trajectory_index':np.repeat(np.asarray(trajectory_indices,dtype=np.int32),num_frames),
+        'frame_num':concatenate('frame_num',np.int32),
+        'class_pixels':np.concatenate([stats['class_pixels'] for stats in trajectory_stats]
+                                      + [np.zeros((0,num_classes),dtype=np.uint32)]),
+        'instance_offsets':np.concatenate(([0],np.cumsum(instances_per_frame))).astype(np.int64),
+        'instance_ids':concatenate('instance_ids',np.uint16),
+        'instance_pixels':concatenate('instance_pixels',np.uint32),
+        'depth_min':concatenate('depth_min',np.uint16),
+        'depth_max':concatenate('depth_max',np.uint16),
+        'depth_mean':concatenate('depth_mean',np.float32),
+        'zero_depth_fraction':concatenate('zero_depth_fraction',np.float32),
+        'render_path':np.array(render_paths,dtype=np.str_),
+        'frame_offsets':np.concatenate(([0],np.cumsum(num_frames))).astype(np.int64),
+        'trajectory_class_pixels':np.stack([stats['trajectory_class_pixels'] for stats in trajectory_stats]),
+        'trajectory_instance_pixels':pad_columns([stats['trajectory_instance_pixels'][None]
+                                                  for stats in trajectory_stats]
+                                                 + [np.zeros((0,1),dtype=np.uint64)]),
+        'class_names':np.array(class_names,dtype=np.str_),
+        'image_shape':image_shapes[0] if image_shapes else np.zeros(2,dtype=np.int64),
+    }
+    for column,dtype in (('trajectory_depth_min',np.uint16),('trajectory_depth_max',np.uint16),
+                         ('trajectory_depth_mean',np.float32),('trajectory_zero_depth_fraction',np.float32)):
+        index[column] = np.array([stats[column] for stats in trajectory_stats],dtype=dtype)
+    return index
+
+def save_frame_stats(path,index):
+    with atomic_open(path) as f:
+        np.savez(f,**{column:index[column] for column in FRAME_STATS_COLUMNS + TRAJECTORY_STATS_COLUMNS})
+
+# The columns are only read from the file when they are first accessed
+def load_frame_stats(path):
+    return np.load(path)
+
+def frame_stats_path_for(protobuf_path):
+    return os.path.splitext(protobuf_path)[0] + '_stats.npz'
+
+# Median frequency balancing class weights, freq(c) = pixels of class c / pixels
+# of the frames the class appears in, weight(c) = median(freq) / freq(c).
+# Classes that never appear get a weight of 0.
+def median_frequency_weights(class_pixels,ignore_classes=(0,)):
+    class_pixels = np.asarray(class_pixels,dtype=np.float64)
+    frame_pixels = class_pixels.sum(axis=1)
+    present = class_pixels > 0
+    appear_pixels = (present * frame_pixels[:,None]).sum(axis=0)
+    freq = np.where(appear_pixels > 0,class_pixels.sum(axis=0) / np.maximum(appear_pixels,1),0)
+    used = freq > 0
+    used[list(ignore_classes)] = False
+    weights = np.zeros(len(freq))
+    if used.any():
+        weights[used] = np.median(freq[used]) / freq[used]
+    return weights
+
+# Each worker process memory maps the pose and class tables once
+worker_poses = None
+worker_class_table = None
+
+def init_worker(pb_path,scheme):
+    global worker_poses, worker_class_table
+    worker_poses = cached_pose_table(pb_path)
+    worker_class_table = cached_class_table(pb_path,scheme)
+
+def statistics_for_trajectory(traj_idx,root_path,options):
+    render_path = str(worker_poses['render_path'][traj_idx])
+    num_views = int(worker_poses['num_views'][traj_idx])
+    backend = options['backend']
+    store_root = options['store_root']
+    def load_depth(frame_num):
+        return depth_from_view(render_path,ViewRef(frame_num),root_path,backend=backend,store_root=store_root)
+    def load_instance(frame_num):
+        return instance_from_view(render_path,ViewRef(frame_num),root_path,backend=backend,store_root=store_root)
+    frame_nums = [int(f) for f in worker_poses['frame_num'][traj_idx,:num_views]]
+    return trajectory_statistics(frame_nums,load_depth,load_instance,
+                                 np.asarray(worker_class_table[traj_idx]),options['num_classes'],
+                                 chunk_size=options['chunk_size'])
+
+# Builds the index of every trajectory of the protobuf that could be read,
+# returning it and the render paths that failed
+def build_frame_stats(protobuf_path,root_path,scheme='13_classes',backend='files',store_root=None,
+                      chunk_size=32,workers=1):
+    check_backend(backend)
+    init_worker(protobuf_path,scheme)
+    render_paths = [str(render_path) for render_path in worker_poses['render_path']]
+    class_names = wnid_class_ids()[0][scheme]
+    options = {'backend':backend,'store_root':store_root,'chunk_size':chunk_size,'num_classes':len(class_names)}
+    tasks = [(traj_idx,root_path,options) for traj_idx in range(len(render_paths))]
+    results = run_trajectory_pool(statistics_for_trajectory,tasks,workers,
+                                  initializer=init_worker,initargs=(protobuf_path,scheme))
+    start_time = time.time()
+    trajectory_stats = [None] * len(tasks)
+    failures = []
+    total_frames = 0
+    for done,((traj_idx,_,_),stats,error) in enumerate(results,1):
+        if error is not None:
+            print('Failed render path:{0} {1}'.format(render_paths[traj_idx],error))
+            failures.append(render_paths[traj_idx])
+            continue
+        trajectory_stats[traj_idx] = stats
+        total_frames += len(stats['frame_num'])
+        print_progress(done,len(tasks),total_frames,start_time,('frames',total_frames))
+    read = [traj_idx for traj_idx,stats in enumerate(trajectory_stats) if stats is not None]
+    index = frame_stats_index([trajectory_stats[traj_idx] for traj_idx in read],
+                              [render_paths[traj_idx] for traj_idx in read],class_names,read)
+    return index, failures
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes the class and instance pixel counts and depth statistics of every frame to one index file')
+    parser.add_argument('protobuf_path', help='e.g. data/scenenet_rgbd_val.pb')
+    parser.add_argument('data_root_path', help='e.g. data/val')
+    parser.add_argument('--output', help='defaults to the protobuf path without its extension + _stats.npz')
+    parser.add_argument('--scheme', default='13_classes', help='a column of semantic_classes/wnid_to_class.txt')
+    parser.add_argument('--backend', default='files', help='files or packed, see frame_store.py')
+    parser.add_argument('--store-root', help='The root of the packed stores, if not under the dataset')
+    parser.add_argument('--chunk-size', type=int, default=32, help='Number of frames processed at once')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes, the work is split by trajectory')
+    args = parser.parse_args()
+    if not os.path.isfile(args.protobuf_path):
+        print('Scenenet protobuf data not found at location:{0}'.format(args.protobuf_path))
+        sys.exit(1)
+    index, failures = build_frame_stats(args.protobuf_path,args.data_root_path,scheme=args.scheme,
+                                        backend=args.backend,store_root=args.store_root,
+                                        chunk_size=args.chunk_size,workers=args.workers)
+    output = args.output or frame_stats_path_for(args.protobuf_path)
+    save_frame_stats(output,index)
+    print('Wrote statistics of {0} frames to:{1}'.format(len(index['frame_num']),output))
+    if failures:
+        print('Failed to read {0} trajectories, they are not in the index:{1}'.format(len(failures),' '.join(failures)))
+        sys.exit(1)
@@ -0,0 +1,198 @@
+import argparse
+from atomic_files import atomic_open, atomic_path, save_array_atomic
+from collections import namedtuple
+import functools
+import io
+import numpy as np
+import os
+from PIL import Image
+from pose_table import cached_pose_table
+import profiling
+import read_protobuf
+from read_protobuf import depth_path_from_view, instance_path_from_view, photo_path_from_view
+import sys
+import time
+from trajectory_pool import print_progress, run_trajectory_pool
+
+# A packed copy of the frames of each trajectory, replacing hundreds of small
+# image files with a few contiguous ones that can be memory mapped.  For a
+# trajectory the store directory (by default render_path/packed under the
+# dataset root) holds
+#
+#   frame_num.npy      int32  (n_views,)
+#   depth.npy          uint16 (n_views,H,W) in millimetres
+#   instance.npy       uint16 (n_views,H,W)
+#   photo.jpgs         the photo jpegs concatenated, unchanged
+#   photo_offsets.npy  int64  (n_views+1,) byte range of each jpeg
+#
+# The photos are optional.  frame_num.npy is written last, so a store with it
+# is complete.
+#
+# The *_from_view functions load a frame given the same (render_path, view)
+# as the read_protobuf path helpers, from either backend
+#   'files'   the original photo/depth/instance image files
+#   'packed'  the packed store, depth and instance are zero copy slices
+
+BACKENDS = ('files', 'packed')
+PACKED_DIR_NAME = 'packed'
+# Number of trajectories whose packed arrays are kept memory mapped
+PACKED_CACHE_SIZE = 64
+
+# Stands in for a view when only the frame number is known, which is all the
+# path helpers use
+ViewRef = namedtuple('ViewRef', ['frame_num'])
+
+def load_image(path):
+    # Packed photos are counted as their bytes are read
+    if not isinstance(path,io.BytesIO):
+        profiling.count_file_read(path)
+    with Image.open(path) as image:
+        return np.array(image)
+
+def packed_dir_for(render_path,root_path=None,store_root=None):
+    if store_root is None:
+        store_root = root_path or read_protobuf.data_root_path
+    return os.path.join(store_root,render_path,PACKED_DIR_NAME)
+
+class PackedTrajectory(object):
+    def __init__(self,store_dir):
+        self.store_dir = store_dir
+        self.frame_num = np.load(os.path.join(store_dir,'frame_num.npy'))
+        self._view_of_frame = {int(frame_num):idx for idx,frame_num in enumerate(self.frame_num)}
+        self.depth = np.load(os.path.join(store_dir,'depth.npy'),mmap_mode='r')
+        self.instance = np.load(os.path.join(store_dir,'instance.npy'),mmap_mode='r')
+        photo_path = os.path.join(store_dir,'photo.jpgs')
+        self.photo_offsets = None
+        self._photos = b''
+        if os.path.isfile(photo_path):
+            self.photo_offsets = np.load(os.path.join(store_dir,'photo_offsets.npy'))
+            if self.photo_offsets[-1] > 0:
+                self._photos = np.memmap(photo_path,dtype=np.uint8,mode='r')
+
+    def __len__(self):
+        return len(self.frame_num)
+
+    def view_index(self,frame_num):
+        try:
+            return self._view_of_frame[frame_num]
+        except KeyError:
+            raise IOError('Frame:{0} is not in packed store:{1}'.format(frame_num,self.store_dir))
+
+    def photo_bytes(self,frame_num):
+        if self.photo_offsets is None:
+            raise IOError('Packed store has no photos:{0}'.format(self.store_dir))
+        idx = self.view_index(frame_num)
+        data = bytes(self._photos[self.photo_offsets[idx]:self.photo_offsets[idx + 1]])
+        profiling.count(bytes_read=len(data))
+        return data
+
+    def photo(self,frame_num):
+        return load_image(io.BytesIO(self.photo_bytes(frame_num)))
+
+    def depth_frame(self,frame_num):
+        frame = self.depth[self.view_index(frame_num)]
+        profiling.count(bytes_read=frame.nbytes)
+        return frame
+
+    def instance_frame(self,frame_num):
+        frame = self.instance[self.view_index(frame_num)]
+        profiling.count(bytes_read=frame.nbytes)
+        return frame
+
+@functools.lru_cache(maxsize=PACKED_CACHE_SIZE)
+def open_packed_trajectory(store_dir):
+    return PackedTrajectory(store_dir)
+
+def check_backend(backend):
+    if backend not in BACKENDS:
+        raise ValueError('Unknown frame backend:{0}, choose from {1}'.format(backend,BACKENDS))
+
+def photo_from_view(render_path,view,root_path=None,backend='files',store_root=None):
+    check_backend(backend)
+    if backend == 'packed':
+        return open_packed_trajectory(packed_dir_for(render_path,root_path,store_root)).photo(view.frame_num)
+    return load_image(photo_path_from_view(render_path,view,root_path))
+
+def depth_from_view(render_path,view,root_path=None,backend='files',store_root=None):
+    check_backend(backend)
+    if backend == 'packed':
+        return open_packed_trajectory(packed_dir_for(render_path,root_path,store_root)).depth_frame(view.frame_num)
+    return load_image(depth_path_from_view(render_path,view,root_path))
+
+def instance_from_view(render_path,view,root_path=None,backend='files',store_root=None):
+    check_backend(backend)
+    if backend == 'packed':
+        return open_packed_trajectory(packed_dir_for(render_path,root_path,store_root)).instance_frame(view.frame_num)
+    return load_image(instance_path_from_view(render_path,view,root_path))
+
+def pack_image_stack(path,image_paths):
+    first = load_image(image_paths[0])
+    with atomic_path(path) as tmp_path:
+        stack = np.lib.format.open_memmap(tmp_path,mode='w+',dtype=first.dtype,
+                                          shape=(len(image_paths),) + first.shape)
+        stack[0] = first
+        for idx,image_path in enumerate(image_paths[1:],1):
+            stack[idx] = load_image(image_path)
+        stack.flush()
+        del stack
+
+# Packs the frames of one trajectory, returning the number of frames packed (0
+# if the store is already complete)
+def pack_trajectory(render_path,frame_nums,root_path=None,store_root=None,photos=True,force=False):
+    store_dir = packed_dir_for(render_path,root_path,store_root)
+    if not force and os.path.isfile(os.path.join(store_dir,'frame_num.npy')):
+        return 0
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    # Marks the store incomplete until it is repacked, and drops photos that
+    # would otherwise be left over from a previous packing
+    for name in ('frame_num.npy','photo.jpgs','photo_offsets.npy'):
+        if os.path.isfile(os.path.join(store_dir,name)):
+            os.remove(os.path.join(store_dir,name))
+    views = [ViewRef(int(frame_num)) for frame_num in frame_nums]
+    pack_image_stack(os.path.join(store_dir,'depth.npy'),
+                     [depth_path_from_view(render_path,view,root_path) for view in views])
+    pack_image_stack(os.path.join(store_dir,'instance.npy'),
+                     [instance_path_from_view(render_path,view,root_path) for view in views])
+    if photos:
+        offsets = np.zeros(len(views) + 1,dtype=np.int64)
+        photo_path = os.path.join(store_dir,'photo.jpgs')
+        with atomic_open(photo_path) as f:
+            for idx,view in enumerate(views):
+                with open(photo_path_from_view(render_path,view,root_path),'rb') as photo_file:
+                    offsets[idx + 1] = offsets[idx] + f.write(photo_file.read())
+        save_array_atomic(os.path.join(store_dir,'photo_offsets.npy'),offsets)
+    save_array_atomic(os.path.join(store_dir,'frame_num.npy'),np.asarray(frame_nums,dtype=np.int32))
+    return len(views)
+
+# Packs every trajectory of the protobuf, returning the render paths that failed
+def pack_split(protobuf_path,root_path,store_root=None,photos=True,force=False,workers=1):
+    poses = cached_pose_table(protobuf_path)
+    tasks = [(str(render_path),np.array(poses['frame_num'][idx,:num_views]),root_path,store_root,photos,force)
+             for idx,(render_path,num_views) in enumerate(zip(poses['render_path'],poses['num_views']))]
+    start_time = time.time()
+    failures = []
+    total_packed = 0
+    for done,(task,packed,error) in enumerate(run_trajectory_pool(pack_trajectory,tasks,workers),1):
+        if error is not None:
+            print('Failed render path:{0} {1}'.format(task[0],error))
+            failures.append(task[0])
+        else:
+            total_packed += packed
+        print_progress(done,len(tasks),total_packed,start_time,('frames packed',total_packed))
+    return failures
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Packs the depth, instance and photo frames of each trajectory into memory mappable files')
+    parser.add_argument('protobuf_path', help='e.g. data/scenenet_rgbd_val.pb')
+    parser.add_argument('data_root_path', help='e.g. data/val')
+    parser.add_argument('--store-root', help='Write the stores under this directory rather than the dataset')
+    parser.add_argument('--no-photos', action='store_true', help='Only pack the depth and instance frames')
+    parser.add_argument('--force', action='store_true', help='Repack trajectories that are already packed')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes, the work is split by trajectory')
+    args = parser.parse_args()
+    failures = pack_split(args.protobuf_path,args.data_root_path,store_root=args.store_root,
+                          photos=not args.no_photos,force=args.force,workers=args.workers)
+    if failures:
+        print('Failed to pack {0} trajectories'.format(len(failures)))
+        sys.exit(1)
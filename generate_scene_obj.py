@@ -6,6 +6,9 @@ import sys
 import os
 import numpy
 import random
+from obj_mesh import format_obj_mesh, load_obj_mesh, merge_mesh_parts, obj_mesh_triangles, save_mesh_npz, save_mesh_ply
+from trajectory_index import IndexedTrajectories
+from trajectory_pool import run_trajectory_pool
 
 import argparse
 
@@ -16,55 +19,54 @@ parser.add_argument('--materials', action='store_true')
 parser.add_argument('--v1', action='store_true', help="Models are using ShapeNet v1 repo rather than v2")
 parser.add_argument('--shapenet-dir')
 parser.add_argument('--layout-dir')
+parser.add_argument('--mesh-cache-dir', help="Directory in which parsed ShapeNet models are cached between runs")
+parser.add_argument('--formats', default='obj',
+                    help="Comma separated output formats from obj, ply (binary) and npz. The ply and npz "
+                         "meshes are triangulated and store the instance_id of each face")
+parser.add_argument('--jobs', type=int, default=1, help="Number of trajectories to convert in parallel processes")
 parser.add_argument('--ids', help="The indices of the trajectories to choose, comma separated,"
                                   "if empty, then all trajectories are processed")
 parser.add_argument('protobuf')
 
 
 def get_bounding_box(shapenet_path):
-    shapenet_obj_file = open(shapenet_path, "r")
-    vertices = []
-    for l in shapenet_obj_file:
-        if l.startswith('v '):
-            s = l[2:].split()
-            x = float(s[0])
-            y = float(s[1])
-            z = float(s[2])
-            vertices.append([x, y, z])
-    min_x = min([v[0] for v in vertices])
-    max_x = max([v[0] for v in vertices])
-    min_y = min([v[1] for v in vertices])
-    max_y = max([v[1] for v in vertices])
-    min_z = min([v[2] for v in vertices])
-    max_z = max([v[2] for v in vertices])
-    return min_x, max_x, min_y, max_y, min_z, max_z
-
-
-def load_obj(shapenet_dir, instance, suffix):
+    return load_obj_mesh(shapenet_path)['bbox']
+
+
+def load_obj(shapenet_dir, instance, suffix, v1=False):
     shapenet_id = instance.object_info.shapenet_hash
     # As of v2 preference is given to the model_normalized naming convention
     shapenet_obj_path = os.path.join(shapenet_dir, shapenet_id, 'models', 'model_normalized.' + suffix)
     if not os.path.isfile(shapenet_obj_path):
-        if not args.v1:
+        if not v1:
             print('Cannot find normalized model. Most likely using ShapeNet.v1 - try running script with --v1 flag. Missing object at path:{0} trying secondary location...'.format(shapenet_obj_path))
         shapenet_obj_path = os.path.join(shapenet_dir, shapenet_id, 'model.' + suffix)
         if not os.path.isfile(shapenet_obj_path):
-            print('ShapeNet object not found at path:{0}'.format(shapenet_obj_path))
-            sys.exit(1)
-    elif args.v1:
+            # Only the trajectory using this object fails, not the whole batch
+            raise IOError('ShapeNet object not found at path:{0}'.format(shapenet_obj_path))
+    elif v1:
         print('This looks like a ShapeNet.v2 model with the name "model_normalized.obj", consider running without the v1 flag')
     return shapenet_obj_path
 
 
 # Given offsets for (v, vn, vv)
-# Merges scenenet object into the combined `merge_into_file` obj file
-def merge_scenenet_obj(output_obj_file, shapenet_dir, instance, k, offsets):
-    num_v = 0
-    num_vt = 0
-    num_vn = 0
+# Merges scenenet object into the combined `merge_into_file` obj file, which can
+# be None if only mesh_parts are needed.  If mesh_parts is a list, the
+# transformed (vertices, triangles, instance_id) of the object are appended.
+def merge_scenenet_obj(output_obj_file, shapenet_dir, instance, k, offsets, v1=False, mesh_cache_dir=None,
+                       mesh_parts=None):
     offset_v, offset_vt, offset_vn = offsets
 
-    input_path = load_obj(shapenet_dir, instance, suffix="obj")
+    input_path = load_obj(shapenet_dir, instance, suffix="obj", v1=v1)
+
+    # The obj is only read and parsed once per run (or once overall with a
+    # mesh cache directory), however many instances use the model
+    mesh = load_obj_mesh(input_path, instance.object_info.shapenet_hash, mesh_cache_dir)
+    vertices = mesh['vertices']
+    normals = mesh['normals']
+    num_v = len(vertices)
+    num_vn = len(normals)
+    num_vt = mesh['num_vt']
 
     height = instance.object_info.height_meters
     i = instance.object_info.object_pose
@@ -74,76 +76,31 @@ def merge_scenenet_obj(output_obj_file, shapenet_dir, instance, k, offsets):
         [i.rotation_mat21, i.rotation_mat22, i.rotation_mat23],
         [i.rotation_mat31, i.rotation_mat32, i.rotation_mat33],
     ])
-    bb = get_bounding_box(input_path)
+    bb = mesh['bbox']
     centroid = numpy.array(
         [bb[0] + ((bb[1] - bb[0]) / 2.0), bb[2] + ((bb[3] - bb[2]) / 2.0), bb[4] + ((bb[5] - bb[4]) / 2.0)])
     centroid[1] -= 0.6 * (bb[3] - bb[2])
 
-    input_file = open(input_path, 'r')
-    output_obj_file.write('o rand_obj.%d\n' % k)
-    for l in input_file:
-        if l.startswith('v '):
-            num_v += 1
-            s = l[2:].split()
-            x = float(s[0])
-            y = float(s[1])
-            z = float(s[2])
-            p = numpy.array([x, y, z])
-
-            if args.v1:
-                tmp = p[0]
-                p[0] = p[2]
-                p[2] = -tmp
-
-            p = (p - centroid) * (height / (bb[3] - bb[2]))
-            p = R.dot(p) + T
-            output_obj_file.write('v %f %f %f\n' % (p[0], p[1], p[2]))
-        elif l.startswith('vt '):
-            num_vt += 1
-            output_obj_file.write(l)
-        elif l.startswith('vn '):
-            num_vn += 1
-            s = l[2:].split()
-            x = float(s[0])
-            y = float(s[1])
-            z = float(s[2])
-            n = numpy.array([x, y, z])
-            n = R.dot(n)
-            output_obj_file.write('vn %f %f %f\n' % (n[0],n[1],n[2]))
-        elif l.startswith('f '):
-            s = 'f'
-            for p in l[2:].split():
-                s += ' '
-                if '/' in p:
-                    # face statement is 'f v/vt/vn v/vt/vn v/vt/vn'
-                    try:
-                        vid_s, vtid_s, vnid_s = p.split('/')
-                    except ValueError:
-                        # This is for compatibility with some v1 object models
-                        vid_s, vtid_s = p.split('/')
-                        vnid_s = None
-                    s += str(int(vid_s) + offset_v)
-                    s += '/'
-                    if vtid_s:  # If there is a vertex texture
-                        s += str(int(vtid_s) + offset_vt)
-                    s += '/'
-                    if vnid_s:  # If there is a vertex normal
-                        s += str(int(vnid_s) + offset_vn)
-                else:
-                    s += str(int(p) + offset_v)
-            output_obj_file.write(s + '\n')
-        elif l.startswith('mtllib '):
-            # pass, as we combine all materials
-            pass
-        else:
-            output_obj_file.write(l)
+    if v1:
+        vertices = numpy.stack((vertices[:, 2], vertices[:, 1], -vertices[:, 0]), axis=1)
+
+    vertices = (vertices - centroid) * (height / (bb[3] - bb[2]))
+    # R p for each vertex as its own (3,3) by (3,1) product, the same sums in
+    # the same order as the per-vertex R.dot(p) that the obj output matches
+    vertices = numpy.matmul(R, vertices[:, :, numpy.newaxis])[:, :, 0] + T
+    normals = numpy.matmul(R, normals[:, :, numpy.newaxis])[:, :, 0]
+
+    if output_obj_file is not None:
+        output_obj_file.write('o rand_obj.%d\n' % k)
+        output_obj_file.write(''.join(format_obj_mesh(mesh, vertices, normals, offset_v, offset_vt, offset_vn)))
+    if mesh_parts is not None:
+        mesh_parts.append((vertices, obj_mesh_triangles(mesh), instance.instance_id))
 
-    input_file.close()
     return [offset_v + num_v, offset_vt + num_vt, offset_vn + num_vn]
 
 
-def merge_scenenet_mtl(output_mtl_file, shapenet_dir, instance, k):
-    input_path = load_obj(shapenet_dir, instance, suffix="mtl")
+def merge_scenenet_mtl(output_mtl_file, shapenet_dir, instance, k, v1=False):
+    input_path = load_obj(shapenet_dir, instance, suffix="mtl", v1=v1)
     input_file = open(input_path, 'r')
     output_mtl_file.write('# Material copied for shape %d from %s\n' % (k, input_path))
     for l in input_file:
@@ -155,90 +112,156 @@ def merge_scenenet_mtl(output_mtl_file, shapenet_dir, instance, k):
             output_mtl_file.write(l)
 
 
-def convert_trajectory(i, traj, shapenet_dir, layout_dir):
-    out_name = "trajectory_%d" % i
+# Faces of the layout are given this instance id in the binary mesh outputs, as
+# the layout obj has no correspondence to the layout instances
+LAYOUT_INSTANCE_ID = -1
+
+OUTPUT_FORMATS = ['obj', 'ply', 'npz']
 
-    layout_path = traj.layout.model
-    layout_file = open(os.path.join(layout_dir, layout_path), 'r')
 
+def convert_trajectory(i, traj, shapenet_dir, layout_dir, materials=False, v1=False, mesh_cache_dir=None,
+                       formats=('obj',)):
+    out_name = "trajectory_%d" % i
+
+    output_filenames = [out_name + '.' + output_format for output_format in formats]
     output_obj_filename = out_name + '.obj'
     output_mtl_filename = out_name + '.mtl'
-    output_obj_file = open(output_obj_filename, 'w')
-
-    output_mtl_file = None
-    if args.materials:
-        output_mtl_file = open(output_mtl_filename, 'w')
 
     offset_v = 0
     offset_vt = 0
     offset_vn = 0
 
-    print('Producing complete obj for render path:{0} outputting to:{1}'.format(traj.render_path, output_obj_filename))
-
-    # Write out the layout obj file
-    for l in layout_file:
-        if l.startswith('v '):
-            offset_v += 1
-        elif l.startswith('vt '):
-            offset_vt += 1
-        elif l.startswith('vn '):
-            offset_vn += 1
-        output_obj_file.write(l)
-
-    layout_file.close()
-
-    if args.materials:
-        output_obj_file.write('mtllib %s\n' % output_mtl_filename)
-
-    offsets = [offset_v, offset_vt, offset_vn]
-
-    # TODO: Read in the layout mtl file, and assign random texture
-    # While the mtl files from the layout obj are re-used,
-    # We combine all other mtl files form the meshes into one.
-    for k, instance in enumerate(traj.instances):
-        # Add the instance object obj mesh to the combined scene
-        if instance.instance_type == sn.Instance.RANDOM_OBJECT:
-            offsets = merge_scenenet_obj(output_obj_file, shapenet_dir, instance, k, offsets)
-            if args.materials:
-                merge_scenenet_mtl(output_mtl_file, shapenet_dir, instance, k)
-
-    output_obj_file.close()
-    if args.materials:
+    print('Producing complete scene for render path:{0} outputting to:{1}'.format(traj.render_path, ','.join(output_filenames)))
+
+    output_obj_file = None
+    if 'obj' in formats:
+        output_obj_file = open(output_obj_filename, 'w')
+    output_mtl_file = None
+    if materials:
+        output_mtl_file = open(output_mtl_filename, 'w')
+        output_filenames.append(output_mtl_filename)
+
+    # The binary formats are built from the same transformed vertices as the obj
+    mesh_parts = None
+    if 'ply' in formats or 'npz' in formats:
+        mesh_parts = []
+
+    try:
+        layout_path = os.path.join(layout_dir, traj.layout.model)
+        if output_obj_file is not None:
+            # Write out the layout obj file
+            with open(layout_path, 'r') as layout_file:
+                for l in layout_file:
+                    if l.startswith('v '):
+                        offset_v += 1
+                    elif l.startswith('vt '):
+                        offset_vt += 1
+                    elif l.startswith('vn '):
+                        offset_vn += 1
+                    output_obj_file.write(l)
+
+            if materials:
+                output_obj_file.write('mtllib %s\n' % output_mtl_filename)
+        if mesh_parts is not None:
+            layout_mesh = load_obj_mesh(layout_path)
+            mesh_parts.append((layout_mesh['vertices'], obj_mesh_triangles(layout_mesh), LAYOUT_INSTANCE_ID))
+
+        offsets = [offset_v, offset_vt, offset_vn]
+
+        # TODO: Read in the layout mtl file, and assign random texture
+        # While the mtl files from the layout obj are re-used,
+        # We combine all other mtl files form the meshes into one.
+        for k, instance in enumerate(traj.instances):
+            # Add the instance object obj mesh to the combined scene
+            if instance.instance_type == sn.Instance.RANDOM_OBJECT:
+                offsets = merge_scenenet_obj(output_obj_file, shapenet_dir, instance, k, offsets,
+                                             v1=v1, mesh_cache_dir=mesh_cache_dir, mesh_parts=mesh_parts)
+                if materials:
+                    merge_scenenet_mtl(output_mtl_file, shapenet_dir, instance, k, v1=v1)
+
+        if mesh_parts is not None:
+            vertices, triangles, instance_ids = merge_mesh_parts(mesh_parts)
+            if 'ply' in formats:
+                save_mesh_ply(out_name + '.ply', vertices, triangles, instance_ids,
+                              comment='render_path %s' % traj.render_path)
+            if 'npz' in formats:
+                save_mesh_npz(out_name + '.npz', vertices, triangles, instance_ids)
+    except Exception:
+        # Do not leave a partial scene behind
+        for output_file in (output_obj_file, output_mtl_file):
+            if output_file is not None:
+                output_file.close()
+        for output_filename in output_filenames:
+            if os.path.isfile(output_filename):
+                os.remove(output_filename)
+        raise
+
+    if output_obj_file is not None:
+        output_obj_file.close()
+    if materials:
         output_mtl_file.close()
 
 
-def main(protobuf_path, shapenet_dir, layout_dir, indices):
-    trajectories_pb = sn.Trajectories()
+# Converts a serialized trajectory, so that workers are only sent the bytes
+# of their own trajectory
+def convert_trajectory_bytes(index, trajectory_bytes, shapenet_dir, layout_dir, options):
+    traj = sn.Trajectory()
+    traj.ParseFromString(trajectory_bytes)
+    convert_trajectory(index, traj, shapenet_dir, layout_dir, **options)
+
+
+def main(protobuf_path, shapenet_dir, layout_dir, indices, materials=False, v1=False,
+         mesh_cache_dir=None, jobs=1, formats=('obj',)):
     try:
-        with open(protobuf_path, 'rb') as f:
-            trajectories_pb.ParseFromString(f.read())
+        trajectories = IndexedTrajectories(protobuf_path)
     except IOError:
         print('Scenenet protobuf data not found at location:{0}'.format(protobuf_path))
         raise
 
-    trajectories = trajectories_pb.trajectories
+    if not indices:
+        indices = range(len(trajectories))
 
-    if indices:
-        trajectories = [(i,trajectories[i]) for i in indices]
-    else:
-        trajectories = [(i,trajectory) for i,trajectory in enumerate(trajectories)]
+    options = {'materials': materials, 'v1': v1, 'mesh_cache_dir': mesh_cache_dir, 'formats': formats}
+    tasks = [(index, trajectories.trajectory_bytes(index), shapenet_dir, layout_dir, options) for index in indices]
+    failures = []
+    for done, ((index, _, _, _, _), _, error) in enumerate(run_trajectory_pool(convert_trajectory_bytes, tasks, jobs), 1):
+        render_path = trajectories.render_paths[index]
+        if error is None:
+            print('[{0}/{1}] Finished trajectory_{2} render path:{3}'.format(done, len(indices), index, render_path))
+        else:
+            print('[{0}/{1}] Failed trajectory_{2} render path:{3} {4}'.format(done, len(indices), index, render_path, error))
+            failures.append(index)
 
-    for index,traj in trajectories:
-        convert_trajectory(index, traj, shapenet_dir, layout_dir)
+    if failures:
+        print('Scene Generation Complete with {0} failed trajectories:{1}'.format(
+            len(failures), ','.join(str(index) for index in sorted(failures))))
+        return False
     print('Scene Generation Complete')
+    return True
 
 
 if __name__ == '__main__':
     args = parser.parse_args()
 
     ids = [int(i) for i in args.ids.split(",")] if args.ids else None
+    formats = args.formats.split(",")
+    for output_format in formats:
+        if output_format not in OUTPUT_FORMATS:
+            parser.error('Unknown output format:{0}, choose from {1}'.format(output_format, ','.join(OUTPUT_FORMATS)))
     data_dir = os.path.dirname(args.protobuf)
 
     # The usual ScenenetRGBD paths
-    main(
+    success = main(
         protobuf_path=args.protobuf,
         # Sign up and download the ShapeNetCore.v1 dataset (https://www.shapenet.org/) extract to the path below
         shapenet_dir=args.shapenet_dir or os.path.join(data_dir, 'ShapeNetCore.v2'),
         # Clone the layouts for our dataset (https://github.com/jmccormac/SceneNetRGBD_Layouts.git) to the path below
         layout_dir=args.layout_dir or os.path.join(data_dir, 'SceneNetRGBD_Layouts'),
-        indices=ids)
+        indices=ids,
+        materials=args.materials,
+        v1=args.v1,
+        mesh_cache_dir=args.mesh_cache_dir,
+        jobs=args.jobs,
+        formats=formats)
+    if not success:
+        sys.exit(1)
@@ -0,0 +1,191 @@
+from atomic_files import save_array_atomic
+import functools
+import math
+import numpy as np
+import os
+import profiling
+
+# Camera intrinsics used for all of the SceneNet RGB-D renders
+DEFAULT_WIDTH = 320
+DEFAULT_HEIGHT = 240
+DEFAULT_HFOV = 60
+DEFAULT_VFOV = 45
+
+RAY_CACHE_SIZE = 8
+
+def pixel_to_ray(pixel,vfov=45,hfov=60,pixel_width=320,pixel_height=240):
+    x, y = pixel
+    x_vect = math.tan(math.radians(hfov/2.0)) * ((2.0 * ((x+0.5)/pixel_width)) - 1.0)
+    y_vect = math.tan(math.radians(vfov/2.0)) * ((2.0 * ((y+0.5)/pixel_height)) - 1.0)
+    return (x_vect,y_vect,1.0)
+
+# Closed form version of pixel_to_ray over every pixel of the image, this
+# returns the normalised ray directions as a (height,width,3) array.
+def pixel_to_ray_grid(width=DEFAULT_WIDTH,height=DEFAULT_HEIGHT,hfov=DEFAULT_HFOV,
+                      vfov=DEFAULT_VFOV,dtype=np.float64):
+    x_vect = math.tan(math.radians(hfov/2.0)) * ((2.0 * ((np.arange(width)+0.5)/width)) - 1.0)
+    y_vect = math.tan(math.radians(vfov/2.0)) * ((2.0 * ((np.arange(height)+0.5)/height)) - 1.0)
+    rays = np.ones((height,width,3))
+    rays[:,:,0], rays[:,:,1] = np.meshgrid(x_vect,y_vect)
+    rays /= np.linalg.norm(rays,axis=2,keepdims=True)
+    return rays.astype(dtype,copy=False)
+
+def ray_array_filename(width,height,hfov,vfov,dtype):
+    return 'pixel_to_ray_{0}x{1}_hfov{2}_vfov{3}_{4}.npy'.format(width,height,hfov,vfov,np.dtype(dtype).name)
+
+@functools.lru_cache(maxsize=RAY_CACHE_SIZE)
+def _cached_ray_array(width,height,hfov,vfov,dtype_name,cache_dir):
+    if cache_dir is not None:
+        path = os.path.join(cache_dir,ray_array_filename(width,height,hfov,vfov,dtype_name))
+        if not os.path.isfile(path):
+            save_array_atomic(path,pixel_to_ray_grid(width,height,hfov,vfov,dtype_name))
+        # A read only memory map lets a pool of workers share the same pages
+        return np.load(path,mmap_mode='r')
+    rays = pixel_to_ray_grid(width,height,hfov,vfov,dtype_name)
+    rays.flags.writeable = False
+    return rays
+
+# This stores for each image pixel, the cameras normalised 3D ray vector.  The
+# arrays are memoized per (width,height,hfov,vfov,dtype) and are returned read
+# only, so copy them before modifying in place.  If cache_dir is given the grid
+# is persisted there as a .npy file and memory mapped on subsequent calls.
+def normalised_pixel_to_ray_array(width=DEFAULT_WIDTH,height=DEFAULT_HEIGHT,hfov=DEFAULT_HFOV,
+                                  vfov=DEFAULT_VFOV,dtype=np.float64,cache_dir=None):
+    return _cached_ray_array(width,height,hfov,vfov,np.dtype(dtype).name,cache_dir)
+
+def normalize_rows(v):
+    return v/np.linalg.norm(v,axis=-1,keepdims=True)
+
+# Batched version of interpolate_poses.  Expects (N,3) start and end positions
+# (camera or lookat) and an alpha that is either a scalar or one per row, and
+# returns the (N,3) interpolated positions.
+def interpolate_pose_arrays(start,end,alpha):
+    alpha = np.asarray(alpha,dtype=np.float64)
+    assert np.all(alpha >= 0.0)
+    assert np.all(alpha <= 1.0)
+    if alpha.ndim == 1:
+        alpha = alpha[:,np.newaxis]
+    interpolated = alpha * end
+    interpolated += (1.0 - alpha) * start
+    return interpolated
+
+# Returns the (N,3,3) camera rotations for (N,3) camera and lookat positions.
+# The rows are the camera x, y and z axes in world coordinates, following
+# world_to_camera_with_pose with the world up vector [0,1,0].
+def camera_rotations(camera,lookat):
+    camera = np.asarray(camera,dtype=np.float64)
+    lookat = np.asarray(lookat,dtype=np.float64)
+    up = np.array([0,1,0])
+    R = np.empty(camera.shape[:-1] + (3,3))
+    R[...,2,:] = normalize_rows(lookat - camera)
+    R[...,0,:] = normalize_rows(np.cross(R[...,2,:],up))
+    R[...,1,:] = -normalize_rows(np.cross(R[...,0,:],R[...,2,:]))
+    return R
+
+def world_to_camera_from_rotations(R,camera):
+    transforms = np.zeros(R.shape[:-2] + (4,4))
+    transforms[...,:3,:3] = R
+    transforms[...,:3,3] = -np.einsum('...ij,...j->...i',R,camera)
+    transforms[...,3,3] = 1.0
+    return transforms
+
+# As the rotation is orthonormal the inverse is in closed form, the transposed
+# rotation and the camera position
+def camera_to_world_from_rotations(R,camera):
+    transforms = np.zeros(R.shape[:-2] + (4,4))
+    transforms[...,:3,:3] = np.swapaxes(R,-1,-2)
+    transforms[...,:3,3] = camera
+    transforms[...,3,3] = 1.0
+    return transforms
+
+# Batched version of world_to_camera_with_pose, returning (N,4,4) transforms
+def world_to_camera_batch(camera,lookat):
+    return world_to_camera_from_rotations(camera_rotations(camera,lookat),camera)
+
+# Batched version of camera_to_world_with_pose, returning (N,4,4) transforms
+def camera_to_world_batch(camera,lookat):
+    return camera_to_world_from_rotations(camera_rotations(camera,lookat),camera)
+
+# Returns the interpolated (N,4,4) world to camera and camera to world
+# transforms for (N,2,3) shutter open/close camera and lookat positions, i.e.
+# the layout of the columns in the pose table.  An alpha of 0.5 is the pose at
+# which the ground truth depth and instance renders are taken.
+def extrinsics_from_shutter_poses(camera,lookat,alpha=0.5):
+    camera = interpolate_pose_arrays(camera[...,0,:],camera[...,1,:],alpha)
+    lookat = interpolate_pose_arrays(lookat[...,0,:],lookat[...,1,:],alpha)
+    R = camera_rotations(camera,lookat)
+    return world_to_camera_from_rotations(R,camera), camera_to_world_from_rotations(R,camera)
+
+# Returns the (N,H,W,3) camera space points of an (N,H,W) depth stack, i.e.
+# depth times the normalised ray of each pixel.  depth_scale converts the
+# depth values to metres, e.g. 0.001 for the uint16 millimetre depth pngs.
+def depth_to_camera_points(depth,depth_scale=1.0,dtype=np.float64,rays=None,out=None):
+    depth = np.asarray(depth)
+    if rays is None:
+        rays = normalised_pixel_to_ray_array(width=depth.shape[-1],height=depth.shape[-2],dtype=dtype)
+    if out is None:
+        out = np.empty(depth.shape + (3,),dtype=dtype)
+    with profiling.stage('points_in_camera_coords',frames=len(depth) if depth.ndim == 3 else 1):
+        np.multiply(np.multiply(depth,depth_scale,dtype=dtype)[...,np.newaxis],rays,out=out)
+    return out
+
+# Projects an (N,H,W) depth stack into world space with an (N,4,4) stack of
+# camera to world transforms (e.g. from extrinsics_from_shutter_poses),
+# returning (N,H,W,3) points.  As the depth scales the unit rays, each world
+# point is depth * (R ray) + t, so the rays are rotated for every frame with a
+# single batched matmul and no homogeneous copies of the points are made.
+#
+# out, if given, is an (N,H,W,3) array of the requested dtype that is filled
+# in place, through a contiguous buffer if it is not C contiguous.  Pixels
+# with zero depth (no surface, e.g. through a window) end up at the camera
+# centre, with return_mask=True an (N,H,W) boolean mask of the valid pixels
+# is also returned.
+def depth_to_world_points(depth,camera_to_world,depth_scale=1.0,dtype=np.float64,rays=None,out=None,
+                          return_mask=False):
+    depth = np.asarray(depth)
+    if depth.ndim == 2:
+        depth = depth[np.newaxis]
+    camera_to_world = np.asarray(camera_to_world).reshape(-1,4,4)
+    num_frames, height, width = depth.shape
+    assert len(camera_to_world) == num_frames
+    if rays is None:
+        rays = normalised_pixel_to_ray_array(width=width,height=height,dtype=dtype)
+    if out is None:
+        out = np.empty((num_frames,height,width,3),dtype=dtype)
+    assert out.shape == (num_frames,height,width,3)
+    rotations = camera_to_world[:,:3,:3].astype(dtype,copy=False)
+    translations = camera_to_world[:,:3,3].astype(dtype,copy=False)
+    with profiling.stage('transform_points',frames=num_frames):
+        # Reshaping a non contiguous out would silently give a copy
+        points = out if out.flags.c_contiguous else np.empty(out.shape,dtype=out.dtype)
+        # (H*W,3) rays times each (3,3) R^T gives the rotated rays of every frame
+        flat_points = points.reshape(num_frames,height * width,3)
+        np.matmul(rays.reshape(height * width,3),np.swapaxes(rotations,-1,-2),out=flat_points)
+        points *= np.multiply(depth,depth_scale,dtype=dtype)[...,np.newaxis]
+        points += translations[:,np.newaxis,np.newaxis,:]
+        if points is not out:
+            out[...] = points
+    if return_mask:
+        return out, depth > 0
+    return out
+
+# Fuses a depth stack into a single (M,3) world space point cloud of the valid
+# (non-zero depth) pixels, processing chunk_size frames at a time so that the
+# intermediate (chunk,H,W,3) buffer is reused.
+def depth_to_point_cloud(depth,camera_to_world,depth_scale=1.0,dtype=np.float32,chunk_size=32):
+    depth = np.asarray(depth)
+    if depth.ndim == 2:
+        depth = depth[np.newaxis]
+    camera_to_world = np.asarray(camera_to_world).reshape(-1,4,4)
+    num_frames, height, width = depth.shape
+    buffer = np.empty((min(chunk_size,num_frames),height,width,3),dtype=dtype)
+    clouds = []
+    for start in range(0,num_frames,chunk_size):
+        end = min(start + chunk_size,num_frames)
+        points, valid = depth_to_world_points(depth[start:end],camera_to_world[start:end],
+                                              depth_scale=depth_scale,dtype=dtype,
+                                              out=buffer[:end - start],return_mask=True)
+        clouds.append(points[valid])
+    if not clouds:
+        return np.empty((0,3),dtype=dtype)
+    return np.concatenate(clouds)
@@ -1,9 +1,15 @@
+import argparse
 from collections import namedtuple
 import numpy as np
+import os
 import pathlib
 import re
 import scenenet_pb2 as sn
 import sys
+import time
+from trajectory_index import trajectory_record
+from trajectory_pool import run_trajectory_pool
+from trajectory_stream import TrajectoryStreamWriter
 
 PoseData = namedtuple('PoseData', ['time', 'camera_position', 'camera_lookat'])
 
@@ -72,27 +78,75 @@ def process_objects_into_instances(layout_lines):
         objects.append(current_object)
     return objects
 
+POSE_LINE_REGEX = re.compile("time:([e\.\-\d]+) pose:([e\.\-\d]+),([e\.\-\d]+),([e\.\-\d]+) lookat:([e\.\-\d]+),([e\.\-\d]+),([e\.\-\d]+)")
+
+# Columns of the pose array, i.e. time, camera position xyz and lookat xyz
+POSE_COLUMNS = 7
+
+# Deleting the characters POSE_LINE_REGEX accepts in numbers, the commas and
+# the line ending leaves only this of a 'time:t pose:x,y,z lookat:x,y,z' line
+POSE_NUMBER_CHARACTERS = str.maketrans('', '', '0123456789.-e,\r\n')
+POSE_LINE_LABELS = 'tim: pos: lookat:'
+
+# Whether every line is of the plain form written by the renderer, with only
+# numbers the regex matches (so no '+' exponents, nan or inf, which float()
+# would accept but the regex skips)
+def are_plain_pose_lines(pose_lines):
+    text = ''.join(pose_lines)
+    return (text.count(',') == 4 * len(pose_lines) and
+            text.translate(POSE_NUMBER_CHARACTERS) == POSE_LINE_LABELS * len(pose_lines))
+
+# Converts 'time:t pose:x,y,z lookat:x,y,z' lines into an (N,7) array by
+# splitting all of them on their separators at once.  Raises ValueError if any
+# line is not in exactly that form or has a number that is not finite.
+def pose_lines_to_array(pose_lines):
+    fields = ','.join(pose_lines).replace('time:', '').replace(' pose:', ',').replace(' lookat:', ',').split(',')
+    if len(fields) != POSE_COLUMNS * len(pose_lines):
+        raise ValueError('Unexpected number of fields in pose lines')
+    poses = np.array(fields, dtype=np.float64).reshape(-1, POSE_COLUMNS)
+    if not np.isfinite(poses).all():
+        raise ValueError('Pose lines with numbers that are not finite')
+    return poses
+
+def regex_pose_lines_to_array(pose_lines):
+    fields = [POSE_LINE_REGEX.search(line).groups() for line in pose_lines]
+    return np.array(fields, dtype=np.float64).reshape(-1, POSE_COLUMNS)
+
+# Takes the pose lines in pairs (i.e. shutter open and shutter close) and keeps
+# only the pairs with a frame, without touching the rest.  Raises ValueError
+# for an odd number of lines, where the last shutter open has no close.
+def frame_pose_lines(pose_lines,skip_frames):
+    if len(pose_lines) % 2:
+        raise ValueError('Odd number of pose lines:{0}, the last pose has no shutter close'.format(len(pose_lines)))
+    shutter_open = pose_lines[0::2 * skip_frames]
+    shutter_close = pose_lines[1::2 * skip_frames]
+    return [line for pair in zip(shutter_open, shutter_close) for line in pair]
+
+# Returns an (M,2,7) array of the (shutter open, shutter close) poses of every
+# frame, where each pose is time, camera position xyz and lookat xyz.  The
+# frame skip is applied to the raw lines, so only the poses of rendered frames
+# are ever converted to floats.  Logs where every pose line is of the plain
+# 'time:... pose:... lookat:...' form written by the renderer take the fast
+# path, anything else falls back to matching each line with the regex.
+def parse_log_to_frame_pose_array(log_lines,skip_frames = 25):
+    pose_lines = [line for line in log_lines if ' lookat:' in line]
+    if len(pose_lines) % 2 == 0 and are_plain_pose_lines(pose_lines):
+        try:
+            poses = pose_lines_to_array(frame_pose_lines(pose_lines,skip_frames))
+            return poses.reshape(-1, 2, POSE_COLUMNS)
+        except ValueError:
+            pass
+    pose_lines = [line for line in pose_lines if POSE_LINE_REGEX.search(line)]
+    poses = regex_pose_lines_to_array(frame_pose_lines(pose_lines,skip_frames))
+    return poses.reshape(-1, 2, POSE_COLUMNS)
+
+def pose_data_from_row(row):
+    return PoseData(time=float(row[0]), camera_position=row[1:4], camera_lookat=row[4:7])
+
 def parse_log_to_frame_pose_pairs(log_lines,skip_frames = 25):
-    def chunks(l, n):
-        for i in range(0, len(l), n):
-            yield l[i:i + n]
-    regex = re.compile("time:([e\.\-\d]+) pose:([e\.\-\d]+),([e\.\-\d]+),([e\.\-\d]+) lookat:([e\.\-\d]+),([e\.\-\d]+),([e\.\-\d]+)")
-    time_center_lookats = []
-    # Get the list of poses
-    for line in log_lines:
-        m = regex.search(line)
-        if m is not None:
-            time_center_lookat = PoseData(time=float(m.group(1)),
-                                            camera_position=np.array([float(m.group(i)) for i in range(2, 5)]),
-                                            camera_lookat=np.array([float(m.group(i)) for i in range(5, 8)]))
-            time_center_lookats.append(time_center_lookat)
-    # Take them in pairs (i.e. time and pose of shutter open, time and pose of shutter close),
-    # and filter out poses without a frame - using the pose_frame_skip info
-    frame_pose_pair_list = []
-    for idx,(shutter_open, shutter_close) in enumerate(chunks(time_center_lookats,2)):
-        if idx % skip_frames == 0:
-            frame_pose_pair_list.append((shutter_open,shutter_close))
-    return frame_pose_pair_list
+    frame_poses = parse_log_to_frame_pose_array(log_lines,skip_frames)
+    return [(pose_data_from_row(shutter_open),pose_data_from_row(shutter_close))
+            for shutter_open,shutter_close in frame_poses]
 
 def get_instances(info_lines):
     instances = []
@@ -225,20 +279,131 @@ def fill_trajectory(info_lines,layout_lines,trajectory,frame_skip=25):
         shutter_close_pose.lookat.z = shutter_close.camera_lookat[2]
         shutter_close_pose.timestamp = shutter_close.time
 
+RENDER_LOG_NAME = 'render_info.log'
+LAYOUT_DESCRIPTION_NAME = 'scene_and_trajectory_description.txt'
+
+# A (render log, layout description, render path) conversion task per
+# trajectory, found by walking a tree of render directories.  The render path
+# is the directory relative to the root, as in the released data (e.g. 0/223).
+def tasks_from_render_tree(root_dir,layout_name=LAYOUT_DESCRIPTION_NAME):
+    tasks = []
+    for dir_path, dir_names, file_names in os.walk(root_dir):
+        dir_names.sort()
+        if RENDER_LOG_NAME in file_names:
+            tasks.append((os.path.join(dir_path,RENDER_LOG_NAME),
+                          os.path.join(dir_path,layout_name),
+                          os.path.relpath(dir_path,root_dir)))
+    return tasks
+
+# Each non empty line of the manifest is 'render_log layout_description' with
+# an optional third column giving the render path, otherwise it is the
+# directory of the render log
+def tasks_from_manifest(manifest_path):
+    tasks = []
+    with open(manifest_path,'r') as f:
+        for line_num, line in enumerate(f, 1):
+            columns = line.split()
+            if not columns or columns[0].startswith('#'):
+                continue
+            if len(columns) == 2:
+                columns.append(str(pathlib.Path(columns[0]).parent))
+            if len(columns) != 3:
+                raise ValueError('Expected "render_log layout_description [render_path]" on line {0} of {1}'.format(line_num,manifest_path))
+            tasks.append(tuple(columns))
+    return tasks
+
+# Returns the serialized trajectory of a (render_log_path, layout_path,
+# render_path) task
+def convert_log(task,frame_skip=25):
+    render_log_path, layout_path, render_path = task
+    info_lines = get_info_log_lines(render_log_path)
+    layout_lines = get_text_layout_lines(layout_path)
+    trajectory = sn.Trajectory()
+    trajectory.render_path = render_path
+    fill_trajectory(info_lines,layout_lines,trajectory,frame_skip=frame_skip)
+    return trajectory.SerializeToString()
+
+def shard_path(output_path,shard):
+    base, ext = os.path.splitext(output_path)
+    return '{0}_{1}{2}'.format(base,shard,ext)
+
+# Converts every task, writing the trajectories (in task order) to output_path,
+# or to output_path with a _0, _1, ... suffix holding shard_size trajectories
+# each.  With stream=True the outputs are trajectory stream files (see
+# trajectory_stream.py) rather than Trajectories messages.  Returns the list of
+# (render_log_path, error) failures.
+def convert_logs(tasks,output_path,shard_size=None,workers=1,frame_skip=25,stream=False):
+    start_time = time.time()
+    # In task order, so that the trajectories are written in that order
+    results = run_trajectory_pool(convert_log,[(task,frame_skip) for task in tasks],workers,ordered=True,chunksize=4)
+    failures = []
+    output_file = None
+    output_paths = []
+    num_in_shard = 0
+    num_written = 0
+    try:
+        for done, (((render_log_path,_,_),_), trajectory_bytes, error) in enumerate(results, 1):
+            if error is not None:
+                print('[{0}/{1}] Failed log:{2} {3}'.format(done,len(tasks),render_log_path,error))
+                failures.append((render_log_path,error))
+                continue
+            if output_file is None or (shard_size and num_in_shard == shard_size):
+                if output_file is not None:
+                    output_file.close()
+                path = shard_path(output_path,len(output_paths)) if shard_size else output_path
+                output_file = TrajectoryStreamWriter(path) if stream else open(path,'wb')
+                output_paths.append(path)
+                num_in_shard = 0
+            output_file.write(trajectory_bytes if stream else trajectory_record(trajectory_bytes))
+            num_in_shard += 1
+            num_written += 1
+            if done % 100 == 0 or done == len(tasks):
+                print('[{0}/{1}] Converted {2} logs ({3:.1f} logs/s)'.format(
+                    done,len(tasks),num_written,done / max(time.time() - start_time,1e-6)))
+    finally:
+        if output_file is not None:
+            output_file.close()
+    print('Wrote {0} trajectories to:{1}'.format(num_written,','.join(output_paths) or 'nothing'))
+    return failures
+
 if __name__ == '__main__':
-    trajectories = sn.Trajectories()
-    if len(sys.argv) < 3:
+    parser = argparse.ArgumentParser(description='Converts renderer logs and scene descriptions to a Trajectories protobuf')
+    parser.add_argument('render_log', nargs='?',
+                        help='/path/to/scenenetrgbd/renderer/build/render_info.log')
+    parser.add_argument('layout_description', nargs='?',
+                        help='/path/to/scenenetrgbd/camera_trajectory_generator/build/scene_and_trajectory_description.txt')
+    parser.add_argument('--render-root',
+                        help='Convert every directory below this one containing a {0} and {1}'.format(RENDER_LOG_NAME,LAYOUT_DESCRIPTION_NAME))
+    parser.add_argument('--manifest',
+                        help='File of "render_log layout_description [render_path]" lines to convert')
+    parser.add_argument('--layout-name', default=LAYOUT_DESCRIPTION_NAME,
+                        help='Name of the layout description in each directory with --render-root')
+    parser.add_argument('--output', default='./scenenet_metadata.pb')
+    parser.add_argument('--shard-size', type=int,
+                        help='Write shards of this many trajectories, OUTPUT_0.pb, OUTPUT_1.pb, ...')
+    parser.add_argument('--stream', action='store_true',
+                        help='Write a trajectory stream file rather than a single Trajectories message')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes parsing logs')
+    parser.add_argument('--frame-skip', type=int, default=25)
+    args = parser.parse_args()
+
+    if args.render_root:
+        tasks = tasks_from_render_tree(args.render_root,args.layout_name)
+    elif args.manifest:
+        tasks = tasks_from_manifest(args.manifest)
+    elif args.render_log and args.layout_description:
+        # A single trajectory, rendered in the log's directory
+        tasks = [(args.render_log,args.layout_description,str(pathlib.Path(args.render_log).parent))]
+    else:
         print('Please run as python logs_to_protobuf.py /path/to/scenenetrgbd/renderer/build/render_info.log /path/to/scenenetrgbd/camera_trajectory_generator/build/scene_and_trajectory_description.txt')
+        print('or with --render-root or --manifest to convert many trajectories')
         sys.exit(1)
-    # Here we add only one trajectory, but it can be a full list
-    render_log_path = sys.argv[1]
-    scene_and_trajectory_description_path = sys.argv[2]
-    info_lines = get_info_log_lines(render_log_path)
-    layout_lines = get_text_layout_lines(scene_and_trajectory_description_path)
-    trajectory = trajectories.trajectories.add()
-    trajectory.render_path = str(pathlib.Path(render_log_path).parent)
-    fill_trajectory(info_lines,layout_lines,trajectory)
-    output_path = './scenenet_metadata.pb'
-    print('Finished processing - writing to:{0}'.format(output_path))
-    with open(output_path,'wb') as f:
-        f.write(trajectories.SerializeToString())
+    print('Converting {0} trajectories'.format(len(tasks)))
+    failures = convert_logs(tasks,args.output,shard_size=args.shard_size,
+                            workers=args.workers,frame_skip=args.frame_skip,stream=args.stream)
+    if failures:
+        print('Finished processing with {0} failed logs:'.format(len(failures)))
+        for render_log_path, error in failures:
+            print('  {0} {1}'.format(render_log_path,error))
+        sys.exit(1)
+    print('Finished processing')
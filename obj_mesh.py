@@ -0,0 +1,387 @@
+# Parsing, caching and formatting of the ShapeNet obj models merged into the
+# scenes by generate_scene_obj.py
+
+from atomic_files import atomic_open
+import functools
+import itertools
+import numpy
+import os
+
+MESH_CACHE_SIZE = 64
+
+# A parsed obj is kept as a list of runs of consecutive lines of the same kind,
+# so that it can be written back out with the original line order
+RUN_VERTICES = 0
+RUN_NORMALS = 1
+RUN_FACES = 2
+# Face lines which do not share a single corner layout are kept as text
+RUN_FACE_LINES = 3
+# Any other lines, which are copied verbatim
+RUN_TEXT = 4
+
+
+def obj_line_kind(l):
+    if l.startswith('v '):
+        return 'v'
+    elif l.startswith('vt '):
+        return 'vt'
+    elif l.startswith('vn '):
+        return 'vn'
+    elif l.startswith('f '):
+        return 'f'
+    elif l.startswith('mtllib '):
+        return 'mtllib'
+    return None
+
+
+# Parses the x, y, z components of 'v ' or 'vn ' lines into an (N,3) array
+def parse_obj_vectors(lines):
+    return numpy.array([l[2:].split()[:3] for l in lines], dtype=numpy.float64).reshape(-1, 3)
+
+
+def bounding_box_of(vertices):
+    min_x, min_y, min_z = vertices.min(axis=0)
+    max_x, max_y, max_z = vertices.max(axis=0)
+    return min_x, max_x, min_y, max_y, min_z, max_z
+
+
+# Formats an (N,3) array as N obj lines in a single string operation
+def format_obj_vectors(prefix, vectors):
+    return ((prefix + ' %f %f %f\n') * len(vectors)) % tuple(vectors.ravel().tolist())
+
+
+def offset_obj_face(l, offset_v, offset_vt, offset_vn):
+    s = 'f'
+    for p in l[2:].split():
+        s += ' '
+        if '/' in p:
+            # face statement is 'f v/vt/vn v/vt/vn v/vt/vn'
+            try:
+                vid_s, vtid_s, vnid_s = p.split('/')
+            except ValueError:
+                # This is for compatibility with some v1 object models
+                vid_s, vtid_s = p.split('/')
+                vnid_s = None
+            s += str(int(vid_s) + offset_v)
+            s += '/'
+            if vtid_s:  # If there is a vertex texture
+                s += str(int(vtid_s) + offset_vt)
+            s += '/'
+            if vnid_s:  # If there is a vertex normal
+                s += str(int(vnid_s) + offset_vn)
+        else:
+            s += str(int(p) + offset_v)
+    return s + '\n'
+
+
+# Parses a block of face lines in which every corner has the same 'v', 'v/vt',
+# 'v/vt/vn' or 'v//vn' layout.  Returns a dict with the (corners,3) indices,
+# which of the v/vt/vn columns are present, the number of slashes per corner and
+# the number of corners per face, or None for any other block.
+def parse_obj_face_block(lines):
+    faces = [l.split()[1:] for l in lines]
+    corner_counts = [len(face) for face in faces]
+    if 0 in corner_counts:
+        return None
+    corners = list(itertools.chain.from_iterable(faces))
+    num_slashes = corners[0].count('/')
+    if num_slashes > 2 or any(corner.count('/') != num_slashes for corner in corners):
+        return None
+    fields = '/'.join(corners).split('/')
+    indices = numpy.zeros((len(corners), 3), dtype=numpy.int64)
+    columns = numpy.zeros(3, dtype=bool)
+    for column_idx in range(num_slashes + 1):
+        column = fields[column_idx::num_slashes + 1]
+        if column_idx > 0 and not any(column):
+            continue
+        if not all(column):
+            return None
+        indices[:, column_idx] = [int(field) for field in column]
+        columns[column_idx] = True
+    return {'indices': indices, 'columns': columns, 'num_slashes': num_slashes,
+            'corner_counts': numpy.array(corner_counts, dtype=numpy.int64)}
+
+
+# The inverse of parse_obj_face_block, with the offsets added to the indices.
+# This produces the same text as offset_obj_face for each line of the block.
+def format_obj_face_block(faces, offset_v, offset_vt, offset_vn):
+    columns = faces['columns']
+    corner_format = '/'.join(['%d' if present else '' for present in columns[:faces['num_slashes'] + 1]])
+    if faces['num_slashes'] == 1:
+        # 'v/vt' corners are written as 'v/vt/'
+        corner_format += '/'
+    face_formats = {}
+    for count in set(faces['corner_counts'].tolist()):
+        face_formats[count] = 'f ' + ' '.join([corner_format] * count) + '\n'
+    block_format = ''.join([face_formats[count] for count in faces['corner_counts'].tolist()])
+    indices = faces['indices'][:, columns] + numpy.array([offset_v, offset_vt, offset_vn])[columns]
+    return block_format % tuple(indices.ravel().tolist())
+
+
+# Returns the parsed mesh as a dict of:
+#   vertices, normals  (N,3) float64 arrays of the v and vn lines
+#   bbox               (min_x, max_x, min_y, max_y, min_z, max_z) of the vertices
+#   num_vt             the number of vt lines
+#   runs               list of (run kind, payload) in file order, where the
+#                      payload is the line count for vertices and normals, the
+#                      parsed block for faces and the text otherwise
+# 'mtllib' lines are dropped, as the materials of all meshes are combined
+def parse_obj_mesh(path):
+    with open(path, 'r') as input_file:
+        lines = input_file.readlines()
+    kinds = [obj_line_kind(l) for l in lines]
+    vertices = parse_obj_vectors([l for l, kind in zip(lines, kinds) if kind == 'v'])
+    normals = parse_obj_vectors([l for l, kind in zip(lines, kinds) if kind == 'vn'])
+    runs = []
+    for kind, group in itertools.groupby(zip(kinds, lines), key=lambda kind_line: kind_line[0]):
+        group_lines = [l for _, l in group]
+        if kind == 'v':
+            runs.append((RUN_VERTICES, len(group_lines)))
+        elif kind == 'vn':
+            runs.append((RUN_NORMALS, len(group_lines)))
+        elif kind == 'f':
+            faces = parse_obj_face_block(group_lines)
+            if faces is not None:
+                runs.append((RUN_FACES, faces))
+            else:
+                runs.append((RUN_FACE_LINES, ''.join(group_lines)))
+        elif kind == 'mtllib':
+            pass
+        else:
+            runs.append((RUN_TEXT, ''.join(group_lines)))
+    return {'vertices': vertices, 'normals': normals, 'bbox': bounding_box_of(vertices),
+            'num_vt': kinds.count('vt'), 'runs': runs}
+
+
+# Splits text back into lines as iterating over the file does, i.e. only at '\n'
+def split_obj_lines(text):
+    lines = [l + '\n' for l in text.split('\n')]
+    lines[-1] = lines[-1][:-1]
+    return [l for l in lines if l]
+
+
+# Formats the mesh with its (transformed) vertices and normals, and the face
+# indices offset by the given amounts, returning a list of text chunks
+def format_obj_mesh(mesh, vertices, normals, offset_v, offset_vt, offset_vn):
+    chunks = []
+    v_idx = 0
+    vn_idx = 0
+    for kind, payload in mesh['runs']:
+        if kind == RUN_VERTICES:
+            chunks.append(format_obj_vectors('v', vertices[v_idx:v_idx + payload]))
+            v_idx += payload
+        elif kind == RUN_NORMALS:
+            chunks.append(format_obj_vectors('vn', normals[vn_idx:vn_idx + payload]))
+            vn_idx += payload
+        elif kind == RUN_FACES:
+            chunks.append(format_obj_face_block(payload, offset_v, offset_vt, offset_vn))
+        elif kind == RUN_FACE_LINES:
+            chunks.extend(offset_obj_face(l, offset_v, offset_vt, offset_vn) for l in split_obj_lines(payload))
+        else:
+            chunks.append(payload)
+    return chunks
+
+
+# The on disk cache stores the runs as flat arrays, the text of all of the
+# runs is concatenated into a single utf-8 buffer
+def save_obj_mesh(cache_path, mesh, source_mtime):
+    runs = mesh['runs']
+    run_kinds = numpy.array([kind for kind, _ in runs], dtype=numpy.int8)
+    run_counts = numpy.array([payload if kind in (RUN_VERTICES, RUN_NORMALS) else 0 for kind, payload in runs],
+                             dtype=numpy.int64)
+    texts = [payload.encode('utf-8') if kind in (RUN_FACE_LINES, RUN_TEXT) else b'' for kind, payload in runs]
+    face_blocks = [payload for kind, payload in runs if kind == RUN_FACES]
+    arrays = {
+        'source_mtime': numpy.array(source_mtime, dtype=numpy.int64),
+        'vertices': mesh['vertices'],
+        'normals': mesh['normals'],
+        'num_vt': numpy.array(mesh['num_vt'], dtype=numpy.int64),
+        'run_kinds': run_kinds,
+        'run_counts': run_counts,
+        'text': numpy.frombuffer(b''.join(texts), dtype=numpy.uint8),
+        'text_offsets': numpy.cumsum([0] + [len(text) for text in texts], dtype=numpy.int64),
+        'face_indices': numpy.concatenate([f['indices'] for f in face_blocks] or [numpy.zeros((0, 3), numpy.int64)]),
+        'face_corner_offsets': numpy.cumsum([0] + [len(f['indices']) for f in face_blocks], dtype=numpy.int64),
+        'face_counts': numpy.concatenate([f['corner_counts'] for f in face_blocks] or [numpy.zeros(0, numpy.int64)]),
+        'face_count_offsets': numpy.cumsum([0] + [len(f['corner_counts']) for f in face_blocks], dtype=numpy.int64),
+        'face_columns': numpy.array([f['columns'] for f in face_blocks], dtype=bool).reshape(-1, 3),
+        'face_num_slashes': numpy.array([f['num_slashes'] for f in face_blocks], dtype=numpy.int64),
+    }
+    with atomic_open(cache_path) as f:
+        numpy.savez(f, **arrays)
+
+
+# Returns None if there is no cache entry for this version of the source file
+def load_cached_obj_mesh(cache_path, source_mtime):
+    if not os.path.isfile(cache_path):
+        return None
+    with numpy.load(cache_path) as arrays:
+        if int(arrays['source_mtime']) != source_mtime:
+            return None
+        arrays = dict(arrays)
+    text = arrays['text'].tobytes()
+    text_offsets = arrays['text_offsets']
+    runs = []
+    face_idx = 0
+    for run_idx, kind in enumerate(arrays['run_kinds'].tolist()):
+        if kind in (RUN_VERTICES, RUN_NORMALS):
+            runs.append((kind, int(arrays['run_counts'][run_idx])))
+        elif kind == RUN_FACES:
+            corners = arrays['face_corner_offsets'][face_idx:face_idx + 2]
+            counts = arrays['face_count_offsets'][face_idx:face_idx + 2]
+            runs.append((kind, {'indices': arrays['face_indices'][corners[0]:corners[1]],
+                                'columns': arrays['face_columns'][face_idx],
+                                'num_slashes': int(arrays['face_num_slashes'][face_idx]),
+                                'corner_counts': arrays['face_counts'][counts[0]:counts[1]]}))
+            face_idx += 1
+        else:
+            runs.append((kind, text[text_offsets[run_idx]:text_offsets[run_idx + 1]].decode('utf-8')))
+    return {'vertices': arrays['vertices'], 'normals': arrays['normals'],
+            'bbox': bounding_box_of(arrays['vertices']), 'num_vt': int(arrays['num_vt']), 'runs': runs}
+
+
+def obj_mesh_cache_path(cache_dir, shapenet_hash, path):
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, '{0}_{1}.npz'.format(shapenet_hash.replace('/', '_'), name))
+
+
+@functools.lru_cache(maxsize=MESH_CACHE_SIZE)
+def _load_obj_mesh(path, source_mtime, cache_path):
+    if cache_path is not None:
+        mesh = load_cached_obj_mesh(cache_path, source_mtime)
+        if mesh is not None:
+            return mesh
+    mesh = parse_obj_mesh(path)
+    if cache_path is not None:
+        save_obj_mesh(cache_path, mesh, source_mtime)
+    return mesh
+
+
+# Returns the parsed mesh for a ShapeNet model.  Meshes are kept in an in
+# process LRU and, if cache_dir is given, stored on disk keyed by the
+# shapenet_hash and the modification time of the source obj.  The returned
+# mesh is shared, so its arrays must not be modified in place.
+def load_obj_mesh(path, shapenet_hash=None, cache_dir=None):
+    cache_path = None
+    if cache_dir is not None and shapenet_hash is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_path = obj_mesh_cache_path(cache_dir, shapenet_hash, path)
+    return _load_obj_mesh(path, os.stat(path).st_mtime_ns, cache_path)
+
+
+# Converts obj vertex indices, which are 1-based or negative relative to the
+# end of the vertex list, to 0-based indices
+def obj_vertex_indices(indices, num_vertices):
+    indices = numpy.asarray(indices, dtype=numpy.int64)
+    return numpy.where(indices > 0, indices - 1, num_vertices + indices)
+
+
+# Fan triangulates faces given the vertex index of every corner and the number
+# of corners in each face, faces with fewer than three corners are dropped
+def fan_triangulate(corner_indices, corner_counts):
+    corner_counts = numpy.asarray(corner_counts, dtype=numpy.int64)
+    face_starts = numpy.cumsum(corner_counts) - corner_counts
+    num_triangles = numpy.maximum(corner_counts - 2, 0)
+    triangle_face = numpy.repeat(numpy.arange(len(corner_counts)), num_triangles)
+    triangle_starts = face_starts[triangle_face]
+    fan_idx = numpy.arange(num_triangles.sum()) - numpy.repeat(numpy.cumsum(num_triangles) - num_triangles, num_triangles)
+    return numpy.stack((corner_indices[triangle_starts],
+                        corner_indices[triangle_starts + fan_idx + 1],
+                        corner_indices[triangle_starts + fan_idx + 2]), axis=1)
+
+
+# Returns the (T,3) 0-based vertex indices of the mesh faces as triangles.
+# These are computed once and kept with the (shared) mesh.
+def obj_mesh_triangles(mesh):
+    if 'triangles' not in mesh:
+        corner_indices = []
+        corner_counts = []
+        for kind, payload in mesh['runs']:
+            if kind == RUN_FACES:
+                corner_indices.append(payload['indices'][:, 0])
+                corner_counts.append(payload['corner_counts'])
+            elif kind == RUN_FACE_LINES:
+                faces = [l.split()[1:] for l in split_obj_lines(payload)]
+                corner_indices.append(numpy.array([int(p.split('/')[0]) for face in faces for p in face],
+                                                  dtype=numpy.int64))
+                corner_counts.append(numpy.array([len(face) for face in faces], dtype=numpy.int64))
+        if corner_indices:
+            corner_indices = obj_vertex_indices(numpy.concatenate(corner_indices), len(mesh['vertices']))
+            mesh['triangles'] = fan_triangulate(corner_indices, numpy.concatenate(corner_counts))
+        else:
+            mesh['triangles'] = numpy.zeros((0, 3), dtype=numpy.int64)
+    return mesh['triangles']
+
+
+# Merges a list of (vertices, triangles, instance_id) parts into a single mesh
+# of vertices, triangles and the instance id of each triangle
+def merge_mesh_parts(parts):
+    vertices = []
+    triangles = []
+    instance_ids = []
+    offset = 0
+    for part_vertices, part_triangles, instance_id in parts:
+        vertices.append(numpy.asarray(part_vertices, dtype=numpy.float32))
+        triangles.append(part_triangles + offset)
+        instance_ids.append(numpy.full(len(part_triangles), instance_id, dtype=numpy.int32))
+        offset += len(part_vertices)
+    if not parts:
+        return (numpy.zeros((0, 3), numpy.float32), numpy.zeros((0, 3), numpy.int32),
+                numpy.zeros(0, numpy.int32))
+    return (numpy.concatenate(vertices), numpy.concatenate(triangles).astype(numpy.int32),
+            numpy.concatenate(instance_ids))
+
+
+def save_mesh_npz(path, vertices, triangles, instance_ids):
+    numpy.savez(path, vertices=vertices, faces=triangles, face_instance_ids=instance_ids)
+
+
+def load_mesh_npz(path):
+    with numpy.load(path) as arrays:
+        return arrays['vertices'], arrays['faces'], arrays['face_instance_ids']
+
+
+PLY_VERTEX_DTYPE = numpy.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4')])
+PLY_FACE_DTYPE = numpy.dtype([('count', 'u1'), ('vertex_indices', '<i4', (3,)), ('instance_id', '<i4')])
+
+
+# Writes a binary little endian ply with a per face instance_id property
+def save_mesh_ply(path, vertices, triangles, instance_ids, comment=None):
+    vertex_data = numpy.empty(len(vertices), dtype=PLY_VERTEX_DTYPE)
+    vertex_data['x'] = vertices[:, 0]
+    vertex_data['y'] = vertices[:, 1]
+    vertex_data['z'] = vertices[:, 2]
+    face_data = numpy.empty(len(triangles), dtype=PLY_FACE_DTYPE)
+    face_data['count'] = 3
+    face_data['vertex_indices'] = triangles
+    face_data['instance_id'] = instance_ids
+    header = ['ply', 'format binary_little_endian 1.0']
+    if comment:
+        header.append('comment %s' % comment)
+    header += ['element vertex %d' % len(vertices),
+               'property float x', 'property float y', 'property float z',
+               'element face %d' % len(triangles),
+               'property list uchar int vertex_indices',
+               'property int instance_id',
+               'end_header']
+    with open(path, 'wb') as f:
+        f.write(('\n'.join(header) + '\n').encode('ascii'))
+        f.write(vertex_data.tobytes())
+        f.write(face_data.tobytes())
+
+
+# Reads back a ply written by save_mesh_ply
+def load_mesh_ply(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    header_end = data.index(b'end_header\n') + len(b'end_header\n')
+    counts = {}
+    for line in data[:header_end].decode('ascii').splitlines():
+        if line.startswith('element '):
+            _, name, count = line.split()
+            counts[name] = int(count)
+    vertex_data = numpy.frombuffer(data, dtype=PLY_VERTEX_DTYPE, count=counts['vertex'], offset=header_end)
+    face_data = numpy.frombuffer(data, dtype=PLY_FACE_DTYPE, count=counts['face'],
+                                 offset=header_end + vertex_data.nbytes)
+    vertices = numpy.stack((vertex_data['x'], vertex_data['y'], vertex_data['z']), axis=1)
+    return vertices, face_data['vertex_indices'], face_data['instance_id']
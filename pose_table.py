@@ -0,0 +1,113 @@
+from atomic_files import save_array_atomic
+import numpy as np
+import os
+import sys
+from trajectory_index import IndexedTrajectories
+
+# A columnar copy of all of the camera poses in a trajectories protobuf, so
+# that pose math can run over whole arrays rather than protobuf attributes.
+#
+#   camera     float64 (n_traj,n_views,2,3)  camera position
+#   lookat     float64 (n_traj,n_views,2,3)  lookat position
+#   timestamp  float64 (n_traj,n_views,2)
+#   frame_num  int32   (n_traj,n_views)
+#   num_views  int32   (n_traj,)
+#   render_path str    (n_traj,)
+#
+# The third axis of camera/lookat/timestamp is indexed by SHUTTER_OPEN and
+# SHUTTER_CLOSE.  Trajectories with fewer than n_views views are padded with
+# NaN poses and a frame_num of -1, num_views gives the number of valid views.
+
+SHUTTER_OPEN = 0
+SHUTTER_CLOSE = 1
+
+POSE_TABLE_COLUMNS = ['camera','lookat','timestamp','frame_num','num_views','render_path']
+
+# Trajectories can be any iterable of sn.Trajectory, each one is only visited
+# once so this works with the lazily decoded IndexedTrajectories
+def pose_table_from_trajectories(trajectories):
+    all_rows = []
+    all_frame_nums = []
+    render_paths = []
+    for traj in trajectories:
+        render_paths.append(traj.render_path)
+        # Fill a flat row per view, which is cheaper than assigning into
+        # the table one element at a time
+        rows = np.empty((len(traj.views),14))
+        frame_nums = np.empty(len(traj.views),dtype=np.int32)
+        for view_idx,view in enumerate(traj.views):
+            o = view.shutter_open
+            c = view.shutter_close
+            rows[view_idx] = (o.camera.x,o.camera.y,o.camera.z,
+                              c.camera.x,c.camera.y,c.camera.z,
+                              o.lookat.x,o.lookat.y,o.lookat.z,
+                              c.lookat.x,c.lookat.y,c.lookat.z,
+                              o.timestamp,c.timestamp)
+            frame_nums[view_idx] = view.frame_num
+        all_rows.append(rows)
+        all_frame_nums.append(frame_nums)
+    n_traj = len(all_rows)
+    view_counts = np.array([len(rows) for rows in all_rows],dtype=np.int32)
+    n_views = view_counts.max() if n_traj else 0
+    table = np.full((n_traj,n_views,14),np.nan)
+    frame_num = np.full((n_traj,n_views),-1,dtype=np.int32)
+    for traj_idx,(rows,frame_nums) in enumerate(zip(all_rows,all_frame_nums)):
+        table[traj_idx,:len(rows)] = rows
+        frame_num[traj_idx,:len(rows)] = frame_nums
+    return {
+        'camera':table[:,:,0:6].reshape(n_traj,n_views,2,3),
+        'lookat':table[:,:,6:12].reshape(n_traj,n_views,2,3),
+        'timestamp':np.ascontiguousarray(table[:,:,12:14]),
+        'frame_num':frame_num,
+        'num_views':view_counts,
+        'render_path':np.array(render_paths,dtype=np.str_),
+    }
+
+def pose_table_from_protobuf(protobuf_path):
+    with IndexedTrajectories(protobuf_path) as trajectories:
+        return pose_table_from_trajectories(trajectories)
+
+# The table is stored as a directory with one .npy file per column, unlike an
+# .npz archive these can be memory mapped.  render_path.npy is removed first
+# and written last, so a directory with it is complete.
+def save_pose_table(table_dir,table):
+    if not os.path.isdir(table_dir):
+        os.makedirs(table_dir)
+    marker = os.path.join(table_dir,POSE_TABLE_COLUMNS[-1] + '.npy')
+    if os.path.isfile(marker):
+        os.remove(marker)
+    for column in POSE_TABLE_COLUMNS:
+        save_array_atomic(os.path.join(table_dir,column + '.npy'),table[column])
+
+def load_pose_table(table_dir,mmap_mode='r'):
+    return {column:np.load(os.path.join(table_dir,column + '.npy'),mmap_mode=mmap_mode)
+            for column in POSE_TABLE_COLUMNS}
+
+def pose_table_dir_for(protobuf_path):
+    return os.path.splitext(protobuf_path)[0] + '_poses'
+
+# Returns the cached pose table for the protobuf, building it if it is missing
+# or older than the protobuf itself
+def cached_pose_table(protobuf_path,table_dir=None,mmap_mode='r'):
+    table_dir = table_dir or pose_table_dir_for(protobuf_path)
+    marker = os.path.join(table_dir,POSE_TABLE_COLUMNS[-1] + '.npy')
+    if not os.path.isfile(marker) or os.path.getmtime(marker) < os.path.getmtime(protobuf_path):
+        table = pose_table_from_protobuf(protobuf_path)
+        try:
+            save_pose_table(table_dir,table)
+        except (IOError,OSError):
+            # The table is only a cache, e.g. the data directory may be read
+            # only, in which case it is rebuilt on the next run
+            print('Unable to write pose table to:{0}'.format(table_dir))
+            return table
+    return load_pose_table(table_dir,mmap_mode=mmap_mode)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Please run as python pose_table.py /path/to/scenenet_rgbd_val.pb [/path/to/output_dir]')
+        sys.exit(1)
+    protobuf_path = sys.argv[1]
+    table_dir = sys.argv[2] if len(sys.argv) > 2 else pose_table_dir_for(protobuf_path)
+    table = pose_table_from_protobuf(protobuf_path)
+    save_pose_table(table_dir,table)
+    print('Wrote poses of {0} trajectories to:{1}'.format(len(table['num_views']),table_dir))
@@ -0,0 +1,231 @@
+from atomic_files import atomic_open
+import atexit
+import functools
+import glob
+import json
+import multiprocessing.util
+import os
+import threading
+import time
+
+# Opt in timing of the stages of the conversion scripts, e.g. where the time of
+# a calculate_optical_flow.py run goes between decoding, geometry and encoding.
+# Enabled by setting the environment variable
+#   SCENENET_PROFILE=1                 writes scenenet_profile.json
+#   SCENENET_PROFILE=run_profile.json  writes run_profile.json
+# or by the --profile flag of the scripts, which calls enable().  Stages are
+# marked with
+#   with profiling.stage('encode',frames=1) as stage:
+#       image.save(path)
+#       profiling.count_file_written(path)
+# or the @profiling.profiled(name) decorator.  count() and the count_file_*
+# functions add to the innermost stage of the thread, e.g. from a file
+# loader.  At exit a summary table of the wall time, frames and bytes of each
+# stage is printed, and every stage is written as a Chrome trace
+# (chrome://tracing or Perfetto).  Times of nested stages are included in
+# those of the stages around them.
+#
+# When disabled, stage() returns a shared no-op stage (which is falsy, so that
+# any extra measurement can be skipped), profiled functions are called
+# directly and the count functions return at once.  Pool worker processes
+# started after enabling record their stages too, they are written to
+# <trace path>.<pid>.part at their exit and merged by the process that enabled
+# profiling.
+
+PROFILE_ENV = 'SCENENET_PROFILE'
+PROFILE_PID_ENV = 'SCENENET_PROFILE_PID'
+DEFAULT_TRACE_PATH = 'scenenet_profile.json'
+
+_enabled = False
+_trace_path = None
+_events = []
+_events_lock = threading.Lock()
+_local = threading.local()
+
+# Identifies this module to the multiprocessing after fork hooks
+class _ForkToken(object):
+    pass
+
+_fork_token = _ForkToken()
+
+class Stage(object):
+    __slots__ = ('name','frames','bytes_read','bytes_written','start')
+
+    def __init__(self,name,frames=0,bytes_read=0,bytes_written=0):
+        self.name = name
+        self.frames = frames
+        self.bytes_read = bytes_read
+        self.bytes_written = bytes_written
+
+    def add(self,frames=0,bytes_read=0,bytes_written=0):
+        self.frames += frames
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+
+    def __enter__(self):
+        stack = getattr(_local,'stack',None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self,*exc_info):
+        end = time.perf_counter()
+        _local.stack.pop()
+        event = (self.name,self.start,end - self.start,os.getpid(),threading.get_ident(),
+                 self.frames,self.bytes_read,self.bytes_written)
+        with _events_lock:
+            _events.append(event)
+
+class NullStage(object):
+    __slots__ = ()
+
+    def add(self,frames=0,bytes_read=0,bytes_written=0):
+        pass
+
+    def __bool__(self):
+        return False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc_info):
+        pass
+
+NULL_STAGE = NullStage()
+
+def is_enabled():
+    return _enabled
+
+def stage(name,frames=0,bytes_read=0,bytes_written=0):
+    if not _enabled:
+        return NULL_STAGE
+    return Stage(name,frames,bytes_read,bytes_written)
+
+# Adds to the innermost stage of the calling thread, if there is one
+def count(frames=0,bytes_read=0,bytes_written=0):
+    if not _enabled:
+        return
+    stack = getattr(_local,'stack',None)
+    if stack:
+        stack[-1].add(frames,bytes_read,bytes_written)
+
+# The size of a file read or written, added to the innermost stage
+def count_file_read(path):
+    if _enabled:
+        count(bytes_read=os.path.getsize(path))
+
+def count_file_written(path):
+    if _enabled:
+        count(bytes_written=os.path.getsize(path))
+
+def profiled(name=None,frames=0):
+    def decorator(function):
+        stage_name = name or function.__name__
+        @functools.wraps(function)
+        def wrapper(*args,**kwargs):
+            if not _enabled:
+                return function(*args,**kwargs)
+            with Stage(stage_name,frames):
+                return function(*args,**kwargs)
+        return wrapper
+    return decorator
+
+def worker_part_path(trace_path,pid):
+    return '{0}.{1}.part'.format(trace_path,pid)
+
+def is_worker():
+    return os.environ.get(PROFILE_PID_ENV) not in (None,str(os.getpid()))
+
+def _start(trace_path):
+    global _enabled, _trace_path
+    _enabled = True
+    _trace_path = trace_path
+    # Run in every multiprocessing child when it starts, after its inherited
+    # finalizers have been cleared
+    multiprocessing.util.register_after_fork(_fork_token,_start_child_process)
+    if is_worker():
+        # Pool workers skip atexit, but do run the multiprocessing finalizers
+        multiprocessing.util.Finalize(None,write_worker_events,exitpriority=100)
+    else:
+        # Inherited by the processes started from here on, which then know
+        # they are workers
+        os.environ[PROFILE_ENV] = trace_path
+        os.environ[PROFILE_PID_ENV] = str(os.getpid())
+        atexit.register(report)
+
+# Enables profiling in this process and in any process it starts afterwards
+def enable(trace_path=DEFAULT_TRACE_PATH):
+    if not _enabled:
+        _start(trace_path)
+
+def _start_child_process(token):
+    # Forked children start with a copy of the events of their parent
+    with _events_lock:
+        del _events[:]
+    _local.stack = []
+    multiprocessing.util.Finalize(None,write_worker_events,exitpriority=100)
+
+def write_worker_events():
+    with _events_lock:
+        events = list(_events)
+    if events:
+        with open(worker_part_path(_trace_path,os.getpid()),'w') as f:
+            json.dump(events,f)
+
+# Returns the events of this process and of its finished workers, removing the
+# worker part files
+def collect_events(trace_path):
+    with _events_lock:
+        events = [tuple(event) for event in _events]
+    for part_path in glob.glob(glob.escape(trace_path) + '.*.part'):
+        with open(part_path,'r') as f:
+            events.extend(tuple(event) for event in json.load(f))
+        os.remove(part_path)
+    return sorted(events,key=lambda event: event[1])
+
+# Returns [(name, calls, frames, seconds, bytes_read, bytes_written)] ordered
+# by the total time of each stage
+def summarize(events):
+    totals = {}
+    for name,_,duration,_,_,frames,bytes_read,bytes_written in events:
+        total = totals.setdefault(name,[0,0,0.0,0,0])
+        total[0] += 1
+        total[1] += frames
+        total[2] += duration
+        total[3] += bytes_read
+        total[4] += bytes_written
+    return sorted(((name,) + tuple(total) for name,total in totals.items()),key=lambda row: -row[3])
+
+def format_summary(rows):
+    lines = ['{0:<28}{1:>8}{2:>9}{3:>11}{4:>11}{5:>10}{6:>11}{7:>11}'.format(
+        'stage','calls','frames','total s','mean ms','frames/s','MB read','MB written')]
+    for name,calls,frames,seconds,bytes_read,bytes_written in rows:
+        lines.append('{0:<28}{1:>8}{2:>9}{3:>11.3f}{4:>11.3f}{5:>10.1f}{6:>11.2f}{7:>11.2f}'.format(
+            name,calls,frames,seconds,1000.0 * seconds / calls,frames / seconds if seconds > 0 else 0.0,
+            bytes_read / 1e6,bytes_written / 1e6))
+    return '\n'.join(lines)
+
+# The events in the Chrome trace event format, complete ('X') events with
+# microsecond times
+def chrome_trace(events):
+    origin = events[0][1] if events else 0.0
+    trace_events = []
+    for name,start,duration,pid,tid,frames,bytes_read,bytes_written in events:
+        trace_events.append({'name':name,'ph':'X','ts':(start - origin) * 1e6,'dur':duration * 1e6,
+                             'pid':pid,'tid':tid,
+                             'args':{'frames':frames,'bytes_read':bytes_read,'bytes_written':bytes_written}})
+    return {'traceEvents':trace_events,'displayTimeUnit':'ms'}
+
+def report():
+    events = collect_events(_trace_path)
+    if not events:
+        return
+    print(format_summary(summarize(events)))
+    with atomic_open(_trace_path,'w') as f:
+        json.dump(chrome_trace(events),f)
+    print('Wrote profile trace to:{0}'.format(_trace_path))
+
+if os.environ.get(PROFILE_ENV) not in (None,'','0'):
+    _start(DEFAULT_TRACE_PATH if os.environ[PROFILE_ENV] == '1' else os.environ[PROFILE_ENV])
@@ -1,39 +1,41 @@
 import scenenet_pb2 as sn
 import os
+import sys
+from trajectory_index import IndexedTrajectories
 
 data_root_path = 'data/val'
 protobuf_path = 'data/scenenet_rgbd_val.pb'
 
 # These functions produce a file path (on Linux systems) to the image given
 # a view and render path from a trajectory.  As long the data_root_path to the
-# root of the dataset is given.  I.e. to either val or train
-def photo_path_from_view(render_path,view):
+# root of the dataset is given.  I.e. to either val or train, which can also be
+# passed as root_path rather than set globally
+def photo_path_from_view(render_path,view,root_path=None):
     photo_path = os.path.join(render_path,'photo')
     image_path = os.path.join(photo_path,'{0}.jpg'.format(view.frame_num))
-    return os.path.join(data_root_path,image_path)
+    return os.path.join(root_path or data_root_path,image_path)
 
-def instance_path_from_view(render_path,view):
+def instance_path_from_view(render_path,view,root_path=None):
     photo_path = os.path.join(render_path,'instance')
     image_path = os.path.join(photo_path,'{0}.png'.format(view.frame_num))
-    return os.path.join(data_root_path,image_path)
+    return os.path.join(root_path or data_root_path,image_path)
 
-def depth_path_from_view(render_path,view):
+def depth_path_from_view(render_path,view,root_path=None):
     photo_path = os.path.join(render_path,'depth')
     image_path = os.path.join(photo_path,'{0}.png'.format(view.frame_num))
-    return os.path.join(data_root_path,image_path)
+    return os.path.join(root_path or data_root_path,image_path)
 
 
 if __name__ == '__main__':
-    trajectories = sn.Trajectories()
     try:
-        with open(protobuf_path,'rb') as f:
-            trajectories.ParseFromString(f.read())
+        trajectories = IndexedTrajectories(protobuf_path)
     except IOError:
         print('Scenenet protobuf data not found at location:{0}'.format(data_root_path))
         print('Please ensure you have copied the pb file to the data directory')
+        sys.exit(1)
 
-    print('Number of trajectories:{0}'.format(len(trajectories.trajectories)))
-    for traj in trajectories.trajectories:
+    print('Number of trajectories:{0}'.format(len(trajectories)))
+    for traj in trajectories:
         layout_type = sn.SceneLayout.LayoutType.Name(traj.layout.layout_type)
         layout_path = traj.layout.model
         print('='*20)
@@ -0,0 +1,123 @@
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from frame_store import ViewRef, check_backend, depth_from_view, instance_from_view, photo_from_view
+from geometry import extrinsics_from_shutter_poses
+import numpy as np
+from pose_table import cached_pose_table
+
+# A loader over every (trajectory, view) of a split, for feeding a trainer, e.g.
+#   frames = SceneNetFrames('data/scenenet_rgbd_val.pb','data/val',
+#                           num_threads=8,shuffle='frame',seed=0)
+#   for frame in frames:
+#       frame.photo, frame.depth, frame.instance, frame.world_to_camera
+# Images are decoded ahead of the consumer by a thread pool (PIL releases the
+# GIL while decoding), at most prefetch frames ahead.  The poses come from the
+# cached pose table, so the trajectories protobuf is not decoded at all.  With
+# backend='packed' the frames are read from the stores written by
+# frame_store.py, where depth and instance frames are memory mapped slices.
+#
+#   photo     uint8  (H,W,3)
+#   depth     uint16 (H,W) in millimetres, as stored in the depth pngs
+#   instance  uint16 (H,W) instance ids, see the trajectory instances
+#   camera/lookat    float64 (2,3) at shutter open and close
+#   timestamp        float64 (2,)
+#   world_to_camera/camera_to_world  float64 (4,4) at the middle of the exposure,
+#                    the pose of the depth and instance renders
+#
+# Components that are not requested are None.
+
+Frame = namedtuple('Frame', ['trajectory_index', 'render_path', 'frame_num', 'photo', 'depth', 'instance',
+                             'camera', 'lookat', 'timestamp', 'world_to_camera', 'camera_to_world'])
+
+COMPONENTS = ('photo', 'depth', 'instance')
+
+# The ways frames can be shuffled, each epoch
+#   None          trajectories and their frames in order
+#   'trajectory'  trajectories in a random order, their frames in order
+#   'frame'       all frames in a random order
+SHUFFLE_MODES = (None, 'trajectory', 'frame')
+
+class SceneNetFrames(object):
+    def __init__(self,protobuf_path,data_root_path,num_threads=4,prefetch=32,shuffle=None,seed=None,
+                 components=COMPONENTS,trajectory_indices=None,pose_table_dir=None,
+                 backend='files',store_root=None):
+        if shuffle not in SHUFFLE_MODES:
+            raise ValueError('Unknown shuffle mode:{0}, choose from {1}'.format(shuffle,SHUFFLE_MODES))
+        for component in components:
+            if component not in COMPONENTS:
+                raise ValueError('Unknown component:{0}, choose from {1}'.format(component,COMPONENTS))
+        check_backend(backend)
+        self.data_root_path = data_root_path
+        self.backend = backend
+        self.store_root = store_root
+        self.num_threads = num_threads
+        self.prefetch = max(prefetch,1)
+        self.shuffle = shuffle
+        self.components = tuple(components)
+        self.poses = cached_pose_table(protobuf_path,table_dir=pose_table_dir)
+        if trajectory_indices is None:
+            trajectory_indices = range(len(self.poses['num_views']))
+        self.trajectory_indices = np.asarray(trajectory_indices,dtype=np.int64)
+        self._random = np.random.RandomState(seed)
+
+    def __len__(self):
+        return int(np.sum(self.poses['num_views'][self.trajectory_indices]))
+
+    # The (trajectory index, view index) of every frame of an epoch, in the
+    # order they are yielded
+    def frame_order(self):
+        trajectory_indices = self.trajectory_indices
+        if self.shuffle == 'trajectory':
+            trajectory_indices = self._random.permutation(trajectory_indices)
+        num_views = self.poses['num_views'][trajectory_indices]
+        traj = np.repeat(trajectory_indices,num_views)
+        # The view index of each frame counts up from 0 within its trajectory
+        starts = np.cumsum(num_views) - num_views
+        view = np.arange(len(traj)) - np.repeat(starts,num_views)
+        order = np.stack((traj,view),axis=1)
+        if self.shuffle == 'frame':
+            order = order[self._random.permutation(len(order))]
+        return order
+
+    def load_frame(self,traj_idx,view_idx):
+        render_path = str(self.poses['render_path'][traj_idx])
+        frame_num = int(self.poses['frame_num'][traj_idx,view_idx])
+        view = ViewRef(frame_num)
+        loaders = {'photo':photo_from_view,'depth':depth_from_view,'instance':instance_from_view}
+        images = {}
+        for component in self.components:
+            images[component] = loaders[component](render_path,view,self.data_root_path,
+                                                   backend=self.backend,store_root=self.store_root)
+        camera = np.array(self.poses['camera'][traj_idx,view_idx])
+        lookat = np.array(self.poses['lookat'][traj_idx,view_idx])
+        world_to_camera, camera_to_world = extrinsics_from_shutter_poses(camera,lookat)
+        return Frame(trajectory_index=int(traj_idx),render_path=render_path,frame_num=frame_num,
+                     photo=images.get('photo'),depth=images.get('depth'),instance=images.get('instance'),
+                     camera=camera,lookat=lookat,
+                     timestamp=np.array(self.poses['timestamp'][traj_idx,view_idx]),
+                     world_to_camera=world_to_camera,camera_to_world=camera_to_world)
+
+    # Each iteration is one epoch, reshuffled if shuffling.  Frames are yielded
+    # in order of frame_order, and an error loading a frame is raised when
+    # that frame is reached.
+    def __iter__(self):
+        order = self.frame_order()
+        if self.num_threads <= 1:
+            for traj_idx, view_idx in order:
+                yield self.load_frame(traj_idx,view_idx)
+            return
+        executor = ThreadPoolExecutor(max_workers=self.num_threads)
+        pending = deque()
+        try:
+            next_frame = 0
+            while next_frame < len(order) or pending:
+                while next_frame < len(order) and len(pending) < self.prefetch:
+                    traj_idx, view_idx = order[next_frame]
+                    pending.append(executor.submit(self.load_frame,traj_idx,view_idx))
+                    next_frame += 1
+                yield pending.popleft().result()
+        finally:
+            # Also reached if the consumer stops early
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
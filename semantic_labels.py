@@ -0,0 +1,37 @@
+import numpy as np
+
+# Instance images are unsigned 16-bit, so a lookup table covering every
+# possible value maps any instance image to classes with a single gather
+INSTANCE_LUT_SIZE = 1 << 16
+
+# Builds the instance id -> class id lookup table for a trajectory from a
+# {instance_id:class_id} mapping.  Instances missing from the mapping (e.g. the
+# background) are given class 0, 'Unknown'.
+def class_lookup_table(mapping,dtype=np.uint8):
+    lut = np.zeros(INSTANCE_LUT_SIZE,dtype=dtype)
+    if mapping:
+        instance_ids = np.fromiter(mapping.keys(),dtype=np.int64,count=len(mapping))
+        class_ids = np.fromiter(mapping.values(),dtype=np.int64,count=len(mapping))
+        lut[instance_ids] = class_ids
+    return lut
+
+# Converts an (K,3) float colour code in [0,1] into a uint8 palette
+def colour_palette(colour_code):
+    return np.uint8(np.asarray(colour_code) * 255)
+
+# Works on a single (H,W) instance image or an (N,H,W) stack of them, and
+# returns the class image(s) and, if a palette is given, the colour image(s).
+# The lut may be shorter than INSTANCE_LUT_SIZE (e.g. a row of the cached class
+# tables, which are only as wide as the largest instance id of the protobuf),
+# instance ids past its end are class 0, 'Unknown'.
+def instance_to_class(instance_img,lut,palette=None):
+    instance_img = np.asarray(instance_img)
+    if instance_img.size and instance_img.max() >= len(lut):
+        known = instance_img < len(lut)
+        class_img = lut[np.where(known,instance_img,0)]
+        class_img[~known] = 0
+    else:
+        class_img = lut[instance_img]
+    if palette is None:
+        return class_img
+    return class_img, palette[class_img]
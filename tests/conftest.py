@@ -0,0 +1,38 @@
+import atexit
+import os
+import pytest
+import shutil
+import subprocess
+import sys
+import tempfile
+
+# The tests import the scripts from the repository root.  scenenet_pb2 is
+# generated from scenenet.proto by make, if it has not been it is generated
+# into a temporary directory for the test run.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,ROOT)
+
+try:
+    import scenenet_pb2
+except ImportError:
+    protoc = shutil.which('protoc')
+    if protoc is None:
+        raise ImportError('scenenet_pb2 is missing and protoc is not installed, run make in {0}'.format(ROOT))
+    build_dir = tempfile.mkdtemp(prefix='scenenet_pb2_')
+    atexit.register(shutil.rmtree,build_dir,True)
+    subprocess.check_call([protoc,'--proto_path',ROOT,'--python_out',build_dir,os.path.join(ROOT,'scenenet.proto')])
+    sys.path.insert(0,build_dir)
+    import scenenet_pb2
+
+from synthetic import synthetic_trajectories
+
+@pytest.fixture
+def trajectories():
+    return synthetic_trajectories()
+
+@pytest.fixture
+def protobuf_path(tmp_path,trajectories):
+    path = str(tmp_path / 'scenenet_rgbd_test.pb')
+    with open(path,'wb') as f:
+        f.write(trajectories.SerializeToString())
+    return path
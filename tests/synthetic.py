@@ -0,0 +1,97 @@
+import numpy as np
+import os
+from PIL import Image
+import random
+import scenenet_pb2 as sn
+
+# Synthetic inputs shared by the tests, so that they run without the dataset
+
+# A random Trajectories message of num_trajectories trajectories, each with a
+# background, layout and light instance, random objects with poses and
+# num_views views 25 frames apart
+def synthetic_trajectories(num_trajectories=3,num_views=6,num_objects=4,seed=0,wnids=('04379243','03001627')):
+    rng = random.Random(seed)
+    trajectories = sn.Trajectories()
+    for traj_idx in range(num_trajectories):
+        traj = trajectories.trajectories.add()
+        traj.render_path = '0/{0}'.format(traj_idx)
+        traj.layout.layout_type = rng.choice([1,2,3,4,5])
+        traj.layout.model = 'layout_{0}.obj'.format(traj_idx)
+        background = traj.instances.add()
+        background.instance_id = 0
+        background.instance_type = sn.Instance.BACKGROUND
+        layout = traj.instances.add()
+        layout.instance_id = 1
+        layout.instance_type = sn.Instance.LAYOUT_OBJECT
+        layout.semantic_wordnet_id = '04590553'
+        light = traj.instances.add()
+        light.instance_id = 2
+        light.instance_type = sn.Instance.LIGHT_OBJECT
+        light.light_info.light_type = sn.LightInfo.SPHERE
+        for instance_id in range(3,3 + num_objects):
+            instance = traj.instances.add()
+            instance.instance_id = instance_id
+            instance.instance_type = sn.Instance.RANDOM_OBJECT
+            instance.semantic_wordnet_id = rng.choice(wnids)
+            info = instance.object_info
+            info.shapenet_hash = '04379243/model{0}'.format(instance_id % 2)
+            info.height_meters = rng.uniform(0.3,1.5)
+            angle = rng.uniform(0,2 * np.pi)
+            pose = info.object_pose
+            pose.rotation_mat11, pose.rotation_mat13 = np.cos(angle), np.sin(angle)
+            pose.rotation_mat22 = 1.0
+            pose.rotation_mat31, pose.rotation_mat33 = -np.sin(angle), np.cos(angle)
+            pose.translation_x, pose.translation_y, pose.translation_z = [rng.uniform(-2,2) for _ in range(3)]
+        for view_idx in range(num_views):
+            view = traj.views.add()
+            view.frame_num = view_idx * 25
+            for pose,offset in ((view.shutter_open,0.0),(view.shutter_close,1.0 / 60)):
+                pose.camera.x = 0.1 * view_idx + rng.uniform(-0.05,0.05)
+                pose.camera.y = rng.uniform(1.0,1.6)
+                pose.camera.z = rng.uniform(-0.5,0.5)
+                pose.lookat.x = pose.camera.x + rng.uniform(-1,1)
+                pose.lookat.y = rng.uniform(0.5,1.5)
+                pose.lookat.z = pose.camera.z + rng.uniform(1,2)
+                pose.timestamp = view_idx + offset
+    return trajectories
+
+# The (N,2,3) shutter open/close camera and lookat positions of views, the
+# layout of the pose table columns
+def shutter_pose_arrays(views):
+    def position(p):
+        return [p.x,p.y,p.z]
+    camera = np.array([[position(view.shutter_open.camera),position(view.shutter_close.camera)] for view in views])
+    lookat = np.array([[position(view.shutter_open.lookat),position(view.shutter_close.lookat)] for view in views])
+    return camera, lookat
+
+# A (height,width) depth map in metres of a tilted plane with a box in front
+# of it, so that there are both smooth surfaces and depth discontinuities
+def synthetic_depth(height=48,width=64,seed=0):
+    rng = np.random.RandomState(seed)
+    rows, cols = np.mgrid[0:height,0:width]
+    depth = 3.0 + 0.02 * rows + 0.01 * cols + rng.uniform(0,0.01,(height,width))
+    depth[height // 4:height // 2,width // 4:width // 2] = 1.5
+    return depth
+
+# Writes the photo, depth and instance images of the views of a trajectory
+# under root_path in the layout of the dataset, render_path/photo/<frame>.jpg
+# and render_path/{depth,instance}/<frame>.png, returning the (N,H,W) depth
+# and instance stacks written
+def write_synthetic_frames(root_path,traj,height=48,width=64,seed=0):
+    rng = np.random.RandomState(seed)
+    instance_ids = [instance.instance_id for instance in traj.instances]
+    depths = []
+    instances = []
+    for view_idx,view in enumerate(traj.views):
+        depth = np.round(synthetic_depth(height,width,seed + view_idx) * 1000).astype(np.uint16)
+        depth[0,:view_idx] = 0
+        instance = rng.choice(instance_ids,(height,width)).astype(np.uint16)
+        photo = rng.randint(0,256,(height,width,3)).astype(np.uint8)
+        for kind,image,extension in (('photo',photo,'jpg'),('depth',depth,'png'),('instance',instance,'png')):
+            image_dir = os.path.join(root_path,traj.render_path,kind)
+            if not os.path.isdir(image_dir):
+                os.makedirs(image_dir)
+            Image.fromarray(image).save(os.path.join(image_dir,'{0}.{1}'.format(view.frame_num,extension)))
+        depths.append(depth)
+        instances.append(instance)
+    return np.stack(depths), np.stack(instances)
@@ -0,0 +1,55 @@
+import class_tables
+import numpy as np
+import os
+import scenenet_pb2 as sn
+
+# The {instance_id:class_id} mapping the original scripts built per trajectory
+def baseline_instance_class_map(traj,wnid_to_class):
+    return {instance.instance_id:wnid_to_class.get(instance.semantic_wordnet_id,0)
+            for instance in traj.instances if instance.instance_type != sn.Instance.BACKGROUND}
+
+def test_class_tables_match_instances(trajectories):
+    tables, class_names, render_paths, missing_wnids = class_tables.class_tables_from_trajectories(trajectories.trajectories)
+    # The wordnet name column is not a class scheme
+    assert sorted(tables) == ['13_classes']
+    assert class_names['13_classes'] == class_tables.CLASS_LISTS['13_classes']
+    assert list(render_paths) == [traj.render_path for traj in trajectories.trajectories]
+    wnid_to_class = class_tables.wnid_class_ids()[1]['13_classes']
+    wnids = set(instance.semantic_wordnet_id for traj in trajectories.trajectories for instance in traj.instances
+                if instance.instance_type != sn.Instance.BACKGROUND)
+    # e.g. the layout wnid of the synthetic trajectories
+    assert '04590553' in missing_wnids
+    assert missing_wnids == wnids - set(wnid_to_class)
+    assert wnid_to_class['04379243'] == 10 and wnid_to_class['03001627'] == 4
+    table = tables['13_classes']
+    assert table.dtype == np.uint8
+    for traj_idx,traj in enumerate(trajectories.trajectories):
+        expected = np.zeros(table.shape[1],dtype=np.uint8)
+        for instance_id,class_id in baseline_instance_class_map(traj,wnid_to_class).items():
+            expected[instance_id] = class_id
+        np.testing.assert_array_equal(table[traj_idx],expected)
+
+def test_schemes_without_class_list(tmp_path,trajectories):
+    path = str(tmp_path / 'wnid_to_class.txt')
+    with open(path,'w') as f:
+        f.write('wnid name 13_classes coarse\n')
+        f.write('4379243 table.n.02 Table Furniture\n')
+        f.write('3001627 chair.n.01 Chair Seat\n')
+    class_names, class_ids = class_tables.wnid_class_ids(path)
+    assert class_names['coarse'] == ['Unknown','Furniture','Seat']
+    assert class_ids['coarse'] == {'04379243':1,'03001627':2}
+    tables = class_tables.class_tables_from_trajectories(trajectories.trajectories,path)[0]
+    assert sorted(tables) == ['13_classes','coarse']
+
+def test_cached_class_table_round_trip(tmp_path,trajectories,protobuf_path):
+    table_dir = str(tmp_path / 'classes')
+    table = class_tables.cached_class_table(protobuf_path,table_dir=table_dir)
+    assert isinstance(table,np.memmap)
+    expected = class_tables.class_tables_from_trajectories(trajectories.trajectories)[0]['13_classes']
+    np.testing.assert_array_equal(table,expected)
+    assert class_tables.load_class_names(table_dir,'13_classes') == class_tables.CLASS_LISTS['13_classes']
+    assert os.path.isfile(os.path.join(table_dir,'render_path.npy'))
+    # Unwritable, the table is returned from memory
+    blocked = tmp_path / 'blocked'
+    blocked.write_text('')
+    np.testing.assert_array_equal(class_tables.cached_class_table(protobuf_path,table_dir=str(blocked)),expected)
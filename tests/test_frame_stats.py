@@ -0,0 +1,83 @@
+from class_tables import class_tables_from_trajectories
+import frame_stats
+import numpy as np
+import os
+import shutil
+from synthetic import write_synthetic_frames
+
+# The class and instance pixel counts of one frame, a pixel at a time
+def reference_pixel_counts(instance,lut,num_classes):
+    class_pixels = np.zeros(num_classes,dtype=np.int64)
+    instance_pixels = {}
+    for instance_id in instance.ravel().tolist():
+        class_pixels[lut[instance_id] if instance_id < len(lut) else 0] += 1
+        instance_pixels[instance_id] = instance_pixels.get(instance_id,0) + 1
+    return class_pixels, instance_pixels
+
+def test_histograms_match_reference():
+    rng = np.random.RandomState(0)
+    instance = rng.randint(0,12,(4,6,8)).astype(np.uint16)
+    # Ids 8 and up are past the end of the lookup table
+    lut = np.array([0,3,3,1,2,0,4,1],dtype=np.uint8)
+    instance_counts = frame_stats.instance_histograms(instance,len(lut))
+    assert instance_counts.shape == (4,instance.max() + 1)
+    class_pixels = frame_stats.class_histograms(instance_counts,lut,5)
+    for frame in range(4):
+        expected_classes, expected_instances = reference_pixel_counts(instance[frame],lut,5)
+        np.testing.assert_array_equal(class_pixels[frame],expected_classes)
+        assert {i:int(c) for i,c in enumerate(instance_counts[frame]) if c} == expected_instances
+
+def test_depth_statistics():
+    depth = np.array([[[0,0],[0,0]],[[0,1000],[3000,2000]]],dtype=np.uint16)
+    depth_min, depth_max, depth_sum, zero_pixels = frame_stats.depth_statistics(depth)
+    np.testing.assert_array_equal(depth_min,[0,1000])
+    np.testing.assert_array_equal(depth_max,[0,3000])
+    np.testing.assert_array_equal(depth_sum,[0,6000])
+    np.testing.assert_array_equal(zero_pixels,[4,1])
+
+def test_build_frame_stats_round_trip(tmp_path,trajectories,protobuf_path):
+    root_path = str(tmp_path / 'val')
+    frames = [write_synthetic_frames(root_path,traj,seed=traj_idx)
+              for traj_idx,traj in enumerate(trajectories.trajectories)]
+    # A trajectory that cannot be read is left out of the index
+    shutil.rmtree(os.path.join(root_path,trajectories.trajectories[1].render_path,'instance'))
+    index, failures = frame_stats.build_frame_stats(protobuf_path,root_path,chunk_size=4)
+    assert failures == [trajectories.trajectories[1].render_path]
+    read = [0,2]
+    assert list(index['render_path']) == [trajectories.trajectories[traj_idx].render_path for traj_idx in read]
+    np.testing.assert_array_equal(index['trajectory_index'],np.repeat(read,6))
+    np.testing.assert_array_equal(index['frame_offsets'],[0,6,12])
+
+    table = class_tables_from_trajectories(trajectories.trajectories)[0]['13_classes']
+    num_classes = len(index['class_names'])
+    for frame_idx in range(len(index['frame_num'])):
+        traj_idx = index['trajectory_index'][frame_idx]
+        view_idx = frame_idx % 6
+        depth, instance = frames[traj_idx][0][view_idx], frames[traj_idx][1][view_idx]
+        assert index['frame_num'][frame_idx] == trajectories.trajectories[traj_idx].views[view_idx].frame_num
+        expected_classes, expected_instances = reference_pixel_counts(instance,table[traj_idx],num_classes)
+        np.testing.assert_array_equal(index['class_pixels'][frame_idx],expected_classes)
+        start, end = index['instance_offsets'][frame_idx:frame_idx + 2]
+        assert dict(zip(index['instance_ids'][start:end].tolist(),index['instance_pixels'][start:end].tolist())) == expected_instances
+        valid = depth[depth > 0]
+        assert index['depth_min'][frame_idx] == valid.min()
+        assert index['depth_max'][frame_idx] == valid.max()
+        assert abs(index['depth_mean'][frame_idx] - valid.mean()) < 1e-3
+        assert index['zero_depth_fraction'][frame_idx] == np.float32((depth == 0).mean())
+    np.testing.assert_array_equal(index['trajectory_class_pixels'],
+                                  [index['class_pixels'][:6].sum(axis=0),index['class_pixels'][6:].sum(axis=0)])
+    np.testing.assert_array_equal(index['image_shape'],[48,64])
+
+    path = str(tmp_path / 'stats.npz')
+    frame_stats.save_frame_stats(path,index)
+    loaded = frame_stats.load_frame_stats(path)
+    assert sorted(loaded.files) == sorted(frame_stats.FRAME_STATS_COLUMNS + frame_stats.TRAJECTORY_STATS_COLUMNS)
+    for column in loaded.files:
+        np.testing.assert_array_equal(loaded[column],index[column])
+        assert loaded[column].dtype == index[column].dtype
+
+def test_median_frequency_weights():
+    class_pixels = np.array([[10,30,0,60],[50,0,50,0]])
+    weights = frame_stats.median_frequency_weights(class_pixels)
+    # freq 1: 30/100, 2: 50/100, 3: 60/100, the median being that of class 2
+    np.testing.assert_allclose(weights,[0,0.5 / 0.3,1.0,0.5 / 0.6])
@@ -0,0 +1,43 @@
+import frame_store
+from frame_store import ViewRef
+import numpy as np
+import os
+from read_protobuf import photo_path_from_view
+from synthetic import write_synthetic_frames
+
+def test_packed_frames_match_files(tmp_path,trajectories):
+    root_path = str(tmp_path / 'val')
+    store_root = str(tmp_path / 'store')
+    traj = trajectories.trajectories[0]
+    depth, instance = write_synthetic_frames(root_path,traj)
+    frame_nums = [view.frame_num for view in traj.views]
+    assert frame_store.pack_trajectory(traj.render_path,frame_nums,root_path,store_root) == len(frame_nums)
+    # A complete store is not packed again
+    assert frame_store.pack_trajectory(traj.render_path,frame_nums,root_path,store_root) == 0
+    for view_idx,frame_num in enumerate(frame_nums):
+        view = ViewRef(frame_num)
+        for load in (frame_store.depth_from_view,frame_store.instance_from_view,frame_store.photo_from_view):
+            np.testing.assert_array_equal(load(traj.render_path,view,root_path,'packed',store_root),
+                                          load(traj.render_path,view,root_path,'files'))
+        np.testing.assert_array_equal(frame_store.depth_from_view(traj.render_path,view,root_path,'packed',store_root),
+                                      depth[view_idx])
+        np.testing.assert_array_equal(frame_store.instance_from_view(traj.render_path,view,root_path,'packed',store_root),
+                                      instance[view_idx])
+        # The jpegs are stored unchanged
+        packed = frame_store.open_packed_trajectory(frame_store.packed_dir_for(traj.render_path,root_path,store_root))
+        with open(photo_path_from_view(traj.render_path,view,root_path),'rb') as f:
+            assert packed.photo_bytes(frame_num) == f.read()
+
+def test_repack_without_photos(tmp_path,trajectories):
+    root_path = str(tmp_path / 'val')
+    traj = trajectories.trajectories[1]
+    write_synthetic_frames(root_path,traj)
+    frame_nums = [view.frame_num for view in traj.views]
+    frame_store.pack_trajectory(traj.render_path,frame_nums,root_path)
+    store_dir = frame_store.packed_dir_for(traj.render_path,root_path)
+    assert os.path.isfile(os.path.join(store_dir,'photo.jpgs'))
+    frame_store.pack_trajectory(traj.render_path,frame_nums[:3],root_path,photos=False,force=True)
+    assert not os.path.isfile(os.path.join(store_dir,'photo.jpgs'))
+    packed = frame_store.PackedTrajectory(store_dir)
+    assert len(packed) == 3
+    assert packed.depth.shape == (3,48,64)
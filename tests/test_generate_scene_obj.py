@@ -0,0 +1,120 @@
+import generate_scene_obj
+import io
+import numpy
+import os
+import pytest
+import random
+import scenenet_pb2 as sn
+
+# The per-line obj merge of the original script, with the --v1 flag passed in
+# rather than read from the parsed arguments
+def baseline_merge_scenenet_obj(output_obj_file, input_path, instance, k, offsets, v1=False):
+    num_v = 0
+    num_vt = 0
+    num_vn = 0
+    offset_v, offset_vt, offset_vn = offsets
+
+    height = instance.object_info.height_meters
+    i = instance.object_info.object_pose
+    T = numpy.array([i.translation_x, i.translation_y, i.translation_z])
+    R = numpy.array([
+        [i.rotation_mat11, i.rotation_mat12, i.rotation_mat13],
+        [i.rotation_mat21, i.rotation_mat22, i.rotation_mat23],
+        [i.rotation_mat31, i.rotation_mat32, i.rotation_mat33],
+    ])
+    vertices = []
+    with open(input_path, 'r') as f:
+        for l in f:
+            if l.startswith('v '):
+                vertices.append([float(s) for s in l[2:].split()[:3]])
+    bb = (min(v[0] for v in vertices), max(v[0] for v in vertices), min(v[1] for v in vertices),
+          max(v[1] for v in vertices), min(v[2] for v in vertices), max(v[2] for v in vertices))
+    centroid = numpy.array(
+        [bb[0] + ((bb[1] - bb[0]) / 2.0), bb[2] + ((bb[3] - bb[2]) / 2.0), bb[4] + ((bb[5] - bb[4]) / 2.0)])
+    centroid[1] -= 0.6 * (bb[3] - bb[2])
+
+    input_file = open(input_path, 'r')
+    output_obj_file.write('o rand_obj.%d\n' % k)
+    for l in input_file:
+        if l.startswith('v '):
+            num_v += 1
+            s = l[2:].split()
+            p = numpy.array([float(s[0]), float(s[1]), float(s[2])])
+            if v1:
+                tmp = p[0]
+                p[0] = p[2]
+                p[2] = -tmp
+            p = (p - centroid) * (height / (bb[3] - bb[2]))
+            p = R.dot(p) + T
+            output_obj_file.write('v %f %f %f\n' % (p[0], p[1], p[2]))
+        elif l.startswith('vt '):
+            num_vt += 1
+            output_obj_file.write(l)
+        elif l.startswith('vn '):
+            num_vn += 1
+            s = l[2:].split()
+            n = R.dot(numpy.array([float(s[0]), float(s[1]), float(s[2])]))
+            output_obj_file.write('vn %f %f %f\n' % (n[0],n[1],n[2]))
+        elif l.startswith('f '):
+            s = 'f'
+            for p in l[2:].split():
+                s += ' '
+                if '/' in p:
+                    try:
+                        vid_s, vtid_s, vnid_s = p.split('/')
+                    except ValueError:
+                        vid_s, vtid_s = p.split('/')
+                        vnid_s = None
+                    s += str(int(vid_s) + offset_v)
+                    s += '/'
+                    if vtid_s:
+                        s += str(int(vtid_s) + offset_vt)
+                    s += '/'
+                    if vnid_s:
+                        s += str(int(vnid_s) + offset_vn)
+                else:
+                    s += str(int(p) + offset_v)
+            output_obj_file.write(s + '\n')
+        elif l.startswith('mtllib '):
+            pass
+        else:
+            output_obj_file.write(l)
+    input_file.close()
+    return [offset_v + num_v, offset_vt + num_vt, offset_vn + num_vn]
+
+# An obj with runs of every line kind and every face corner layout, including
+# the v/vt corners of some v1 models
+def write_sample_obj(path, num_vertices=200, seed=0):
+    rng = random.Random(seed)
+    lines = ['# sample\n', 'mtllib model.mtl\n', 'o thing\n', 'g group\n']
+    for block in range(3):
+        lines += ['v %r %r %r\n' % (rng.uniform(-1,1), rng.uniform(-1,1), rng.uniform(-1,1)) for _ in range(num_vertices)]
+        lines += ['vt %f %f\n' % (rng.random(), rng.random()) for _ in range(num_vertices // 2)]
+        lines += ['vn %.6f %.6f %.6f\n' % (rng.uniform(-1,1), rng.uniform(-1,1), rng.uniform(-1,1)) for _ in range(num_vertices // 3)]
+        lines += ['usemtl m%d\n' % block, 's off\n', '\n']
+        for _ in range(num_vertices):
+            corner = rng.choice(['{0}', '{0}/{0}/{0}', '{0}//{0}', '{0}/{0}'])
+            lines.append('f %s\n' % ' '.join(corner.format(rng.randint(1,num_vertices)) for _ in range(3)))
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(''.join(lines))
+
+@pytest.mark.parametrize('v1', [False, True])
+def test_merge_scenenet_obj_matches_baseline(tmp_path, trajectories, v1):
+    shapenet_dir = str(tmp_path / 'shapenet')
+    instances = [instance for instance in trajectories.trajectories[0].instances
+                 if instance.instance_type == sn.Instance.RANDOM_OBJECT]
+    model_name = 'model.obj' if v1 else os.path.join('models', 'model_normalized.obj')
+    for seed, shapenet_hash in enumerate(sorted(set(instance.object_info.shapenet_hash for instance in instances))):
+        write_sample_obj(os.path.join(shapenet_dir, shapenet_hash, model_name), seed=seed)
+    for mesh_cache_dir in (None, str(tmp_path / 'cache')):
+        offsets = expected_offsets = [10, 5, 3]
+        output = io.StringIO()
+        expected = io.StringIO()
+        for k, instance in enumerate(instances):
+            input_path = generate_scene_obj.load_obj(shapenet_dir, instance, 'obj', v1=v1)
+            offsets = generate_scene_obj.merge_scenenet_obj(output, shapenet_dir, instance, k, offsets, v1=v1,
+                                                            mesh_cache_dir=mesh_cache_dir)
+            expected_offsets = baseline_merge_scenenet_obj(expected, input_path, instance, k, expected_offsets, v1=v1)
+            assert offsets == expected_offsets
+        assert output.getvalue() == expected.getvalue()
@@ -0,0 +1,73 @@
+import geometry
+from geometry import normalised_pixel_to_ray_array, pixel_to_ray
+import numpy as np
+from synthetic import shutter_pose_arrays, synthetic_depth
+
+# The per-pixel ray array of the original scripts
+def baseline_normalised_pixel_to_ray_array(width=320,height=240):
+    def normalize(v):
+        return v/np.linalg.norm(v)
+    pixel_to_ray_array = np.zeros((height,width,3))
+    for y in range(height):
+        for x in range(width):
+            pixel_to_ray_array[y,x] = normalize(np.array(pixel_to_ray((x,y),pixel_height=height,pixel_width=width)))
+    return pixel_to_ray_array
+
+def test_ray_array_matches_baseline():
+    for width, height in ((320,240),(64,48)):
+        np.testing.assert_allclose(normalised_pixel_to_ray_array(width,height),
+                                   baseline_normalised_pixel_to_ray_array(width,height),rtol=0,atol=1e-15)
+
+def test_ray_array_cache(tmp_path):
+    rays = normalised_pixel_to_ray_array(64,48,cache_dir=str(tmp_path))
+    path = tmp_path / geometry.ray_array_filename(64,48,60,45,'float64')
+    assert path.is_file()
+    np.testing.assert_array_equal(np.load(str(path)),normalised_pixel_to_ray_array(64,48))
+    assert not rays.flags.writeable
+    assert normalised_pixel_to_ray_array(32,24,dtype=np.float32).dtype == np.float32
+
+def test_extrinsics_match_per_view_transforms(trajectories):
+    from calculate_optical_flow import camera_to_world_with_pose, interpolate_poses, world_to_camera_with_pose
+    views = [view for traj in trajectories.trajectories for view in traj.views]
+    camera, lookat = shutter_pose_arrays(views)
+    for alpha in (0.0,0.5,1.0):
+        wTc, cTw = geometry.extrinsics_from_shutter_poses(camera,lookat,alpha)
+        for view_idx,view in enumerate(views):
+            # interpolate_poses stores the pose in the single precision
+            # protobuf fields, so the original is only float32 accurate
+            view_pose = interpolate_poses(view.shutter_open,view.shutter_close,alpha)
+            np.testing.assert_allclose(wTc[view_idx],world_to_camera_with_pose(view_pose),rtol=0,atol=1e-6)
+            np.testing.assert_allclose(cTw[view_idx],camera_to_world_with_pose(view_pose),rtol=0,atol=1e-6)
+
+def test_interpolate_pose_arrays_per_row_alpha(trajectories):
+    camera, lookat = shutter_pose_arrays(trajectories.trajectories[0].views)
+    alpha = np.linspace(0,1,len(camera))
+    interpolated = geometry.interpolate_pose_arrays(camera[:,0],camera[:,1],alpha)
+    for row in range(len(camera)):
+        np.testing.assert_allclose(interpolated[row],geometry.interpolate_pose_arrays(camera[row:row + 1,0],camera[row:row + 1,1],alpha[row])[0])
+
+# The original scripts' projection, homogeneous camera points of each pixel
+# times the 4x4 camera to world transform
+def baseline_depth_to_world_points(depth,camera_to_world):
+    from calculate_optical_flow import points_in_camera_coords, transform_points
+    rays = baseline_normalised_pixel_to_ray_array(depth.shape[1],depth.shape[0])
+    return transform_points(camera_to_world,points_in_camera_coords(depth,rays))[:,:,:3]
+
+def test_depth_to_world_points_matches_baseline(trajectories):
+    camera, lookat = shutter_pose_arrays(trajectories.trajectories[0].views[:3])
+    cTw = geometry.extrinsics_from_shutter_poses(camera,lookat)[1]
+    depth = np.stack([synthetic_depth(seed=seed) for seed in range(3)])
+    depth[:,0,:5] = 0.0
+    points, valid = geometry.depth_to_world_points(depth,cTw,return_mask=True)
+    for frame in range(3):
+        np.testing.assert_allclose(points[frame],baseline_depth_to_world_points(depth[frame],cTw[frame]),
+                                   rtol=0,atol=1e-12)
+    np.testing.assert_array_equal(valid,depth > 0)
+    # A non contiguous out is filled through a buffer
+    out = np.zeros((3,48,64,4))[...,:3]
+    geometry.depth_to_world_points(depth,cTw,out=out)
+    np.testing.assert_array_equal(out,points)
+    millimetres = np.round(depth * 1000).astype(np.uint16)
+    cloud = geometry.depth_to_point_cloud(millimetres,cTw,depth_scale=0.001,dtype=np.float64,chunk_size=2)
+    expected = geometry.depth_to_world_points(millimetres,cTw,depth_scale=0.001)[millimetres > 0]
+    np.testing.assert_array_equal(cloud,expected)
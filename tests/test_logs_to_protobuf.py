@@ -0,0 +1,83 @@
+from collections import namedtuple
+import logs_to_protobuf
+import numpy as np
+import pytest
+import random
+import re
+
+PoseData = namedtuple('PoseData', ['time', 'camera_position', 'camera_lookat'])
+
+# The per-line regex parse of the original script
+def baseline_parse_log_to_frame_pose_pairs(log_lines,skip_frames = 25):
+    def chunks(l, n):
+        for i in range(0, len(l), n):
+            yield l[i:i + n]
+    regex = re.compile(r"time:([e\.\-\d]+) pose:([e\.\-\d]+),([e\.\-\d]+),([e\.\-\d]+) lookat:([e\.\-\d]+),([e\.\-\d]+),([e\.\-\d]+)")
+    time_center_lookats = []
+    for line in log_lines:
+        m = regex.search(line)
+        if m is not None:
+            time_center_lookat = PoseData(time=float(m.group(1)),
+                                            camera_position=np.array([float(m.group(i)) for i in range(2, 5)]),
+                                            camera_lookat=np.array([float(m.group(i)) for i in range(5, 8)]))
+            time_center_lookats.append(time_center_lookat)
+    frame_pose_pair_list = []
+    for idx,(shutter_open, shutter_close) in enumerate(chunks(time_center_lookats,2)):
+        if idx % skip_frames == 0:
+            frame_pose_pair_list.append((shutter_open,shutter_close))
+    return frame_pose_pair_list
+
+def synthetic_log_lines(num_poses=120,seed=0,line_ending='\n'):
+    rng = random.Random(seed)
+    lines = ['instance:1;04379243,table;table;hash{0}'.format(line_ending)]
+    for pose_idx in range(num_poses):
+        values = [pose_idx * 0.01] + [rng.uniform(-5,5) for _ in range(6)]
+        if pose_idx % 7 == 0:
+            values[3] = 1.5e-05
+        lines.append('time:{0!r} pose:{1!r},{2!r},{3!r} lookat:{4!r},{5!r},{6!r}{7}'.format(*(values + [line_ending])))
+    return lines
+
+def assert_same_pairs(pairs,expected):
+    assert len(pairs) == len(expected)
+    for pair,expected_pair in zip(pairs,expected):
+        for pose,expected_pose in zip(pair,expected_pair):
+            assert pose.time == expected_pose.time
+            np.testing.assert_array_equal(pose.camera_position,expected_pose.camera_position)
+            np.testing.assert_array_equal(pose.camera_lookat,expected_pose.camera_lookat)
+
+@pytest.mark.parametrize('line_ending',['\n','\r\n',''])
+def test_parse_matches_baseline(line_ending):
+    lines = synthetic_log_lines(line_ending=line_ending)
+    for skip_frames in (1,3,25):
+        assert_same_pairs(logs_to_protobuf.parse_log_to_frame_pose_pairs(lines,skip_frames),
+                          baseline_parse_log_to_frame_pose_pairs(lines,skip_frames))
+
+# Lines the fast path cannot take, which the regex skips or reads in part
+@pytest.mark.parametrize('malformed',[
+    'time:1.0 pose:1e+05,2,3 lookat:4,5,6\n',
+    'time:1.0 pose:nan,2,3 lookat:4,5,6\n',
+    'time:1.0 pose:1,inf,3 lookat:4,5,6\n',
+    'time:1.0\tpose:1,2,3 lookat:4,5,6\n',
+    'time:1.0 pose:1,2,3 lookat:4,5,6,7\n',
+    'warning, time:1.0 pose:1,2,3 lookat:4,5,6\n',
+])
+def test_parse_malformed_lines_match_baseline(malformed):
+    lines = synthetic_log_lines()
+    for position in (5,6,len(lines)):
+        malformed_lines = lines[:position] + [malformed,malformed] + lines[position:]
+        for skip_frames in (1,25):
+            assert_same_pairs(logs_to_protobuf.parse_log_to_frame_pose_pairs(malformed_lines,skip_frames),
+                              baseline_parse_log_to_frame_pose_pairs(malformed_lines,skip_frames))
+
+def test_parse_odd_pose_count():
+    lines = synthetic_log_lines(num_poses=51)
+    with pytest.raises(ValueError):
+        baseline_parse_log_to_frame_pose_pairs(lines)
+    with pytest.raises(ValueError):
+        logs_to_protobuf.parse_log_to_frame_pose_pairs(lines)
+
+def test_frame_pose_array_layout():
+    lines = synthetic_log_lines()
+    poses = logs_to_protobuf.parse_log_to_frame_pose_array(lines,skip_frames=25)
+    assert poses.shape == (3,2,logs_to_protobuf.POSE_COLUMNS)
+    np.testing.assert_array_equal(poses[:,:,0],[[0.0,0.01],[0.5,0.51],[1.0,1.01]])
@@ -0,0 +1,127 @@
+import calculate_optical_flow as flow_module
+from geometry import normalised_pixel_to_ray_array
+import math
+import numpy as np
+import pytest
+from synthetic import shutter_pose_arrays, synthetic_depth
+
+# The per-pixel flow_to_hsv_image of the original script, with the image
+# size taken from the flow rather than fixed at 240x320
+def baseline_flow_to_hsv_image(flow, magnitude_scale=1.0/100.0):
+    hsv = np.empty(flow.shape[:2] + (3,))
+    for row in range(flow.shape[0]):
+        for col in range(flow.shape[1]):
+            v = flow[row,col,:]
+            magnitude = np.linalg.norm(v)
+            if magnitude < 1e-8:
+                hsv[row,col,0] = 0.0
+                hsv[row,col,1] = 0.0
+                hsv[row,col,2] = 0.0
+            else:
+                direction = v / magnitude
+                theta = math.atan2(direction[1], direction[0])
+                if theta <= 0:
+                    theta += 2*math.pi
+                assert(theta >= 0.0 and theta <= 2*math.pi)
+                hsv[row,col,0] = theta / (2*math.pi)
+                hsv[row,col,1] = 1.0
+                hsv[row,col,2] = min(magnitude * magnitude_scale, 1.0)
+    return hsv
+
+# scipy.misc.bytescale, which scipy.misc.imsave applied to the float rgb image
+def bytescale(data, high=255, low=0):
+    cmin = data.min()
+    cscale = data.max() - cmin
+    if cscale == 0:
+        cscale = 1
+    bytedata = (data - cmin) * (float(high - low) / cscale) + low
+    return (bytedata.clip(low, high) + 0.5).astype(np.uint8)
+
+def synthetic_flow(height=48,width=64,seed=0):
+    rng = np.random.RandomState(seed)
+    flow = rng.normal(0,80,(height,width,2))
+    flow[:4] = 0.0
+    # Axis aligned directions, where the hue wraps
+    flow[4,:4] = [[1,0],[-1,0],[0,1],[0,-1]]
+    return flow
+
+def test_flow_to_hsv_image_matches_baseline():
+    flow = synthetic_flow()
+    np.testing.assert_allclose(flow_module.flow_to_hsv_image(flow),baseline_flow_to_hsv_image(flow),rtol=0,atol=1e-15)
+    batch = np.stack([synthetic_flow(seed=seed) for seed in range(3)])
+    np.testing.assert_array_equal(flow_module.flow_to_hsv_image(batch)[2],flow_module.flow_to_hsv_image(batch[2]))
+
+def test_hsv_to_rgb_matches_matplotlib():
+    colors = pytest.importorskip('matplotlib.colors')
+    hsv = flow_module.flow_to_hsv_image(synthetic_flow())
+    np.testing.assert_allclose(flow_module.hsv_to_rgb(hsv),colors.hsv_to_rgb(hsv),rtol=0,atol=1e-15)
+
+def test_flow_to_rgb_image_matches_imsave():
+    flow = np.stack([synthetic_flow(seed=seed) for seed in range(3)])
+    rgb = flow_module.flow_to_rgb_image(flow,rescale=True)
+    for frame_flow,frame_rgb in zip(flow,rgb):
+        expected = bytescale(flow_module.hsv_to_rgb(baseline_flow_to_hsv_image(frame_flow)))
+        np.testing.assert_array_equal(frame_rgb,expected)
+    # A still frame is all black, and is not stretched
+    still = flow_module.flow_to_rgb_image(np.zeros((8,8,2)),rescale=True)
+    np.testing.assert_array_equal(still,0)
+    out = np.empty((48,64,3),dtype=np.uint8)
+    assert flow_module.flow_to_rgb_image(flow[0],out=out) is out
+
+def test_flo_round_trip(tmp_path):
+    flow = synthetic_flow().astype(np.float32)
+    path = str(tmp_path / '0.flo')
+    flow_module.write_flo(path,flow)
+    np.testing.assert_array_equal(flow_module.read_flo(path),flow)
+    assert (tmp_path / '0.flo').stat().st_size == 12 + flow.nbytes
+
+# The original script's flow of one view, the zero depth pixels moved 1km
+# away and projected into world space with the mid shutter pose
+def baseline_view_flow(depth,view):
+    from calculate_optical_flow import (camera_to_world_with_pose, flatten_points, interpolate_poses,
+                                        optical_flow, points_in_camera_coords, reshape_points,
+                                        transform_points)
+    height, width = depth.shape
+    depth = depth.copy()
+    depth[depth == 0.0] = 1000.0
+    points_in_camera = points_in_camera_coords(depth,normalised_pixel_to_ray_array(width,height))
+    camera_to_world_matrix = camera_to_world_with_pose(interpolate_poses(view.shutter_open,view.shutter_close,0.5))
+    points_in_world = flatten_points(transform_points(camera_to_world_matrix,points_in_camera))
+    flow = optical_flow(points_in_world,view.shutter_open,view.shutter_close,pixel_width=width,pixel_height=height)
+    return reshape_points(height,width,flow)
+
+def test_optical_flow_batch_matches_baseline(trajectories):
+    views = trajectories.trajectories[0].views
+    camera, lookat = shutter_pose_arrays(views)
+    depth = np.stack([synthetic_depth(seed=seed) for seed in range(len(views))])
+    depth[:,0,:5] = 0.0
+    flow = flow_module.optical_flow_batch(depth,camera,lookat,dtype=np.float64)
+    for view_idx,view in enumerate(views):
+        # The original interpolates the pose in the single precision protobuf
+        # fields, so only agrees to float32 accuracy
+        expected = baseline_view_flow(depth[view_idx],view)
+        np.testing.assert_allclose(flow[view_idx],expected,rtol=1e-4,atol=1e-3 * np.abs(expected).max())
+    assert flow_module.optical_flow_batch(depth,camera,lookat).dtype == np.float32
+
+def write_flow(output_dir,camera,lookat,depth,**kwargs):
+    frame_nums = [25 * idx for idx in range(len(depth))]
+    def load_depth(frame_num):
+        return depth[frame_num // 25]
+    return flow_module.write_trajectory_flow(str(output_dir),frame_nums,camera,lookat,load_depth,**kwargs)
+
+def test_write_trajectory_flow_chunks(tmp_path,trajectories):
+    camera, lookat = shutter_pose_arrays(trajectories.trajectories[1].views)
+    depth = np.stack([np.round(synthetic_depth(seed=seed) * 1000).astype(np.uint16) for seed in range(len(camera))])
+    names = ['optical_flow','forward_flow','backward_flow','out_of_frame','occluded']
+    assert write_flow(tmp_path / 'whole',camera,lookat,depth,forward_backward=True) == len(depth)
+    write_flow(tmp_path / 'chunked',camera,lookat,depth,forward_backward=True,chunk_size=4)
+    for name in names:
+        whole = np.load(str(tmp_path / 'whole' / (name + '.npy')))
+        np.testing.assert_array_equal(np.load(str(tmp_path / 'chunked' / (name + '.npy'))),whole)
+    flow = np.load(str(tmp_path / 'whole' / 'optical_flow.npy'))
+    assert flow.shape == depth.shape + (2,)
+    # The .flo files hold the displacement over the 1/60s shutter
+    write_flow(tmp_path / 'flo',camera,lookat,depth,flow_format='flo',chunk_size=4)
+    for view_idx in range(len(depth)):
+        flo = flow_module.read_flo(str(tmp_path / 'flo' / '{0}.flo'.format(25 * view_idx)))
+        np.testing.assert_allclose(flo,flow[view_idx] * np.float32(1.0 / 60),rtol=1e-6)
@@ -0,0 +1,45 @@
+import numpy as np
+import os
+import pose_table
+from synthetic import shutter_pose_arrays
+
+def assert_table_matches(table,trajectories):
+    assert list(table['render_path']) == [traj.render_path for traj in trajectories.trajectories]
+    for traj_idx,traj in enumerate(trajectories.trajectories):
+        num_views = len(traj.views)
+        assert table['num_views'][traj_idx] == num_views
+        camera, lookat = shutter_pose_arrays(traj.views)
+        np.testing.assert_array_equal(table['camera'][traj_idx,:num_views],camera)
+        np.testing.assert_array_equal(table['lookat'][traj_idx,:num_views],lookat)
+        np.testing.assert_array_equal(table['timestamp'][traj_idx,:num_views],
+                                      [[view.shutter_open.timestamp,view.shutter_close.timestamp] for view in traj.views])
+        np.testing.assert_array_equal(table['frame_num'][traj_idx,:num_views],[view.frame_num for view in traj.views])
+        # Shorter trajectories are padded
+        assert np.all(np.isnan(table['camera'][traj_idx,num_views:]))
+        assert np.all(table['frame_num'][traj_idx,num_views:] == -1)
+
+def test_pose_table_matches_views(trajectories):
+    del trajectories.trajectories[1].views[2:]
+    table = pose_table.pose_table_from_trajectories(trajectories.trajectories)
+    assert table['camera'].shape == (3,6,2,3)
+    assert_table_matches(table,trajectories)
+
+def test_cached_pose_table_round_trip(tmp_path,trajectories,protobuf_path):
+    table_dir = str(tmp_path / 'poses')
+    table = pose_table.cached_pose_table(protobuf_path,table_dir)
+    assert isinstance(table['camera'],np.memmap)
+    assert_table_matches(table,trajectories)
+    # A newer protobuf rebuilds the table
+    del trajectories.trajectories[0].views[3:]
+    with open(protobuf_path,'wb') as f:
+        f.write(trajectories.SerializeToString())
+    marker = os.path.join(table_dir,'render_path.npy')
+    os.utime(marker,(0,0))
+    assert_table_matches(pose_table.cached_pose_table(protobuf_path,table_dir),trajectories)
+    assert os.path.getmtime(marker) > 0
+
+def test_cached_pose_table_unwritable(tmp_path,trajectories,protobuf_path):
+    # A file where the table directory should be
+    table_dir = tmp_path / 'poses'
+    table_dir.write_text('')
+    assert_table_matches(pose_table.cached_pose_table(protobuf_path,str(table_dir)),trajectories)
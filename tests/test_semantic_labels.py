@@ -0,0 +1,52 @@
+import convert_instance2class
+import numpy as np
+from PIL import Image
+from semantic_labels import class_lookup_table, colour_palette, instance_to_class
+
+# The per-instance masking of the original save_class_from_instance
+def baseline_instance_to_class(instance_img,mapping,colour_code):
+    class_img = np.zeros(instance_img.shape)
+    h,w  = instance_img.shape
+    class_img_rgb = np.zeros((h,w,3),dtype=np.uint8)
+    for instance, semantic_class in mapping.items():
+        class_img[instance_img == instance] = semantic_class
+        for channel in range(3):
+            class_img_rgb[:,:,channel][instance_img == instance] = np.uint8(colour_code[semantic_class][channel]*255)
+    return np.uint8(class_img), class_img_rgb
+
+def synthetic_instances(seed=0,height=48,width=64):
+    rng = np.random.RandomState(seed)
+    return rng.randint(0,40,(height,width)).astype(np.uint16)
+
+MAPPING = {instance_id:(instance_id * 7) % 14 for instance_id in range(1,30)}
+
+def test_instance_to_class_matches_baseline():
+    palette = colour_palette(convert_instance2class.colour_code)
+    lut = class_lookup_table(MAPPING)
+    for seed in range(3):
+        instance_img = synthetic_instances(seed)
+        class_img, rgb = instance_to_class(instance_img,lut,palette)
+        expected_class, expected_rgb = baseline_instance_to_class(instance_img,MAPPING,convert_instance2class.colour_code)
+        np.testing.assert_array_equal(class_img,expected_class)
+        np.testing.assert_array_equal(rgb,expected_rgb)
+    stack = np.stack([synthetic_instances(seed) for seed in range(3)])
+    np.testing.assert_array_equal(instance_to_class(stack,lut)[1],instance_to_class(stack[1],lut))
+
+def test_short_lookup_table():
+    # A class table row only as wide as the largest instance id
+    lut = class_lookup_table(MAPPING)[:30]
+    instance_img = synthetic_instances()
+    expected = baseline_instance_to_class(instance_img,MAPPING,convert_instance2class.colour_code)[0]
+    np.testing.assert_array_equal(instance_to_class(instance_img,lut),expected)
+    assert np.all(instance_to_class(instance_img,lut)[instance_img >= 30] == 0)
+
+def test_save_class_from_instance(tmp_path):
+    instance_img = synthetic_instances()
+    instance_path = str(tmp_path / 'instance.png')
+    Image.fromarray(instance_img).save(instance_path)
+    class_path = str(tmp_path / 'class.png')
+    colour_path = str(tmp_path / 'colour.png')
+    convert_instance2class.save_class_from_instance(instance_path,class_path,colour_path,MAPPING)
+    expected_class, expected_rgb = baseline_instance_to_class(instance_img,MAPPING,convert_instance2class.colour_code)
+    np.testing.assert_array_equal(np.asarray(Image.open(class_path)),expected_class)
+    np.testing.assert_array_equal(np.asarray(Image.open(colour_path)),expected_rgb)
@@ -0,0 +1,44 @@
+from calculate_surface_normals import points_in_camera_coords, surface_normal, surface_normals_batch
+from geometry import normalised_pixel_to_ray_array
+import numpy as np
+from synthetic import synthetic_depth
+
+# The per-pixel surface_normal of the original script, with the image size
+# taken from the points rather than fixed at 240x320
+def baseline_surface_normal(points):
+    def normalize(v):
+        return v/np.linalg.norm(v)
+    d = 2
+    lookups = {0:(-d,0),1:(-d,d),2:(0,d),3:(d,d),4:(d,0),5:(d,-d),6:(0,-d),7:(-d,-d)}
+    surface_normals = np.zeros((points.shape[0],points.shape[1],3))
+    for i in range(points.shape[0]):
+        for j in range(points.shape[1]):
+            min_diff = None
+            point1 = points[i,j,:3]
+            for k in range(8):
+                try:
+                    point2 = points[i+lookups[k][0],j+lookups[k][1],:3]
+                    point3 = points[i+lookups[(k+2)%8][0],j+lookups[(k+2)%8][1],:3]
+                    diff = np.linalg.norm(point2 - point1) + np.linalg.norm(point3 - point1)
+                    if min_diff is None or diff < min_diff:
+                        normal = normalize(np.cross(point2-point1,point3-point1))
+                        min_diff = diff
+                except IndexError:
+                    continue
+            surface_normals[i,j,:3] = normal
+    return surface_normals
+
+def camera_points(seed=0):
+    depth = synthetic_depth(seed=seed)
+    height, width = depth.shape
+    return points_in_camera_coords(depth,normalised_pixel_to_ray_array(width,height))
+
+def test_surface_normal_matches_baseline():
+    points = camera_points()
+    np.testing.assert_allclose(surface_normal(points),baseline_surface_normal(points),rtol=0,atol=1e-12)
+
+def test_surface_normals_batch_chunks():
+    points = np.stack([camera_points(seed) for seed in range(5)])
+    normals = surface_normals_batch(points,chunk_size=2)
+    np.testing.assert_array_equal(normals,surface_normals_batch(points,chunk_size=16))
+    np.testing.assert_array_equal(normals[3],surface_normal(points[3]))
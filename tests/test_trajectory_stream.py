@@ -0,0 +1,43 @@
+import scenenet_pb2 as sn
+import trajectory_stream
+from synthetic import synthetic_trajectories
+
+def test_protobuf_stream_round_trip(tmp_path,trajectories,protobuf_path):
+    stream_path = str(tmp_path / 'test.trajs')
+    assert trajectory_stream.protobuf_to_stream(protobuf_path,stream_path) == 3
+    assert list(trajectory_stream.iter_trajectory_stream(stream_path)) == list(trajectories.trajectories)
+    round_trip_path = str(tmp_path / 'round_trip.pb')
+    assert trajectory_stream.stream_to_protobuf(stream_path,round_trip_path) == 3
+    with open(round_trip_path,'rb') as f, open(protobuf_path,'rb') as original:
+        assert f.read() == original.read()
+    round_trip = sn.Trajectories()
+    with open(round_trip_path,'rb') as f:
+        round_trip.ParseFromString(f.read())
+    assert round_trip == trajectories
+
+def test_stream_without_footer(tmp_path,trajectories):
+    stream_path = str(tmp_path / 'test.trajs')
+    with trajectory_stream.TrajectoryStreamWriter(stream_path) as writer:
+        for trajectory in trajectories.trajectories:
+            writer.write(trajectory)
+    offsets = trajectory_stream.read_stream_index(stream_path)
+    assert len(offsets) == 3
+    with open(stream_path,'rb') as f:
+        footer_offset = trajectory_stream.read_stream_footer(f)[1]
+        f.seek(0)
+        data = f.read()
+    # A crashed run, without the footer and with half of a fourth record
+    extra = synthetic_trajectories(num_trajectories=1,seed=1).trajectories[0]
+    partial = trajectory_stream.encode_varint(extra.ByteSize()) + extra.SerializeToString()
+    with open(stream_path,'wb') as f:
+        f.write(data[:footer_offset] + partial[:len(partial) // 2])
+    assert list(trajectory_stream.read_stream_index(stream_path)) == list(offsets)
+    assert list(trajectory_stream.iter_trajectory_stream(stream_path)) == list(trajectories.trajectories)
+    # Appending drops the partial record and writes the footer again
+    with trajectory_stream.TrajectoryStreamWriter(stream_path,append=True) as writer:
+        assert len(writer) == 3
+        writer.write(extra)
+    assert len(trajectory_stream.read_stream_index(stream_path)) == 4
+    assert list(trajectory_stream.iter_trajectory_stream(stream_path)) == list(trajectories.trajectories) + [extra]
+    raw = list(trajectory_stream.iter_trajectory_stream(stream_path,raw=True))
+    assert raw[-1] == extra.SerializeToString()
@@ -0,0 +1,85 @@
+from geometry import normalised_pixel_to_ray_array
+import math
+import numpy as np
+import tsdf_fusion
+from tsdf_fusion import TSDFVolume
+
+HEIGHT, WIDTH = 24, 32
+
+# A wall facing the camera at z = 1 and a step nearer the camera in one corner,
+# labelled 5 on the left and 7 on the right
+def plane_frame():
+    rays = normalised_pixel_to_ray_array(WIDTH,HEIGHT)
+    depth = 1.0 / rays[...,2]
+    depth[:8,:8] *= 0.8
+    instance = np.where(np.arange(WIDTH) < WIDTH // 2,5,7)[np.newaxis,:].repeat(HEIGHT,axis=0)
+    return depth.astype(np.float32), instance
+
+def camera_to_world(x):
+    transform = np.eye(4)
+    transform[0,3] = x
+    return transform
+
+# The update of a single voxel by a frame, one voxel at a time
+def reference_integrate(voxel,state,depth,transform,instance,volume):
+    centre = (np.array(voxel) + 0.5) * volume.voxel_size
+    point = transform[:3,:3].T.dot(centre - transform[:3,3])
+    if point[2] <= 1e-6:
+        return
+    u = round(((point[0] / point[2]) / math.tan(math.radians(volume.hfov / 2.0)) + 1.0) * WIDTH / 2.0 - 0.5)
+    v = round(((point[1] / point[2]) / math.tan(math.radians(volume.vfov / 2.0)) + 1.0) * HEIGHT / 2.0 - 0.5)
+    if not (0 <= u < WIDTH and 0 <= v < HEIGHT) or depth[v,u] <= 0:
+        return
+    sdf = float(depth[v,u]) - np.linalg.norm(point)
+    if sdf < -volume.truncation:
+        return
+    tsdf, weight, slots = state
+    state[0] = (tsdf * weight + min(sdf / volume.truncation,1.0)) / (weight + 1.0)
+    state[1] = min(weight + 1.0,volume.max_weight)
+    if abs(sdf) < volume.truncation:
+        label = int(instance[v,u])
+        if label not in slots and len(slots) == tsdf_fusion.LABEL_SLOTS:
+            # Space-Saving, the new label takes the least frequent slot
+            least = min(slots,key=slots.get)
+            slots[label] = slots.pop(least)
+        slots[label] = slots.get(label,0) + 1
+
+def test_integrate_matches_per_voxel_reference():
+    depth, instance = plane_frame()
+    transforms = [camera_to_world(0.0),camera_to_world(0.07),camera_to_world(-0.03)]
+    volume = TSDFVolume(voxel_size=0.05,truncation=0.15,labels=True)
+    for transform in transforms:
+        volume.integrate(depth,transform,instance)
+    coords, tsdf, labels = volume.observed_voxels(min_weight=0.0)
+    weight = volume.weight[:volume.num_blocks].reshape(-1)
+    assert len(coords) == volume.num_blocks * tsdf_fusion.BLOCK_SIZE ** 3
+    observed = 0
+    for voxel,voxel_tsdf,voxel_weight,voxel_label in zip(coords,tsdf,weight,labels):
+        state = [1.0,0.0,{}]
+        for transform in transforms:
+            reference_integrate(voxel,state,depth,transform,instance,volume)
+        assert abs(voxel_tsdf - state[0]) < 1e-6
+        assert voxel_weight == state[1]
+        if state[2]:
+            # Ties between equally frequent labels may go either way
+            assert state[2][voxel_label] == max(state[2].values())
+        else:
+            assert voxel_label == tsdf_fusion.UNKNOWN_LABEL
+        observed += state[1] > 0
+    assert observed > 1000
+
+def test_extract_mesh_of_plane():
+    depth, instance = plane_frame()
+    depth[:8,:8] /= 0.8
+    volume = TSDFVolume(voxel_size=0.05,labels=True)
+    volume.integrate(depth,camera_to_world(0.0),instance)
+    vertices, triangles, face_labels, vertex_labels = volume.extract_mesh()
+    assert len(vertices) and len(triangles)
+    np.testing.assert_allclose(vertices[:,2],1.0,atol=0.5 * volume.voxel_size)
+    assert triangles.max() < len(vertices)
+    assert set(np.unique(face_labels)) <= set([5,7])
+    assert set(np.unique(vertex_labels)) == set([5,7])
+
+def test_voxel_keys_round_trip():
+    coords = np.array([[0,0,0],[-5,3,7],[1000,-1000,12],[-(1 << 19),(1 << 19) - 1,0]])
+    np.testing.assert_array_equal(tsdf_fusion.coords_from_keys(tsdf_fusion.voxel_keys(coords)),coords)
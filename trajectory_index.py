@@ -0,0 +1,190 @@
+from atomic_files import atomic_open
+import mmap
+import numpy as np
+import os
+import scenenet_pb2 as sn
+
+# The scenenet_rgbd_*.pb files are a single Trajectories message, which on the
+# wire is just a concatenation of length delimited 'trajectories' (field 1)
+# records.  Rather than parsing the whole file, we scan it once to record the
+# byte range of each trajectory in a sidecar index and afterwards only decode
+# the trajectories that are actually accessed.
+
+TRAJECTORIES_FIELD = 1
+RENDER_PATH_FIELD = 4
+
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LENGTH_DELIMITED = 2
+WIRE_FIXED32 = 5
+
+def read_varint(buf,pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+def encode_varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+# The bytes appended to a Trajectories file for one serialized trajectory, so
+# that files can be written one trajectory at a time
+def trajectory_record(trajectory_bytes):
+    tag = (TRAJECTORIES_FIELD << 3) | WIRE_LENGTH_DELIMITED
+    return encode_varint(tag) + encode_varint(len(trajectory_bytes)) + trajectory_bytes
+
+# Returns the field number, wire type and the position of the field payload
+def read_tag(buf,pos):
+    tag, pos = read_varint(buf,pos)
+    return tag >> 3, tag & 0x7, pos
+
+# Returns the position after the field payload starting at pos
+def skip_field(buf,pos,wire_type):
+    if wire_type == WIRE_VARINT:
+        _, pos = read_varint(buf,pos)
+        return pos
+    if wire_type == WIRE_FIXED64:
+        return pos + 8
+    if wire_type == WIRE_LENGTH_DELIMITED:
+        length, pos = read_varint(buf,pos)
+        return pos + length
+    if wire_type == WIRE_FIXED32:
+        return pos + 4
+    raise ValueError('Unsupported protobuf wire type:{0} at byte:{1}'.format(wire_type,pos))
+
+# Only the top level fields of the trajectory are walked, the (large) instance
+# and view sub-messages are skipped over by their length prefix
+def render_path_in_trajectory(buf,start,end):
+    render_path = ''
+    pos = start
+    while pos < end:
+        field, wire_type, pos = read_tag(buf,pos)
+        if field == RENDER_PATH_FIELD and wire_type == WIRE_LENGTH_DELIMITED:
+            length, pos = read_varint(buf,pos)
+            render_path = bytes(buf[pos:pos+length]).decode('utf-8')
+            pos += length
+        else:
+            pos = skip_field(buf,pos,wire_type)
+    return render_path
+
+# Returns (offsets,lengths,render_paths) for every trajectory in the buffer
+def scan_trajectories(buf):
+    offsets = []
+    lengths = []
+    render_paths = []
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        field, wire_type, pos = read_tag(buf,pos)
+        if field == TRAJECTORIES_FIELD and wire_type == WIRE_LENGTH_DELIMITED:
+            length, pos = read_varint(buf,pos)
+            offsets.append(pos)
+            lengths.append(length)
+            render_paths.append(render_path_in_trajectory(buf,pos,pos+length))
+            pos += length
+        else:
+            pos = skip_field(buf,pos,wire_type)
+    return (np.array(offsets,dtype=np.int64),
+            np.array(lengths,dtype=np.int64),
+            np.array(render_paths,dtype=np.str_))
+
+def index_path_for(protobuf_path):
+    return protobuf_path + '.index.npz'
+
+class IndexedTrajectories(object):
+    # A read only, list like view of the trajectories in a protobuf file.
+    # Trajectories are decoded on demand by position or by render_path, e.g.
+    #   trajectories = IndexedTrajectories('data/scenenet_rgbd_val.pb')
+    #   traj = random.choice(trajectories)
+    #   traj = trajectories.by_render_path('0/223')
+    # The index is stored next to the protobuf (or at index_path) and rebuilt
+    # whenever the protobuf file size or modification time changes.
+    def __init__(self,protobuf_path,index_path=None):
+        self.protobuf_path = protobuf_path
+        self.index_path = index_path or index_path_for(protobuf_path)
+        self._file = open(protobuf_path,'rb')
+        stat = os.fstat(self._file.fileno())
+        self._source_stamp = np.array([stat.st_size,stat.st_mtime_ns],dtype=np.int64)
+        if stat.st_size > 0:
+            self._buf = mmap.mmap(self._file.fileno(),0,access=mmap.ACCESS_READ)
+        else:
+            self._buf = b''
+        if not self._load_index():
+            self.offsets, self.lengths, self.render_paths = scan_trajectories(self._buf)
+            self._save_index()
+        self._render_path_lookup = None
+
+    def _load_index(self):
+        if not os.path.isfile(self.index_path):
+            return False
+        with np.load(self.index_path) as index:
+            if not np.array_equal(index['source_stamp'],self._source_stamp):
+                return False
+            self.offsets = index['offsets']
+            self.lengths = index['lengths']
+            self.render_paths = index['render_paths']
+        return True
+
+    def _save_index(self):
+        try:
+            with atomic_open(self.index_path) as f:
+                np.savez(f,source_stamp=self._source_stamp,offsets=self.offsets,
+                         lengths=self.lengths,render_paths=self.render_paths)
+        except (IOError,OSError):
+            # The index is only an optimisation, e.g. the data directory may be
+            # read only, in which case it is rebuilt on the next run
+            print('Unable to write trajectory index to:{0}'.format(self.index_path))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    # Returns the serialized sn.Trajectory without decoding it, e.g. to hand
+    # to a worker process
+    def trajectory_bytes(self,idx):
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError('Trajectory index out of range:{0}'.format(idx))
+        start = int(self.offsets[idx])
+        return self._buf[start:start+int(self.lengths[idx])]
+
+    def __getitem__(self,idx):
+        trajectory = sn.Trajectory()
+        trajectory.ParseFromString(self.trajectory_bytes(idx))
+        return trajectory
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def index_of_render_path(self,render_path):
+        if self._render_path_lookup is None:
+            self._render_path_lookup = {path:idx for idx,path in enumerate(self.render_paths)}
+        return self._render_path_lookup[render_path]
+
+    def by_render_path(self,render_path):
+        return self[self.index_of_render_path(render_path)]
+
+    def close(self):
+        if isinstance(self._buf,mmap.mmap):
+            self._buf.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc_info):
+        self.close()
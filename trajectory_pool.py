@@ -0,0 +1,52 @@
+import multiprocessing
+import time
+
+# The process pool plumbing shared by the scripts that work through a split
+# one trajectory (or render log) at a time
+#   for task, result, error in run_trajectory_pool(write_trajectory,tasks,workers,
+#                                                  initializer=init_worker,initargs=(pb_path,)):
+# calls write_trajectory(*task) for each task tuple, in worker processes if
+# workers > 1.  Results are yielded as they finish, or in task order with
+# ordered=True.  An exception is yielded as the error 'TypeName: message',
+# with a result of None, so that one failure does not stop a batch.  The
+# initializer is only run by the worker processes, serial runs call the
+# function in this process, which must already be set up.
+
+def error_message(e):
+    return '{0}: {1}'.format(type(e).__name__, e)
+
+# Returns (task index, result, error) where error is None on success
+def call_task(indexed_task):
+    task_idx, function, task = indexed_task
+    try:
+        return task_idx, function(*task), None
+    except Exception as e:
+        return task_idx, None, error_message(e)
+
+def run_trajectory_pool(function,tasks,workers=1,initializer=None,initargs=(),ordered=False,chunksize=1):
+    tasks = list(tasks)
+    indexed_tasks = ((task_idx,function,task) for task_idx,task in enumerate(tasks))
+    if workers <= 1:
+        for task_idx,result,error in map(call_task,indexed_tasks):
+            yield tasks[task_idx], result, error
+        return
+    pool = multiprocessing.Pool(workers,initializer=initializer,initargs=initargs)
+    try:
+        imap = pool.imap if ordered else pool.imap_unordered
+        for task_idx,result,error in imap(call_task,indexed_tasks,chunksize=chunksize):
+            yield tasks[task_idx], result, error
+    except BaseException:
+        # Includes the caller abandoning the results part way through
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+# Prints e.g. 'Trajectories:3/10 frames written:120 skipped:4 (40.1 frames/s)',
+# fields are the (name, value) pairs before the frame rate
+def print_progress(done,total,frames,start_time,*fields):
+    print('Trajectories:{0}/{1} {2} ({3:.1f} frames/s)'.format(
+        done,total,' '.join('{0}:{1}'.format(name,value) for name,value in fields),
+        frames / max(time.time() - start_time,1e-6)))
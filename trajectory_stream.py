@@ -0,0 +1,194 @@
+import numpy as np
+import os
+import scenenet_pb2 as sn
+import struct
+import sys
+from trajectory_index import IndexedTrajectories, encode_varint, trajectory_record
+
+# A streaming alternative to a single (multi-GB) Trajectories message.  The
+# file is
+#   header: STREAM_MAGIC
+#   records: varint length + serialized sn.Trajectory, one per trajectory
+#   footer: little endian uint64 record offsets, uint64 count,
+#           uint64 footer offset, FOOTER_MAGIC
+# Trajectories are flushed as they are written, and the footer index is only
+# written on close, so a file without a footer (e.g. from a crashed run) can
+# still be read sequentially and appended to.
+#   with TrajectoryStreamWriter('scenenet_rgbd_train.trajs') as writer:
+#       writer.write(trajectory)
+#   for trajectory in iter_trajectory_stream('scenenet_rgbd_train.trajs'):
+#       ...
+
+STREAM_MAGIC = b'SNTRAJS1'
+FOOTER_MAGIC = b'SNTRIDX1'
+FOOTER_TAIL = struct.Struct('<QQ8s')
+
+# Reads a varint from a file object, returning None at the end of the file
+def read_varint_from_file(f):
+    result = 0
+    shift = 0
+    while True:
+        byte = f.read(1)
+        if not byte:
+            if shift:
+                raise IOError('Truncated varint at byte:{0}'.format(f.tell()))
+            return None
+        byte = byte[0]
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result
+        shift += 7
+
+def check_stream_header(f,path):
+    f.seek(0)
+    if f.read(len(STREAM_MAGIC)) != STREAM_MAGIC:
+        raise IOError('Not a trajectory stream file:{0}'.format(path))
+
+# Returns (offsets, footer_offset) from the footer, or None if there is none
+def read_stream_footer(f):
+    f.seek(0,os.SEEK_END)
+    size = f.tell()
+    if size < len(STREAM_MAGIC) + FOOTER_TAIL.size:
+        return None
+    f.seek(size - FOOTER_TAIL.size)
+    count, footer_offset, magic = FOOTER_TAIL.unpack(f.read(FOOTER_TAIL.size))
+    if magic != FOOTER_MAGIC or footer_offset + 8 * count + FOOTER_TAIL.size != size:
+        return None
+    f.seek(footer_offset)
+    offsets = np.frombuffer(f.read(8 * count),dtype='<u8').astype(np.int64)
+    return offsets, footer_offset
+
+# Walks the records from the header, returning (offsets, end) where end is the
+# position after the last complete record
+def scan_stream_records(f):
+    offsets = []
+    size = f.seek(0,os.SEEK_END)
+    pos = len(STREAM_MAGIC)
+    f.seek(pos)
+    while pos < size:
+        length = read_varint_from_file(f)
+        if length is None or f.tell() + length > size:
+            break
+        offsets.append(pos)
+        pos = f.tell() + length
+        f.seek(pos)
+    return np.array(offsets,dtype=np.int64), pos
+
+# Returns the record offsets of a stream file, from the footer if it has one
+def read_stream_index(path):
+    with open(path,'rb') as f:
+        check_stream_header(f,path)
+        footer = read_stream_footer(f)
+        if footer is not None:
+            return footer[0]
+        return scan_stream_records(f)[0]
+
+def read_record_at(f,offset):
+    f.seek(offset)
+    length = read_varint_from_file(f)
+    data = f.read(length) if length is not None else b''
+    if length is None or len(data) != length:
+        raise IOError('Truncated trajectory record at byte:{0}'.format(offset))
+    return data
+
+class TrajectoryStreamWriter(object):
+    # Appends trajectories to a stream file, creating it if needed.  With
+    # append=False an existing file is replaced.
+    def __init__(self,path,append=False):
+        self.path = path
+        if append and os.path.isfile(path):
+            self._file = open(path,'r+b')
+            check_stream_header(self._file,path)
+            footer = read_stream_footer(self._file)
+            if footer is not None:
+                offsets, end = footer
+            else:
+                # Drops any partially written record
+                offsets, end = scan_stream_records(self._file)
+            self.offsets = [int(offset) for offset in offsets]
+            self._file.seek(end)
+            self._file.truncate()
+        else:
+            self._file = open(path,'wb')
+            self._file.write(STREAM_MAGIC)
+            self.offsets = []
+
+    def __len__(self):
+        return len(self.offsets)
+
+    # Takes an sn.Trajectory or its serialized bytes
+    def write(self,trajectory):
+        if isinstance(trajectory,sn.Trajectory):
+            trajectory = trajectory.SerializeToString()
+        self.offsets.append(self._file.tell())
+        self._file.write(encode_varint(len(trajectory)))
+        self._file.write(trajectory)
+        self._file.flush()
+
+    def close(self):
+        if self._file.closed:
+            return
+        footer_offset = self._file.tell()
+        self._file.write(np.array(self.offsets,dtype='<u8').tobytes())
+        self._file.write(FOOTER_TAIL.pack(len(self.offsets),footer_offset,FOOTER_MAGIC))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc_info):
+        self.close()
+
+# Yields one sn.Trajectory at a time (or its serialized bytes with raw=True),
+# so only a single trajectory is ever decoded in memory.  Without a footer the
+# records are read up to the last complete one, as the writer would append.
+def iter_trajectory_stream(path,raw=False):
+    with open(path,'rb') as f:
+        check_stream_header(f,path)
+        footer = read_stream_footer(f)
+        end = footer[1] if footer is not None else scan_stream_records(f)[1]
+        f.seek(len(STREAM_MAGIC))
+        while f.tell() < end:
+            offset = f.tell()
+            length = read_varint_from_file(f)
+            if length is None:
+                break
+            data = f.read(length)
+            if len(data) != length:
+                raise IOError('Truncated trajectory record at byte:{0} of {1}'.format(offset,path))
+            if raw:
+                yield data
+            else:
+                trajectory = sn.Trajectory()
+                trajectory.ParseFromString(data)
+                yield trajectory
+
+# Converts a scenenet_rgbd_*.pb file into a stream file without decoding the
+# trajectories
+def protobuf_to_stream(protobuf_path,stream_path):
+    with IndexedTrajectories(protobuf_path) as trajectories:
+        with TrajectoryStreamWriter(stream_path) as writer:
+            for idx in range(len(trajectories)):
+                writer.write(bytes(trajectories.trajectory_bytes(idx)))
+    return len(writer)
+
+# Converts a stream file back into the single Trajectories message layout of
+# the released scenenet_rgbd_*.pb files, one trajectory at a time
+def stream_to_protobuf(stream_path,protobuf_path):
+    num_trajectories = 0
+    with open(protobuf_path,'wb') as f:
+        for trajectory_bytes in iter_trajectory_stream(stream_path,raw=True):
+            f.write(trajectory_record(trajectory_bytes))
+            num_trajectories += 1
+    return num_trajectories
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4 or sys.argv[1] not in ('to-stream','to-protobuf'):
+        print('Please run as python trajectory_stream.py to-stream data/scenenet_rgbd_val.pb data/scenenet_rgbd_val.trajs')
+        print('or python trajectory_stream.py to-protobuf data/scenenet_rgbd_val.trajs data/scenenet_rgbd_val.pb')
+        sys.exit(1)
+    if sys.argv[1] == 'to-stream':
+        num_trajectories = protobuf_to_stream(sys.argv[2],sys.argv[3])
+    else:
+        num_trajectories = stream_to_protobuf(sys.argv[2],sys.argv[3])
+    print('Converted {0} trajectories to:{1}'.format(num_trajectories,sys.argv[3]))
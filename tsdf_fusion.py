@@ -0,0 +1,331 @@
+import argparse
+from geometry import DEFAULT_HFOV, DEFAULT_VFOV, depth_to_world_points, normalised_pixel_to_ray_array
+import math
+import numpy as np
+from obj_mesh import save_mesh_npz, save_mesh_ply
+import random
+from scenenet_frames import SceneNetFrames
+import sys
+
+# Fuses the depth frames of a trajectory into a truncated signed distance
+# function (TSDF) stored in a sparse grid of voxel blocks, e.g.
+#   volume = TSDFVolume(voxel_size=0.02,labels=True)
+#   for frame in SceneNetFrames(protobuf_path,data_root_path,components=('depth','instance')):
+#       volume.integrate(frame.depth * 0.001,frame.camera_to_world,frame.instance)
+#   vertices, triangles, face_labels, vertex_labels = volume.extract_mesh()
+#
+# Blocks of BLOCK_SIZE^3 voxels are only allocated around observed surfaces,
+# so memory scales with the surface area rather than the room's bounding box.
+# The SceneNet depth is the distance along each pixel's ray, so the signed
+# distance of a voxel is the depth of the pixel it projects to minus the
+# voxel's distance from the camera.  Instance labels are fused by counting the
+# observations of up to LABEL_SLOTS labels per voxel, the voxel label being
+# the most frequent.  When a voxel sees more labels than that, a new label
+# takes over the least frequent slot with its count + 1 (the Space-Saving
+# algorithm), which still keeps any label seen in more than 1/LABEL_SLOTS of
+# the observations.
+
+BLOCK_SIZE = 8
+UNKNOWN_LABEL = -1
+LABEL_SLOTS = 3
+
+# Voxel coordinates are packed into one int64 key for lookups, with 21 bits per
+# axis
+KEY_BITS = 21
+KEY_OFFSET = 1 << (KEY_BITS - 1)
+
+def voxel_keys(coords):
+    coords = coords.astype(np.int64) + KEY_OFFSET
+    return (coords[...,0] << (2 * KEY_BITS)) | (coords[...,1] << KEY_BITS) | coords[...,2]
+
+def coords_from_keys(keys):
+    mask = (1 << KEY_BITS) - 1
+    coords = np.stack(((keys >> (2 * KEY_BITS)) & mask,(keys >> KEY_BITS) & mask,keys & mask),axis=-1)
+    return coords - KEY_OFFSET
+
+# The (x,y,z) offsets of the 8 corners of a cube, corner c has offset bit i of c
+# on axis i
+CUBE_CORNERS = np.array([[(c >> 0) & 1,(c >> 1) & 1,(c >> 2) & 1] for c in range(8)])
+# The 12 cube edges as pairs of corners differing in one axis
+CUBE_EDGES = np.array([(a,a | (1 << axis)) for axis in range(3) for a in range(8) if not a & (1 << axis)])
+
+# Returns the index of each key in sorted_keys, or -1 where it is missing
+def lookup_keys(sorted_keys,keys):
+    pos = np.searchsorted(sorted_keys,keys)
+    pos = np.minimum(pos,len(sorted_keys) - 1)
+    found = sorted_keys[pos] == keys if len(sorted_keys) else np.zeros(keys.shape,dtype=bool)
+    return np.where(found,pos,-1)
+
+class TSDFVolume(object):
+    def __init__(self,voxel_size=0.02,truncation=None,max_weight=64.0,labels=False,
+                 hfov=DEFAULT_HFOV,vfov=DEFAULT_VFOV):
+        self.voxel_size = voxel_size
+        # A few voxels either side of the surface by default
+        self.truncation = truncation or 4.0 * voxel_size
+        self.max_weight = max_weight
+        self.labels = labels
+        self.hfov = hfov
+        self.vfov = vfov
+        self.block_length = voxel_size * BLOCK_SIZE
+        # The sorted keys of the allocated blocks and the index of each block
+        self._block_keys = np.zeros(0,dtype=np.int64)
+        self._block_key_indices = np.zeros(0,dtype=np.int64)
+        self.num_blocks = 0
+        self.block_coords = np.zeros((0,3),dtype=np.int64)
+        self.tsdf = np.ones((0,BLOCK_SIZE ** 3),dtype=np.float32)
+        self.weight = np.zeros((0,BLOCK_SIZE ** 3),dtype=np.float32)
+        # The label slots of each voxel and their observation counts, there
+        # are none without label fusion
+        label_slots = LABEL_SLOTS if labels else 0
+        self.label = np.full((0,BLOCK_SIZE ** 3,label_slots),UNKNOWN_LABEL,dtype=np.int32)
+        self.label_count = np.zeros((0,BLOCK_SIZE ** 3,label_slots),dtype=np.int32)
+        # Voxel offsets within a block, in the flattened voxel order
+        self._block_voxels = np.stack(np.meshgrid(np.arange(BLOCK_SIZE),np.arange(BLOCK_SIZE),
+                                                  np.arange(BLOCK_SIZE),indexing='ij'),axis=-1).reshape(-1,3)
+
+    def _grow(self,capacity):
+        def grown(array,fill):
+            new = np.full((capacity,) + array.shape[1:],fill,dtype=array.dtype)
+            new[:len(array)] = array
+            return new
+        self.block_coords = grown(self.block_coords,0)
+        self.tsdf = grown(self.tsdf,1.0)
+        self.weight = grown(self.weight,0.0)
+        self.label = grown(self.label,UNKNOWN_LABEL)
+        self.label_count = grown(self.label_count,0)
+
+    # Returns the block indices of (K,3) block coordinates, allocating any new
+    # blocks
+    def allocate_blocks(self,coords):
+        keys = voxel_keys(coords)
+        found = lookup_keys(self._block_keys,keys)
+        indices = np.zeros(len(keys),dtype=np.int64)
+        if len(self._block_keys):
+            indices = self._block_key_indices[np.maximum(found,0)]
+        new = found < 0
+        new_keys, new_inverse = np.unique(keys[new],return_inverse=True)
+        new_indices = self.num_blocks + np.arange(len(new_keys),dtype=np.int64)
+        indices[new] = new_indices[new_inverse]
+        self.num_blocks += len(new_keys)
+        insert_at = np.searchsorted(self._block_keys,new_keys)
+        self._block_keys = np.insert(self._block_keys,insert_at,new_keys)
+        self._block_key_indices = np.insert(self._block_key_indices,insert_at,new_indices)
+        if self.num_blocks > len(self.block_coords):
+            self._grow(max(self.num_blocks,2 * len(self.block_coords)))
+        self.block_coords[indices] = coords
+        return indices
+
+    # The blocks within the truncation distance of the surfaces seen in a frame
+    def _frame_blocks(self,depth,camera_to_world):
+        height, width = depth.shape
+        rays = normalised_pixel_to_ray_array(width,height,self.hfov,self.vfov,dtype=np.float32)
+        valid = depth > 0
+        num_samples = int(math.ceil(2.0 * self.truncation / (0.5 * self.block_length))) + 1
+        block_keys = []
+        for offset in np.linspace(-self.truncation,self.truncation,num_samples):
+            sample_depth = np.where(valid,np.maximum(depth + offset,0.0),0.0)
+            points = depth_to_world_points(sample_depth,camera_to_world,dtype=np.float32,rays=rays)[0]
+            block_keys.append(voxel_keys(np.floor(points[valid] / self.block_length)))
+        # Unique on the packed keys is much cheaper than on the rows
+        return coords_from_keys(np.unique(np.concatenate(block_keys)))
+
+    # Integrates one frame, with depth in metres (0 where there is no surface)
+    # and a (4,4) camera to world transform.  instance is an optional (H,W)
+    # label image, fused if the volume was created with labels=True.
+    def integrate(self,depth,camera_to_world,instance=None):
+        depth = np.asarray(depth,dtype=np.float32)
+        camera_to_world = np.asarray(camera_to_world,dtype=np.float64)
+        height, width = depth.shape
+        block_indices = self.allocate_blocks(self._frame_blocks(depth,camera_to_world))
+        if not len(block_indices):
+            return
+
+        # Voxel centres of every block in view, in camera coordinates
+        voxels = self.block_coords[block_indices][:,np.newaxis,:] * BLOCK_SIZE + self._block_voxels
+        centres = (voxels.reshape(-1,3) + 0.5) * self.voxel_size
+        rotation = camera_to_world[:3,:3]
+        points = (centres - camera_to_world[:3,3]).dot(rotation)
+
+        # Inverse of pixel_to_ray, to the nearest pixel
+        z = points[:,2]
+        in_front = z > 1e-6
+        safe_z = np.where(in_front,z,1.0)
+        u = np.rint(((points[:,0] / safe_z) / math.tan(math.radians(self.hfov / 2.0)) + 1.0) * width / 2.0 - 0.5)
+        v = np.rint(((points[:,1] / safe_z) / math.tan(math.radians(self.vfov / 2.0)) + 1.0) * height / 2.0 - 0.5)
+        in_image = in_front & (u >= 0) & (u < width) & (v >= 0) & (v < height)
+        u = np.where(in_image,u,0).astype(np.int64)
+        v = np.where(in_image,v,0).astype(np.int64)
+        pixel_depth = depth[v,u]
+        sdf = pixel_depth - np.linalg.norm(points,axis=1)
+        # Voxels far behind the surface are occluded and left untouched
+        update = in_image & (pixel_depth > 0) & (sdf >= -self.truncation)
+
+        tsdf = self.tsdf[block_indices].reshape(-1)
+        weight = self.weight[block_indices].reshape(-1)
+        new_tsdf = np.minimum(sdf[update] / self.truncation,1.0)
+        old_weight = weight[update]
+        tsdf[update] = (tsdf[update] * old_weight + new_tsdf) / (old_weight + 1.0)
+        weight[update] = np.minimum(old_weight + 1.0,self.max_weight)
+        self.tsdf[block_indices] = tsdf.reshape(len(block_indices),-1)
+        self.weight[block_indices] = weight.reshape(len(block_indices),-1)
+
+        if self.labels and instance is not None:
+            near = update & (np.abs(sdf) < self.truncation)
+            # Only the slots of the voxels near the surface are gathered, from
+            # views of the whole volume
+            voxel = (block_indices[:,np.newaxis] * BLOCK_SIZE ** 3 + np.arange(BLOCK_SIZE ** 3)).reshape(-1)[near]
+            label = self.label.reshape(-1,LABEL_SLOTS)
+            count = self.label_count.reshape(-1,LABEL_SLOTS)
+            observed = np.asarray(instance)[v[near],u[near]].astype(np.int32)
+            slot_labels = label[voxel]
+            slot_counts = count[voxel]
+            # The slot of the observed label, otherwise the least frequent
+            # slot (an empty one if there is any)
+            matches = slot_labels == observed[:,np.newaxis]
+            slot = np.where(matches.any(axis=1),matches.argmax(axis=1),slot_counts.argmin(axis=1))
+            rows = np.arange(len(slot))
+            slot_labels[rows,slot] = observed
+            slot_counts[rows,slot] += 1
+            label[voxel] = slot_labels
+            count[voxel] = slot_counts
+
+    # The most frequent label of each voxel of (...,LABEL_SLOTS) label slots,
+    # UNKNOWN_LABEL if it has none
+    def voxel_labels(self,label,count):
+        if not label.shape[-1]:
+            return np.full(label.shape[:-1],UNKNOWN_LABEL,dtype=np.int32)
+        best = np.argmax(count,axis=-1)[...,np.newaxis]
+        return np.where(np.take_along_axis(count,best,axis=-1) > 0,
+                        np.take_along_axis(label,best,axis=-1),UNKNOWN_LABEL)[...,0]
+
+    # Returns the (V,3) integer coordinates, tsdf values and labels of every
+    # observed voxel
+    def observed_voxels(self,min_weight=1.0):
+        weight = self.weight[:self.num_blocks]
+        observed = weight >= min_weight
+        block, voxel = np.nonzero(observed)
+        coords = self.block_coords[block] * BLOCK_SIZE + self._block_voxels[voxel]
+        labels = self.voxel_labels(self.label[block,voxel],self.label_count[block,voxel])
+        return coords, self.tsdf[:self.num_blocks][observed], labels
+
+    # Extracts the zero level set as a triangle mesh with (naive) surface nets:
+    # a vertex is placed in every cube of 8 observed voxels that the surface
+    # crosses, at the mean of the crossings on its edges, and every voxel edge
+    # crossing the surface gives a quad joining the 4 cubes around it.  Faces
+    # face the observed free space.  Returns (vertices, triangles, face_labels,
+    # vertex_labels), the labels being UNKNOWN_LABEL without label fusion.
+    def extract_mesh(self,min_weight=1.0):
+        coords, tsdf, labels = self.observed_voxels(min_weight)
+        keys = voxel_keys(coords)
+        order = np.argsort(keys)
+        keys, coords, tsdf, labels = keys[order], coords[order], tsdf[order], labels[order]
+
+        # Cubes anchored at each voxel, kept where all corners are observed
+        # and the surface passes through
+        corners = lookup_keys(keys,voxel_keys(coords[:,np.newaxis,:] + CUBE_CORNERS))
+        complete = np.all(corners >= 0,axis=1)
+        corner_tsdf = tsdf[np.maximum(corners,0)]
+        inside = corner_tsdf < 0
+        crossed = complete & np.any(inside,axis=1) & ~np.all(inside,axis=1)
+        cube_corners = corners[crossed]
+        values = corner_tsdf[crossed]
+        cube_coords = coords[crossed]
+        cube_keys = keys[crossed]
+
+        # Mean crossing point over the cube edges
+        va = values[:,CUBE_EDGES[:,0]]
+        vb = values[:,CUBE_EDGES[:,1]]
+        edge_crossed = (va < 0) != (vb < 0)
+        t = np.where(edge_crossed,va / np.where(edge_crossed,va - vb,1.0),0.0)
+        pa = CUBE_CORNERS[CUBE_EDGES[:,0]]
+        pb = CUBE_CORNERS[CUBE_EDGES[:,1]]
+        crossings = pa + t[...,np.newaxis] * (pb - pa)
+        offsets = np.sum(crossings * edge_crossed[...,np.newaxis],axis=1) / np.sum(edge_crossed,axis=1)[:,np.newaxis]
+        vertices = ((cube_coords + 0.5 + offsets) * self.voxel_size).astype(np.float32)
+        nearest_corner = np.argmin(np.abs(values),axis=1)
+        vertex_labels = labels[cube_corners[np.arange(len(cube_corners)),nearest_corner]]
+
+        triangles = []
+        face_labels = []
+        for axis in range(3):
+            step = np.zeros(3,dtype=np.int64)
+            step[axis] = 1
+            # e_i x e_j = e_axis, so the quad below winds around +e_axis
+            e_i = np.zeros(3,dtype=np.int64)
+            e_j = np.zeros(3,dtype=np.int64)
+            e_i[(axis + 1) % 3] = 1
+            e_j[(axis + 2) % 3] = 1
+            neighbour = lookup_keys(keys,voxel_keys(coords + step))
+            has_neighbour = neighbour >= 0
+            start_inside = tsdf < 0
+            edge = has_neighbour & (start_inside != (tsdf[np.maximum(neighbour,0)] < 0))
+            edge_coords = coords[edge]
+            # The 4 cubes around the edge, in order around it
+            quad = np.stack([lookup_keys(cube_keys,voxel_keys(edge_coords - shift))
+                             for shift in (0 * e_i,e_i,e_i + e_j,e_j)],axis=1)
+            complete_quad = np.all(quad >= 0,axis=1)
+            quad = quad[complete_quad]
+            # Wind the quads so that they face away from the inside
+            flip = ~start_inside[edge][complete_quad]
+            quad[flip] = quad[flip][:,::-1]
+            triangles.append(quad[:,[0,1,2]])
+            triangles.append(quad[:,[0,2,3]])
+            # Label of whichever end of the edge is nearer the surface
+            start = np.nonzero(edge)[0][complete_quad]
+            end = neighbour[edge][complete_quad]
+            nearer = np.where(np.abs(tsdf[start]) <= np.abs(tsdf[end]),start,end)
+            face_labels += [labels[nearer]] * 2
+        triangles = np.concatenate(triangles).astype(np.int32)
+        face_labels = np.concatenate(face_labels)
+        return vertices, triangles, face_labels, vertex_labels
+
+    # The surface points (the mesh vertices) and their labels
+    def extract_point_cloud(self,min_weight=1.0):
+        vertices, _, _, vertex_labels = self.extract_mesh(min_weight)
+        return vertices, vertex_labels
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fuses the depth frames of a trajectory into a TSDF and extracts a mesh')
+    parser.add_argument('protobuf_path', help='e.g. data/scenenet_rgbd_val.pb')
+    parser.add_argument('data_root_path', help='e.g. data/val')
+    parser.add_argument('--render-path', help='The trajectory to fuse, a random one if not given')
+    parser.add_argument('--voxel-size', type=float, default=0.02, help='in metres')
+    parser.add_argument('--truncation', type=float, help='in metres, 4 voxels by default')
+    parser.add_argument('--frame-step', type=int, default=1, help='Fuse every nth frame')
+    parser.add_argument('--labels', action='store_true', help='Fuse the instance labels')
+    parser.add_argument('--backend', default='files', help='files or packed, see frame_store.py')
+    parser.add_argument('--num-threads', type=int, default=4)
+    parser.add_argument('--mesh', default='tsdf_mesh.ply', help='Output .ply or .npz mesh with per face instance ids')
+    parser.add_argument('--points', help='Also write the surface points and their labels to this .npz')
+    args = parser.parse_args()
+
+    components = ('depth','instance') if args.labels else ('depth',)
+    frames = SceneNetFrames(args.protobuf_path,args.data_root_path,num_threads=args.num_threads,
+                            components=components,backend=args.backend)
+    render_paths = [str(render_path) for render_path in frames.poses['render_path']]
+    if args.render_path is None:
+        traj_idx = random.randrange(len(render_paths))
+    elif args.render_path in render_paths:
+        traj_idx = render_paths.index(args.render_path)
+    else:
+        print('Render path:{0} is not in:{1}'.format(args.render_path,args.protobuf_path))
+        sys.exit(1)
+    frames.trajectory_indices = np.array([traj_idx])
+
+    volume = TSDFVolume(voxel_size=args.voxel_size,truncation=args.truncation,labels=args.labels)
+    for idx,frame in enumerate(frames):
+        if idx % args.frame_step:
+            continue
+        print('Fusing render path:{0} frame:{1}'.format(frame.render_path,frame.frame_num))
+        volume.integrate(frame.depth * 0.001,frame.camera_to_world,frame.instance)
+    vertices, triangles, face_labels, vertex_labels = volume.extract_mesh()
+    print('Allocated {0} blocks, extracted {1} vertices and {2} triangles'.format(
+        volume.num_blocks,len(vertices),len(triangles)))
+    if args.mesh.endswith('.npz'):
+        save_mesh_npz(args.mesh,vertices,triangles,face_labels)
+    else:
+        save_mesh_ply(args.mesh,vertices,triangles,face_labels,comment='render_path %s' % render_paths[traj_idx])
+    print('Wrote mesh to:{0}'.format(args.mesh))
+    if args.points:
+        np.savez(args.points,points=vertices,instance_ids=vertex_labels)
+        print('Wrote points to:{0}'.format(args.points))